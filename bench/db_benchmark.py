@@ -0,0 +1,237 @@
+# bench/db_benchmark.py
+"""Микробенчмарки горячих методов Database на базах разного размера.
+
+Для каждого размера (строк в users и scheduled_posts) база строится один
+раз и кэшируется в --data-dir, каждый прогон работает с ее копией.
+Каждый метод вызывается с заданной конкурентностью (задач asyncio на
+одном экземпляре Database), отчет - ops/s и p50/p99 на вызов.
+Кэш пользователей по умолчанию выключен (--user-cache-size 0), иначе
+get_user и get_user_channels после прогрева измеряют словарь, а не базу.
+
+Примеры:
+    python bench/db_benchmark.py --sizes 1e3,1e4,1e5 --save bench/baseline.json
+    python bench/db_benchmark.py --sizes 1e3,1e4,1e5 --compare bench/baseline.json
+    python bench/db_benchmark.py --sizes 1e6 --pragma cache_size=-64000 --compare bench/baseline.json
+
+--compare завершается с кодом 1, если p50 или ops/s хуже базовых больше
+чем на --threshold процентов. Размер 1e7 строится несколько минут и
+занимает несколько ГБ.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from load_test import FIRST_USER_ID, ROOT, channel_id, latency_report, seed
+
+sys.path.insert(0, str(ROOT))
+main = importlib.import_module('main')
+
+def parse_pragma(value: str):
+    key, _, raw = value.partition('=')
+    if not raw:
+        raise argparse.ArgumentTypeError(f'Ожидается имя=значение: {value}')
+    return key, int(raw) if raw.lstrip('-').isdigit() else raw
+
+def parse_list(value: str) -> List[int]:
+    return [int(float(item)) for item in value.split(',') if item]
+
+# ========== БЕНЧМАРКИ ==========
+def make_benchmarks(database, rng: random.Random, size: int) -> Dict[str, Callable]:
+    """Имя метода -> фабрика операции; фабрика получает число операций и готовит данные"""
+    now = datetime.now()
+    fresh_user = [FIRST_USER_ID + size]
+
+    def random_user() -> int:
+        return FIRST_USER_ID + rng.randrange(size)
+
+    async def get_user(count: int):
+        return lambda: database.get_user(random_user())
+
+    async def get_user_channels(count: int):
+        return lambda: database.get_user_channels(random_user())
+
+    async def get_pending_posts(count: int):
+        # Окно диспетчера - ближайший час
+        return lambda: database.get_pending_posts(now + timedelta(hours=1))
+
+    async def get_statistics(count: int):
+        return database.get_statistics
+
+    async def add_scheduled_post(count: int):
+        def op():
+            user_id = random_user()
+            return database.add_scheduled_post(user_id, channel_id(user_id, 0), 'text', 'bench', None,
+                                               now + timedelta(seconds=rng.uniform(3600, 7 * 86400)))
+        return op
+
+    async def add_user_channel(count: int):
+        # Новые пользователи без каналов, чтобы проходила вставка, а не отказ по лимиту
+        first = fresh_user[0]
+        fresh_user[0] += count
+        conn = await database.connect()
+        await conn.executemany('INSERT INTO users (user_id, first_name) VALUES (?, ?)',
+                               ((uid, 'bench') for uid in range(first, first + count)))
+        await conn.commit()
+        users = iter(range(first, first + count))
+
+        def op():
+            user_id = next(users)
+            return database.add_user_channel(user_id, channel_id(user_id, 0), 'bench')
+        return op
+
+    return {
+        'get_user': get_user,
+        'get_user_channels': get_user_channels,
+        'get_pending_posts': get_pending_posts,
+        'get_statistics': get_statistics,
+        'add_scheduled_post': add_scheduled_post,
+        'add_user_channel': add_user_channel,
+    }
+
+async def measure(op: Callable, ops: int, concurrency: int, max_seconds: float) -> Dict:
+    """ops вызовов op() в concurrency задачах (или меньше, если вышло время)"""
+    latencies: List[float] = []
+    remaining = iter(range(ops))
+    deadline = time.perf_counter() + max_seconds
+
+    async def worker():
+        for _ in remaining:
+            started = time.perf_counter()
+            await op()
+            latencies.append(time.perf_counter() - started)
+            if started > deadline:
+                break
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    report = latency_report(latencies)
+    report['ops_per_second'] = round(len(latencies) / elapsed, 1) if elapsed else 0.0
+    return report
+
+# ========== БАЗЫ ==========
+async def build_template(path: Path, size: int, seed_value: int):
+    """База на size пользователей (по каналу на каждого) и size постов на ближайшую неделю"""
+    database = main.Database(str(path), read_pool_size=0)
+    started = time.perf_counter()
+    await seed(database, random.Random(seed_value), size, 1, size, chunk=100000)
+    await database.close()
+    logging.warning(f'База {path.name} построена за {time.perf_counter() - started:.1f} с')
+
+async def run_size(args, size: int) -> List[Dict]:
+    data_dir = Path(args.data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    # Версия схемы в имени: после новой миграции шаблон строится заново
+    template = data_dir / f'db_{size}_v{len(main.Database.MIGRATIONS)}_s{args.seed}.db'
+    if not template.exists() or args.rebuild:
+        template.unlink(missing_ok=True)
+        await build_template(template, size, args.seed)
+    work = data_dir / f'work_{size}.db'
+    for suffix in ('-wal', '-shm'):
+        Path(str(work) + suffix).unlink(missing_ok=True)
+    shutil.copyfile(template, work)
+
+    database = main.Database(str(work), pragmas=dict(args.pragma), group_commit=args.group_commit,
+                             user_cache_size=args.user_cache_size)
+    await database.init_db()
+    rng = random.Random(args.seed)
+    benchmarks = make_benchmarks(database, rng, size)
+    results = []
+    for name in args.methods or benchmarks:
+        for concurrency in args.concurrency:
+            op = await benchmarks[name](args.warmup + args.ops)
+            await measure(op, args.warmup, concurrency, args.max_seconds)
+            report = await measure(op, args.ops, concurrency, args.max_seconds)
+            results.append({'method': name, 'size': size, 'concurrency': concurrency, **report})
+            print(f"{name:<20} {size:>10} x{concurrency:<4} {report['ops_per_second']:>10.1f} ops/s  "
+                  f"p50 {report['p50_ms']:>8.3f} ms  p99 {report['p99_ms']:>8.3f} ms", flush=True)
+    await database.close()
+    return results
+
+def metadata(args) -> Dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'schema_version': len(main.Database.MIGRATIONS),
+        'pragmas': {**main.Database.PRAGMAS, **dict(args.pragma)},
+        'group_commit': args.group_commit,
+        'user_cache_size': args.user_cache_size,
+        'ops': args.ops,
+        'seed': args.seed,
+    }
+
+# ========== СРАВНЕНИЕ ==========
+def compare(baseline: Dict, results: List[Dict], threshold: float) -> List[str]:
+    """Печать изменений относительно базовых результатов, возвращает регрессии"""
+    base = {(row['method'], row['size'], row['concurrency']): row for row in baseline['results']}
+    regressions = []
+    print(f"\nСравнение с {baseline['meta'].get('commit') or '?'} от {baseline['meta'].get('date')}:")
+    for row in results:
+        key = (row['method'], row['size'], row['concurrency'])
+        old = base.get(key)
+        if old is None:
+            continue
+        p50 = (row['p50_ms'] / old['p50_ms'] - 1) * 100 if old['p50_ms'] else 0.0
+        ops = (row['ops_per_second'] / old['ops_per_second'] - 1) * 100 if old['ops_per_second'] else 0.0
+        worse = p50 > threshold or ops < -threshold
+        label = f"{key[0]} size={key[1]} x{key[2]}"
+        print(f"{label:<45} p50 {p50:+7.1f}%  ops/s {ops:+7.1f}%{'  РЕГРЕССИЯ' if worse else ''}")
+        if worse:
+            regressions.append(label)
+    return regressions
+
+async def run(args) -> Dict:
+    results = []
+    for size in args.sizes:
+        results.extend(await run_size(args, size))
+    return {'meta': metadata(args), 'results': results}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Микробенчмарки Database')
+    parser.add_argument('--sizes', type=parse_list, default=[1000, 10000, 100000], help='например 1e3,1e5,1e7')
+    parser.add_argument('--concurrency', type=parse_list, default=[1, 16])
+    parser.add_argument('--methods', type=lambda value: value.split(','), help='по умолчанию все')
+    parser.add_argument('--ops', type=int, default=1000, help='вызовов на метод')
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--max-seconds', type=float, default=10, help='ограничение времени на метод')
+    parser.add_argument('--pragma', type=parse_pragma, action='append', default=[], help='имя=значение')
+    parser.add_argument('--group-commit', action='store_true')
+    parser.add_argument('--user-cache-size', type=int, default=0, help='размер кэша пользователей Database')
+    parser.add_argument('--data-dir', default=str(ROOT / 'bench' / '.data'))
+    parser.add_argument('--rebuild', action='store_true', help='пересоздать шаблоны баз')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', help='сохранить результаты в JSON (базовая линия)')
+    parser.add_argument('--compare', help='JSON с базовыми результатами')
+    parser.add_argument('--threshold', type=float, default=20, help='допустимое ухудшение, %%')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    if args.save:
+        Path(args.save).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+    if args.compare:
+        regressions = compare(json.loads(Path(args.compare).read_text(encoding='utf-8')), report['results'],
+                              args.threshold)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,156 @@
+# bench/fake_bot_api.py
+"""Поддельный Bot API для нагрузочного стенда.
+
+Отвечает на /bot<token>/<method> как api.telegram.org: sendMessage,
+sendPhoto, sendVideo, sendMediaGroup, copyMessage, editMessageText,
+getChatMember, getMe и т.д. Задержка ответа и доля ответов 429
+(flood control) настраиваются, случайность задается seed, поэтому
+прогоны воспроизводимы.
+
+Отдельный запуск (бот с BOT_API_URL=http://127.0.0.1:8081/bot):
+    python bench/fake_bot_api.py --port 8081 --latency 50 --flood-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from aiohttp import web
+
+# Методы отправки, на которые может прийти 429
+SEND_METHODS = {'sendMessage', 'sendPhoto', 'sendVideo', 'sendMediaGroup', 'copyMessage'}
+
+class FakeBotAPI:
+    """Bot API в памяти: latency и jitter в секундах, flood_rate - доля 429 на отправки"""
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, flood_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = 0, bot_username: str = 'bench_bot'):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.bot_username = bot_username
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.floods = 0
+        self.message_id = 0
+        self.base_url: Optional[str] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Запуск сервера (port=0 - свободный порт), возвращает base_url для Bot"""
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f'http://{host}:{port}/bot'
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def stats(self) -> Dict:
+        return {'calls': dict(self.calls), 'floods': self.floods}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(await request.post()) if request.can_read_body else {}
+        self.calls[method] += 1
+
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if method in SEND_METHODS and self.flood_rate and self.random.random() < self.flood_rate:
+            self.floods += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+
+        handler = getattr(self, f'_{method}', None)
+        result = handler(params) if handler else True
+        return web.json_response({'ok': True, 'result': result})
+
+    def _message(self, params: Dict, **fields) -> Dict:
+        self.message_id += 1
+        chat_id = params.get('chat_id', '0')
+        chat_id = int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0
+        return {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'channel' if chat_id < 0 else 'private'},
+            **fields,
+        }
+
+    def _getMe(self, params: Dict) -> Dict:
+        return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': self.bot_username,
+                'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+
+    def _sendMessage(self, params: Dict) -> Dict:
+        return self._message(params, text=params.get('text', ''))
+
+    def _editMessageText(self, params: Dict) -> Dict:
+        return self._message(params, text=params.get('text', ''))
+
+    def _sendPhoto(self, params: Dict) -> Dict:
+        photo = {'file_id': str(params.get('photo', 'photo')), 'file_unique_id': 'p', 'width': 1, 'height': 1}
+        return self._message(params, photo=[photo], caption=params.get('caption'))
+
+    def _sendVideo(self, params: Dict) -> Dict:
+        video = {'file_id': str(params.get('video', 'video')), 'file_unique_id': 'v',
+                 'width': 1, 'height': 1, 'duration': 1}
+        return self._message(params, video=video, caption=params.get('caption'))
+
+    def _sendMediaGroup(self, params: Dict) -> list:
+        media = json.loads(params.get('media', '[]'))
+        return [self._message(params, media_group_id='1', text='') for _ in media]
+
+    def _copyMessage(self, params: Dict) -> Dict:
+        self.message_id += 1
+        return {'message_id': self.message_id}
+
+    def _getChatMember(self, params: Dict) -> Dict:
+        return {
+            'status': 'administrator',
+            'user': {'id': int(params.get('user_id', 1)), 'is_bot': True, 'first_name': 'Bench'},
+            'can_be_edited': False, 'is_anonymous': False, 'can_manage_chat': True,
+            'can_delete_messages': True, 'can_manage_video_chats': True, 'can_restrict_members': True,
+            'can_promote_members': False, 'can_change_info': True, 'can_invite_users': True,
+            'can_post_messages': True, 'can_edit_messages': True,
+        }
+
+async def serve(args):
+    api = FakeBotAPI(args.latency / 1000, args.jitter / 1000, args.flood_rate, args.retry_after, args.seed)
+    base_url = await api.start(args.host, args.port)
+    print(f'Поддельный Bot API: {base_url}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(json.dumps(api.stats(), ensure_ascii=False))
+        await api.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Поддельный Telegram Bot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=50, help='средняя задержка ответа, мс')
+    parser.add_argument('--jitter', type=float, default=20, help='разброс задержки, мс')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='доля отправок с ответом 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответе 429, с')
+    parser.add_argument('--seed', type=int, default=0)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,307 @@
+# bench/load_test.py
+"""Нагрузочный стенд: бот против поддельного Bot API (bench/fake_bot_api.py).
+
+Сценарии:
+    seed     - наполнение базы пользователями, каналами и постами
+    webhook  - прогон синтетических обновлений через WebhookIngress и обработчики
+    publish  - публикация наступивших постов через publish_scheduled_posts
+
+Примеры:
+    python bench/load_test.py seed --db bench.db --fresh --users 10000 --posts 100000
+    python bench/load_test.py webhook --db bench.db --updates 20000 --concurrency 200
+    python bench/load_test.py publish --db bench.db --posts 5000 --flood-rate 0.01
+
+Отчет - пропускная способность и p50/p99 задержки, --output сохраняет его в JSON.
+Все случайные данные и ответы 429 задаются --seed, прогоны воспроизводимы.
+Лимиты Telegram (--global-rate, --chat-rate) по умолчанию подняты, чтобы
+мерить сам бот; для реального профиля задайте 30 и 20.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List
+
+import aiohttp
+from aiohttp import web
+
+from fake_bot_api import FakeBotAPI
+
+ROOT = Path(__file__).resolve().parent.parent
+BENCH_TOKEN = '123456:BENCH'
+FIRST_USER_ID = 100000
+
+def load_bot(args):
+    """Импорт main.py с конфигурацией стенда (main читает окружение при импорте)"""
+    os.environ['DB_PATH'] = args.db
+    os.environ['BOT_TOKEN'] = BENCH_TOKEN
+    os.environ.pop('RAILWAY_STATIC_URL', None)
+    os.environ['PUBLISH_WORKERS'] = str(args.workers)
+    os.environ['GLOBAL_RATE_LIMIT'] = str(args.global_rate)
+    os.environ['CHAT_RATE_LIMIT'] = str(args.chat_rate)
+    if args.fresh:
+        for suffix in ('', '-wal', '-shm'):
+            Path(args.db + suffix).unlink(missing_ok=True)
+    sys.path.insert(0, str(ROOT))
+    main = importlib.import_module('main')
+    logging.getLogger().setLevel(args.log_level)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    return main
+
+def percentile(samples: List[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(q * len(ordered) + 0.5) - 1))]
+
+def latency_report(samples: List[float]) -> Dict:
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'max_ms': round(max(samples, default=0) * 1000, 3),
+    }
+
+def channel_id(user_id: int, index: int) -> str:
+    return f'-100{user_id * 10 + index}'
+
+# ========== НАПОЛНЕНИЕ БАЗЫ ==========
+async def seed(database, rng: random.Random, users: int, channels_per_user: int, posts: int,
+               due: bool = False, chunk: int = 10000) -> Dict:
+    """Пользователи, их каналы и посты (due - все посты уже наступили, иначе - ближайшая неделя)"""
+    await database.init_db()
+    conn = await database.connect()
+    started = time.perf_counter()
+
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + users)
+    await conn.executemany(
+        'INSERT OR IGNORE INTO users (user_id, username, first_name, tariff, channels_count) VALUES (?, ?, ?, ?, ?)',
+        ((uid, f'user{uid}', f'User {uid}', rng.choice(('free', 'basic')), channels_per_user) for uid in user_ids)
+    )
+    await conn.executemany(
+        'INSERT OR IGNORE INTO user_channels (user_id, channel_id, channel_name) VALUES (?, ?, ?)',
+        ((uid, channel_id(uid, i), f'Channel {uid}/{i}') for uid in user_ids for i in range(channels_per_user))
+    )
+    await conn.commit()
+
+    now = datetime.now()
+    for offset in range(0, posts, chunk):
+        rows = []
+        for _ in range(min(chunk, posts - offset)):
+            uid = rng.randrange(FIRST_USER_ID, FIRST_USER_ID + users)
+            when = now - timedelta(seconds=rng.uniform(1, 60)) if due else now + timedelta(seconds=rng.uniform(60, 7 * 86400))
+            rows.append((uid, channel_id(uid, rng.randrange(channels_per_user)), 'text',
+                         f'Пост {offset + len(rows)}', None, when.isoformat()))
+        await conn.executemany('''
+            INSERT INTO scheduled_posts (user_id, channel_id, content_type, content, media_id, scheduled_time)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+        await conn.commit()
+
+    return {'users': users, 'channels': users * channels_per_user, 'posts': posts,
+            'seconds': round(time.perf_counter() - started, 2)}
+
+async def run_seed(main, args, rng: random.Random) -> Dict:
+    seeded = await seed(main.db, rng, args.users, args.channels_per_user, args.posts)
+    await main.db.close()
+    return {'seed': seeded}
+
+# ========== WEBHOOK ==========
+def synthetic_update(update_id: int, user_id: int, kind: str) -> Dict:
+    """Обновление Telegram: команда или нажатие кнопки"""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'}
+    chat = {'id': user_id, 'type': 'private'}
+    if kind.startswith('/'):
+        return {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user, 'text': kind,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(kind)}],
+        }}
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': user, 'chat_instance': str(user_id), 'data': kind,
+        'message': {'message_id': 1, 'date': int(time.time()), 'chat': chat, 'text': 'menu'},
+    }}
+
+# Доли типов обновлений в прогоне
+UPDATE_MIX = [('/start', 0.4), ('/channels', 0.2), ('plan_post', 0.3), ('help', 0.1)]
+
+async def run_webhook(main, args, rng: random.Random) -> Dict:
+    """Обновления POST-запросами в /webhook; задержка подтверждения и обработки"""
+    from telegram.ext import Application
+
+    if args.users:
+        await seed(main.db, rng, args.users, args.channels_per_user, 0)
+    else:
+        await main.db.init_db()
+
+    handling: List[float] = []
+
+    class TimedApplication(Application):
+        async def process_update(self, update):
+            started = time.perf_counter()
+            try:
+                await super().process_update(update)
+            finally:
+                handling.append(time.perf_counter() - started)
+
+    api = FakeBotAPI(args.latency / 1000, args.jitter / 1000, args.flood_rate, args.retry_after, args.seed)
+    await api.start()
+    application = main.build_application(base_url=api.base_url, application_class=TimedApplication)
+    await application.initialize()
+    await application.start()
+    ingress = main.WebhookIngress(application)
+    ingress.start()
+
+    app = web.Application()
+    app.router.add_post('/webhook', ingress.handle_webhook)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    host, port = runner.addresses[0][:2]
+    url = f'http://{host}:{port}/webhook'
+
+    kinds, weights = zip(*UPDATE_MIX)
+    updates = [
+        synthetic_update(i + 1, rng.randrange(FIRST_USER_ID, FIRST_USER_ID + max(args.users, 1)), kind)
+        for i, kind in enumerate(rng.choices(kinds, weights, k=args.updates))
+    ]
+
+    acks: List[float] = []
+    statuses: Dict[int, int] = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def post(session: aiohttp.ClientSession, update: Dict):
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.post(url, json=update) as response:
+                await response.read()
+            acks.append(time.perf_counter() - started)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    started = time.perf_counter()
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(post(session, update) for update in updates))
+    sent = time.perf_counter() - started
+    await ingress.queue.join()
+    elapsed = time.perf_counter() - started
+
+    await ingress.stop()
+    await runner.cleanup()
+    await application.stop()
+    await application.shutdown()
+    await api.stop()
+    await main.db.close()
+
+    return {
+        'webhook': {
+            'updates': args.updates,
+            'http_statuses': statuses,
+            'ingress': {key: value for key, value in ingress.stats().items() if key != 'latency'},
+            'accept_per_second': round(args.updates / sent, 1),
+            'processed_per_second': round(ingress.processed / elapsed, 1),
+            'ack_latency': latency_report(acks),
+            'handling_latency': latency_report(handling),
+        },
+        'fake_api': api.stats(),
+    }
+
+# ========== ПУБЛИКАЦИЯ ==========
+async def run_publish(main, args, rng: random.Random) -> Dict:
+    """Наступившие посты: захват из базы и publish_scheduled_posts через поддельный API"""
+    from telegram import Bot
+
+    seeded = await seed(main.db, rng, args.users, args.channels_per_user, args.posts, due=True)
+
+    api = FakeBotAPI(args.latency / 1000, args.jitter / 1000, args.flood_rate, args.retry_after, args.seed)
+    await api.start()
+    bot = Bot(BENCH_TOKEN, base_url=api.base_url,
+              request=main.InstrumentedRequest(connection_pool_size=max(args.workers * 2, 64)))
+    await bot.initialize()
+    main.publish_pipeline.start(bot)
+
+    started = time.perf_counter()
+    lease_until = datetime.now() + timedelta(seconds=main.POST_LEASE_SECONDS)
+    posts = []
+    while True:
+        batch = await main.db.claim_due_posts(main.WORKER_ID, lease_until, 500)
+        posts.extend(batch)
+        if len(batch) < 500:
+            break
+    claimed = time.perf_counter() - started
+
+    # То же, что publish_scheduled_posts, плюс время завершения каждого поста
+    latencies: List[float] = []
+    publish_started = time.perf_counter()
+    futures = main.publish_pipeline.submit(posts)
+    for future in futures:
+        future.add_done_callback(lambda _: latencies.append(time.perf_counter() - publish_started))
+    results = await asyncio.gather(*futures)
+    published = time.perf_counter() - publish_started
+
+    await main.publish_pipeline.stop()
+    await bot.shutdown()
+    await api.stop()
+    await main.db.close()
+
+    outcome: Dict[str, int] = {}
+    for status in results:
+        outcome[status] = outcome.get(status, 0) + 1
+    return {
+        'seed': seeded,
+        'publish': {
+            'posts': len(posts),
+            'statuses': outcome,
+            'claim_seconds': round(claimed, 3),
+            'publish_seconds': round(published, 3),
+            'posts_per_second': round(len(posts) / published, 1) if published else 0.0,
+            'completion_latency': latency_report(latencies),
+        },
+        'fake_api': api.stats(),
+    }
+
+SCENARIOS = {'seed': run_seed, 'webhook': run_webhook, 'publish': run_publish}
+
+async def run(args) -> Dict:
+    main = load_bot(args)
+    rng = random.Random(args.seed)
+    report = await SCENARIOS[args.scenario](main, args, rng)
+    report['config'] = {key: value for key, value in vars(args).items() if key != 'output'}
+    return report
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный стенд бота')
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--db', default='bench.db', help='файл базы стенда (не рабочая scheduler.db)')
+    parser.add_argument('--fresh', action='store_true', help='удалить базу перед прогоном')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--channels-per-user', type=int, default=2)
+    parser.add_argument('--posts', type=int, default=5000)
+    parser.add_argument('--updates', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=100, help='одновременных webhook-запросов')
+    parser.add_argument('--workers', type=int, default=16, help='воркеров публикации')
+    parser.add_argument('--global-rate', type=float, default=10000, help='сообщений в секунду')
+    parser.add_argument('--chat-rate', type=float, default=10000, help='сообщений в минуту на канал')
+    parser.add_argument('--latency', type=float, default=50, help='средняя задержка Bot API, мс')
+    parser.add_argument('--jitter', type=float, default=20, help='разброс задержки, мс')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='доля отправок с ответом 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответе 429, с')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help='сохранить отчет в JSON')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text, encoding='utf-8')
@@ -3,18 +3,39 @@ import os
 import sys
 import logging
 import asyncio
+import base64
+import bisect
+import csv
+import functools
+import heapq
+import inspect
+import io
+import random
+import re
+import secrets
+import socket
+import time
 import aiosqlite
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 import json
+from collections import OrderedDict, deque, namedtuple
+from contextlib import asynccontextmanager
 from pathlib import Path
 
+try:
+    import orjson  # необязательная зависимость: быстрый разбор webhook
+except ImportError:
+    orjson = None
+
 from telegram import (
     Update, 
     InlineKeyboardButton, 
     InlineKeyboardMarkup,
     BotCommand,
     ChatMember,
+    InputMediaPhoto,
+    InputMediaVideo,
     LabeledPrice
 )
 from telegram.ext import (
@@ -27,16 +48,92 @@ from telegram.ext import (
     ConversationHandler,
     PreCheckoutQueryHandler
 )
+from telegram.error import (
+    BadRequest,
+    ChatMigrated,
+    Forbidden,
+    InvalidToken,
+    NetworkError,
+    RetryAfter,
+    TelegramError
+)
 from telegram.request import HTTPXRequest
+from aiohttp import web
 
 # ========== КОНФИГУРАЦИЯ ==========
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "7370973281:AAGdnM2SdekWwSF5alb5vnt0UWAN5QZ1dCQ")
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "6646433980"))
+ADMIN_USERS_PAGE_SIZE = 10
 PORT = int(os.environ.get("PORT", 8443))
+BOT_API_URL = os.environ.get("BOT_API_URL", "")  # другой адрес Bot API, например поддельный сервер из bench/
 WEBHOOK_URL = os.environ.get("RAILWAY_STATIC_URL", "")
 if WEBHOOK_URL:
     WEBHOOK_URL = f"https://{WEBHOOK_URL}/webhook"
 
+# Ограничения Telegram на отправку сообщений
+PUBLISH_WORKERS = int(os.environ.get("PUBLISH_WORKERS", 16))
+GLOBAL_RATE_LIMIT = float(os.environ.get("GLOBAL_RATE_LIMIT", 30))  # сообщений в секунду
+CHAT_RATE_LIMIT = float(os.environ.get("CHAT_RATE_LIMIT", 20))  # сообщений в минуту на канал
+PUBLISH_MAX_RETRIES = int(os.environ.get("PUBLISH_MAX_RETRIES", 5))
+
+# Повторы неудачных публикаций: экспоненциальная задержка с джиттером, затем dead letter
+PUBLISH_RETRY_BASE = float(os.environ.get("PUBLISH_RETRY_BASE", 5))  # секунд
+PUBLISH_RETRY_MAX_DELAY = float(os.environ.get("PUBLISH_RETRY_MAX_DELAY", 3600))  # секунд
+PUBLISH_INLINE_RETRY_AFTER = float(os.environ.get("PUBLISH_INLINE_RETRY_AFTER", 60))  # RetryAfter до стольких секунд ждем в памяти
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 5))  # ошибок подряд до размыкания
+CIRCUIT_COOLDOWN = float(os.environ.get("CIRCUIT_COOLDOWN", 300))  # секунд без отправок в канал
+
+# Аренда постов: несколько процессов публикации могут работать с одной базой
+# Случайный суффикс отличает перезапуск от прежнего процесса: его аренды не продлеваются и истекают
+WORKER_ID = (
+    f'{os.environ.get("WORKER_ID") or os.environ.get("RAILWAY_REPLICA_ID") or socket.gethostname()}'
+    f'-{os.getpid()}-{secrets.token_hex(4)}'
+)
+POST_LEASE_SECONDS = int(os.environ.get("POST_LEASE_SECONDS", 300))
+
+# SQLite
+DB_PATH = os.environ.get("DB_PATH", "scheduler.db")
+DB_READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", 4))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 256 * 1024 * 1024))
+DB_CACHE_SIZE = int(os.environ.get("DB_CACHE_SIZE", -16000))  # отрицательное значение - в КиБ
+DB_GROUP_COMMIT = os.environ.get("DB_GROUP_COMMIT", "0") == "1"
+DB_GROUP_COMMIT_DELAY = float(os.environ.get("DB_GROUP_COMMIT_DELAY", 0.005))  # секунд
+DB_GROUP_COMMIT_MAX = int(os.environ.get("DB_GROUP_COMMIT_MAX", 200))  # операторов в транзакции
+SETTINGS_CACHE_TTL = float(os.environ.get("SETTINGS_CACHE_TTL", 300))  # секунд
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))  # пользователей
+USER_CACHE_POLICY = os.environ.get("USER_CACHE_POLICY", "lru")  # lru или fifo
+
+# Очередь входящих webhook-обновлений
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 64))
+WEBHOOK_BACKPRESSURE = os.environ.get("WEBHOOK_BACKPRESSURE", "wait")  # wait или reject
+WEBHOOK_QUEUE_TIMEOUT = float(os.environ.get("WEBHOOK_QUEUE_TIMEOUT", 5))  # секунд ожидания места
+WEBHOOK_DEDUP_WINDOW = int(os.environ.get("WEBHOOK_DEDUP_WINDOW", 10000))  # последних update_id
+
+# Данные кнопок, не влезающие в 64 байта callback_data, хранятся на сервере
+CALLBACK_PAYLOAD_TTL = float(os.environ.get("CALLBACK_PAYLOAD_TTL", 24 * 3600))  # секунд
+CALLBACK_PAYLOAD_LIMIT = int(os.environ.get("CALLBACK_PAYLOAD_LIMIT", 100000))  # записей
+
+# Счетчики статистики ведут триггеры, сверка с таблицами раз в интервал
+STATS_RECONCILE_INTERVAL = float(os.environ.get("STATS_RECONCILE_INTERVAL", 3600))  # секунд
+STATS_ROLLUP_INTERVAL = float(os.environ.get("STATS_ROLLUP_INTERVAL", 300))  # секунд
+STATS_ROLLUP_CHUNK_HOURS = int(os.environ.get("STATS_ROLLUP_CHUNK_HOURS", 24))  # часов за транзакцию
+
+# Права бота в каналах: кэш проверок и фоновый обход user_channels
+ADMIN_CHECK_TTL = float(os.environ.get("ADMIN_CHECK_TTL", 600))  # секунд
+ADMIN_CHECK_INTERVAL = float(os.environ.get("ADMIN_CHECK_INTERVAL", 900))  # секунд между обходами
+ADMIN_CHECK_BATCH = int(os.environ.get("ADMIN_CHECK_BATCH", 100))  # каналов за запрос к базе
+ADMIN_CHECK_RATE = float(os.environ.get("ADMIN_CHECK_RATE", 5))  # get_chat_member в секунду
+CHANNEL_RESUME_GRACE = float(os.environ.get("CHANNEL_RESUME_GRACE", 3600))  # посты, опоздавшие сильнее, не возобновляются
+
+# Альбом собирается из сообщений с одним media_group_id, пока они приходят чаще этого интервала
+MEDIA_GROUP_DELAY = float(os.environ.get("MEDIA_GROUP_DELAY", 1.5))  # секунд
+MEDIA_GROUP_MAX_ITEMS = 10  # ограничение Telegram на альбом
+
+# Массовый импорт постов из CSV/JSON
+BULK_IMPORT_MAX_ROWS = int(os.environ.get("BULK_IMPORT_MAX_ROWS", 5000))
+BULK_IMPORT_MAX_BYTES = int(os.environ.get("BULK_IMPORT_MAX_BYTES", 2 * 1024 * 1024))
+
 # ========== НАСТРОЙКА ЛОГИРОВАНИЯ ==========
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -44,19 +141,737 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ========== МЕТРИКИ ==========
+# Границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (накопительные счетчики не храним)"""
+    
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # последняя корзина - +Inf
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+    
+    def percentile(self, q: float) -> float:
+        """Оценка перцентиля по верхней границе корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+    
+    def snapshot(self) -> Dict:
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+        }
+
+# Задержка публикации относительно scheduled_time, секунды
+LAG_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+class Counter:
+    """Монотонный счетчик"""
+    
+    def __init__(self):
+        self.value = 0
+    
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels.items()) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+class MetricsRegistry:
+    """Метрики в текстовом формате Prometheus (exposition format 0.0.4).
+    
+    Семейство метрик - имя, тип, описание и ряды по значениям меток.
+    Гистограммы и счетчики создаются при первом обращении и дальше
+    обновляются без блокировок (все происходит в одном цикле событий).
+    Глубины очередей снимаются датчиками в момент запроса /metrics.
+    """
+    
+    def __init__(self):
+        self._families: Dict[str, Tuple[str, str, Dict]] = {}
+    
+    def _family(self, kind: str, name: str, description: str) -> Dict:
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (kind, description, {})
+        elif family[0] != kind:
+            raise ValueError(f"Метрика {name} уже объявлена как {family[0]}")
+        return family[2]
+    
+    def histogram(self, name: str, description: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+                  **labels) -> Histogram:
+        series = self._family('histogram', name, description)
+        key = tuple(labels.items())
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+        return histogram
+    
+    def counter(self, name: str, description: str, **labels) -> Counter:
+        series = self._family('counter', name, description)
+        key = tuple(labels.items())
+        counter = series.get(key)
+        if counter is None:
+            counter = series[key] = Counter()
+        return counter
+    
+    def gauge(self, name: str, description: str, read: Callable[[], float], **labels):
+        """Датчик: значение читается функцией read при каждом сборе"""
+        self._family('gauge', name, description)[tuple(labels.items())] = read
+    
+    def render(self) -> str:
+        lines = []
+        for name, (kind, description, series) in self._families.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, metric in series.items():
+                labels = dict(key)
+                if kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float('inf'),), metric.counts):
+                        cumulative += count
+                        bucket_labels = _format_labels({**labels, 'le': _format_value(float(bound))})
+                        lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(metric.sum)}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {metric.count}")
+                elif kind == 'counter':
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(metric.value)}")
+                else:
+                    try:
+                        value = metric()
+                    except Exception as e:
+                        logger.warning(f"Датчик {name} недоступен: {e}")
+                        continue
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+    
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        """Метрики для Prometheus"""
+        return web.Response(body=self.render().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+metrics = MetricsRegistry()
+
+def instrument_methods(cls, name: str, description: str):
+    """Замер времени всех публичных корутин класса (гистограмма с меткой method)"""
+    for attr, func in list(vars(cls).items()):
+        if attr.startswith('_') or not inspect.iscoroutinefunction(func):
+            continue
+        histogram = metrics.histogram(name, description, method=attr)
+        
+        def timed(func=func, histogram=histogram):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+            return wrapper
+        setattr(cls, attr, timed())
+
+def timed_handler(kind: str, name: str, callback):
+    """Обработчик PTB с замером времени выполнения"""
+    histogram = metrics.histogram('bot_handler_duration_seconds', 'Время обработчиков команд, сообщений и кнопок',
+                                  kind=kind, handler=name)
+    
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с замером времени и кодов ответа каждого метода Bot API"""
+    
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        code = 'error'  # сетевая ошибка без ответа
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            return code, payload
+        finally:
+            metrics.histogram('telegram_api_duration_seconds', 'Время вызовов Bot API',
+                              method=api_method).observe(time.perf_counter() - started)
+            metrics.counter('telegram_api_responses_total', 'Ответы Bot API по кодам',
+                            method=api_method, code=str(code)).inc()
+
+# ========== КЭШ ==========
+_MISSING = object()
+
+class TTLCache:
+    """Кэш в памяти со временем жизни записей и счетчиками попаданий"""
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: Dict = {}
+    
+    def get(self, key):
+        """Значение из кэша или _MISSING (None - тоже допустимое значение)"""
+        entry = self._data.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return _MISSING
+    
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+    
+    def invalidate(self, key=_MISSING):
+        """Сброс одной записи или всего кэша"""
+        if key is _MISSING:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+    
+    def stats(self) -> Dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+class LRUCache:
+    """Кэш ограниченного размера: lru вытесняет давно читавшиеся записи, fifo - самые старые.
+    
+    Запись после чтения из базы передает generation, снятое до чтения:
+    если за время чтения был сброс, прочитанное могло устареть и не кэшируется.
+    """
+    
+    def __init__(self, maxsize: int, policy: str = "lru"):
+        if policy not in ("lru", "fifo"):
+            raise ValueError(f"Неизвестная политика вытеснения: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0  # растет при каждом сбросе
+        self._data: OrderedDict = OrderedDict()
+    
+    def get(self, key):
+        """Значение из кэша или _MISSING"""
+        if key not in self._data:
+            self.misses += 1
+            return _MISSING
+        self.hits += 1
+        if self.policy == "lru":
+            self._data.move_to_end(key)
+        return self._data[key]
+    
+    def set(self, key, value, generation: Optional[int] = None):
+        if generation is not None and generation != self.generation:
+            return
+        if key in self._data and self.policy == "lru":
+            self._data.move_to_end(key)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+    
+    def peek(self, key):
+        """Значение без учета в статистике и без изменения порядка"""
+        return self._data.get(key, _MISSING)
+    
+    def invalidate(self, key=_MISSING):
+        """Сброс одной записи или всего кэша"""
+        self.generation += 1
+        if key is _MISSING:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+    
+    def stats(self) -> Dict:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self._data)}
+
 # ========== БАЗА ДАННЫХ ==========
+# Результат изменяющего запроса: число строк, ID вставки и строки RETURNING
+WriteResult = namedtuple('WriteResult', ['rowcount', 'lastrowid', 'rows'])
+
 class Database:
-    def __init__(self, db_path: str = "scheduler.db"):
+    # Версионированные миграции схемы: номер версии = индекс + 1 (PRAGMA user_version)
+    MIGRATIONS = [
+        # 1: аренда постов воркерами публикации
+        [
+            'ALTER TABLE scheduled_posts ADD COLUMN worker_id TEXT',
+            'ALTER TABLE scheduled_posts ADD COLUMN lease_expires_at DATETIME',
+        ],
+        # 2: индексы под горячие запросы (см. check_query_plans)
+        [
+            "CREATE INDEX IF NOT EXISTS idx_posts_pending ON scheduled_posts (scheduled_time) WHERE status = 'pending'",
+            "CREATE INDEX IF NOT EXISTS idx_posts_lease ON scheduled_posts (lease_expires_at) WHERE status = 'in_flight'",
+            "CREATE INDEX IF NOT EXISTS idx_posts_worker ON scheduled_posts (worker_id) WHERE status = 'in_flight'",
+            'CREATE INDEX IF NOT EXISTS idx_user_channels_user ON user_channels (user_id, added_at)',
+            'CREATE INDEX IF NOT EXISTS idx_users_tariff ON users (tariff)',
+            'CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status, amount)',
+        ],
+        # 3: постраничный вывод пользователей по (registered_at, user_id)
+        [
+            'CREATE INDEX IF NOT EXISTS idx_users_registered ON users (registered_at, user_id)',
+        ],
+        # 4: счетчики статистики, которые ведут триггеры
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users BEGIN
+                INSERT INTO stats_counters (name, value) VALUES ('users', 1), ('tariff:' || NEW.tariff, 1)
+                ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users BEGIN
+                INSERT INTO stats_counters (name, value) VALUES ('users', -1), ('tariff:' || OLD.tariff, -1)
+                ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_users_tariff AFTER UPDATE OF tariff ON users
+            WHEN OLD.tariff IS NOT NEW.tariff BEGIN
+                INSERT INTO stats_counters (name, value) VALUES ('tariff:' || OLD.tariff, -1), ('tariff:' || NEW.tariff, 1)
+                ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_payments_insert AFTER INSERT ON payments
+            WHEN NEW.status = 'completed' BEGIN
+                INSERT INTO stats_counters (name, value) VALUES ('revenue', NEW.amount)
+                ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_payments_status AFTER UPDATE OF status, amount ON payments BEGIN
+                INSERT INTO stats_counters (name, value) VALUES ('revenue',
+                    (CASE WHEN NEW.status = 'completed' THEN NEW.amount ELSE 0 END) -
+                    (CASE WHEN OLD.status = 'completed' THEN OLD.amount ELSE 0 END))
+                ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_posts_done AFTER UPDATE OF status ON scheduled_posts
+            WHEN NEW.status IN ('published', 'failed') AND OLD.status IS NOT NEW.status BEGIN
+                INSERT INTO stats_counters (name, value) VALUES ('posts_' || NEW.status || ':' || date('now'), 1)
+                ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+            END
+            ''',
+            # Заполнение для существующей базы
+            "INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'users', COUNT(*) FROM users",
+            "INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'tariff:' || tariff, COUNT(*) FROM users GROUP BY tariff",
+            "INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'revenue', COALESCE(SUM(amount), 0) FROM payments WHERE status = 'completed'",
+        ],
+        # 5: почасовые и дневные агрегаты для трендов
+        [
+            'ALTER TABLE scheduled_posts ADD COLUMN finished_at DATETIME',
+            '''
+            CREATE TABLE IF NOT EXISTS stats_rollup (
+                period TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                channel_id TEXT NOT NULL DEFAULT '',
+                bucket TEXT NOT NULL,
+                value INTEGER NOT NULL,
+                PRIMARY KEY (period, metric, channel_id, bucket)
+            ) WITHOUT ROWID
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_rollup_bucket ON stats_rollup (period, bucket)',
+            'CREATE INDEX IF NOT EXISTS idx_payments_date ON payments (payment_date)',
+            'CREATE INDEX IF NOT EXISTS idx_posts_created ON scheduled_posts (created_at)',
+            'CREATE INDEX IF NOT EXISTS idx_posts_finished ON scheduled_posts (finished_at) WHERE finished_at IS NOT NULL',
+        ],
+        # 6: посты пользователя по дням для проверки лимитов массового импорта
+        [
+            'CREATE INDEX IF NOT EXISTS idx_posts_user_time ON scheduled_posts (user_id, scheduled_time)',
+        ],
+        # 7: повторяющиеся посты - правило хранится один раз, в scheduled_posts только ближайший выпуск
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS post_series (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                channel_id TEXT,
+                content_type TEXT,
+                content TEXT,
+                media_id TEXT,
+                rule TEXT NOT NULL,
+                start_time DATETIME NOT NULL,
+                next_time DATETIME NOT NULL,
+                remaining INTEGER,
+                status TEXT DEFAULT 'active',
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+            'ALTER TABLE scheduled_posts ADD COLUMN series_id INTEGER',
+            'CREATE INDEX IF NOT EXISTS idx_series_user ON post_series (user_id, status)',
+            'CREATE INDEX IF NOT EXISTS idx_series_status ON post_series (status)',
+            'CREATE INDEX IF NOT EXISTS idx_posts_series ON scheduled_posts (series_id, status) WHERE series_id IS NOT NULL',
+        ],
+        # 8: один пост в несколько каналов - основной канал в scheduled_posts, остальные здесь
+        [
+            'ALTER TABLE scheduled_posts ADD COLUMN fanout INTEGER DEFAULT 0',
+            '''
+            CREATE TABLE IF NOT EXISTS post_targets (
+                post_id INTEGER NOT NULL,
+                channel_id TEXT NOT NULL,
+                status TEXT DEFAULT 'pending',
+                PRIMARY KEY (post_id, channel_id)
+            ) WITHOUT ROWID
+            ''',
+        ],
+        # 9: права бота в каналах - потерянные каналы помечаются, их посты приостанавливаются
+        [
+            "ALTER TABLE user_channels ADD COLUMN status TEXT DEFAULT 'active'",
+            'ALTER TABLE user_channels ADD COLUMN checked_at DATETIME',
+            'CREATE INDEX IF NOT EXISTS idx_user_channels_channel ON user_channels (channel_id)',
+            'CREATE INDEX IF NOT EXISTS idx_posts_channel ON scheduled_posts (channel_id, status)',
+            'CREATE INDEX IF NOT EXISTS idx_targets_channel ON post_targets (channel_id, status)',
+        ],
+        # 10: повторы публикаций и недоставленные посты
+        [
+            'ALTER TABLE scheduled_posts ADD COLUMN attempts INTEGER DEFAULT 0',
+            'ALTER TABLE scheduled_posts ADD COLUMN next_attempt_at DATETIME',
+            'ALTER TABLE scheduled_posts ADD COLUMN last_error TEXT',
+            "CREATE INDEX IF NOT EXISTS idx_posts_retry ON scheduled_posts (next_attempt_at) WHERE status = 'retry'",
+            '''
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                post_id INTEGER NOT NULL,
+                channel_id TEXT,
+                error_class TEXT,
+                error TEXT,
+                attempts INTEGER,
+                failed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_dead_letters_failed ON dead_letters (failed_at)',
+        ],
+        # 11: копии постов в агрегатах и явная отметка последнего посчитанного часа
+        [
+            'ALTER TABLE post_targets ADD COLUMN finished_at DATETIME',
+            'CREATE INDEX IF NOT EXISTS idx_targets_finished ON post_targets (finished_at) WHERE finished_at IS NOT NULL',
+            '''
+            INSERT OR IGNORE INTO stats_counters (name, value)
+            SELECT 'rollup_watermark', CAST(strftime('%s', MAX(bucket)) AS INTEGER) FROM stats_rollup
+            WHERE period = 'hour' HAVING MAX(bucket) IS NOT NULL
+            ''',
+        ],
+        # 12: сообщение в основном канале поста с копиями и частичная публикация
+        [
+            'ALTER TABLE scheduled_posts ADD COLUMN message_id INTEGER',
+            'DROP TRIGGER IF EXISTS stats_posts_done',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_posts_done AFTER UPDATE OF status ON scheduled_posts
+            WHEN NEW.status IN ('published', 'failed', 'partial') AND OLD.status IS NOT NEW.status BEGIN
+                INSERT INTO stats_counters (name, value) VALUES ('posts_' || NEW.status || ':' || date('now'), 1)
+                ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+            END
+            ''',
+        ],
+    ]
+    
+    # Почасовые агрегаты окна [?, ?) из исходных таблиц (по индексам на время)
+    ROLLUP_HOURLY = [
+        '''
+            INSERT INTO stats_rollup (period, metric, channel_id, bucket, value)
+            SELECT 'hour', 'users', '', strftime('%Y-%m-%d %H:00', registered_at), COUNT(*)
+            FROM users WHERE registered_at >= ? AND registered_at < ? GROUP BY 4
+        ''',
+        '''
+            INSERT INTO stats_rollup (period, metric, channel_id, bucket, value)
+            SELECT 'hour', 'payments', '', strftime('%Y-%m-%d %H:00', payment_date), COUNT(*)
+            FROM payments WHERE payment_date >= ? AND payment_date < ? AND status = 'completed' GROUP BY 4
+        ''',
+        '''
+            INSERT INTO stats_rollup (period, metric, channel_id, bucket, value)
+            SELECT 'hour', 'revenue', '', strftime('%Y-%m-%d %H:00', payment_date), SUM(amount)
+            FROM payments WHERE payment_date >= ? AND payment_date < ? AND status = 'completed' GROUP BY 4
+        ''',
+        '''
+            INSERT INTO stats_rollup (period, metric, channel_id, bucket, value)
+            SELECT 'hour', 'scheduled', '', strftime('%Y-%m-%d %H:00', created_at), COUNT(*)
+            FROM scheduled_posts WHERE created_at >= ? AND created_at < ? GROUP BY 4
+        ''',
+        # У частично вышедшего поста итог основного канала - по сохраненному message_id
+        '''
+            INSERT INTO stats_rollup (period, metric, channel_id, bucket, value)
+            SELECT 'hour',
+                   CASE WHEN status != 'partial' THEN status WHEN message_id IS NULL THEN 'failed' ELSE 'published' END,
+                   channel_id, strftime('%Y-%m-%d %H:00', finished_at), COUNT(*)
+            FROM scheduled_posts
+            WHERE finished_at >= ? AND finished_at < ? AND status IN ('published', 'failed', 'partial')
+            GROUP BY 2, 3, 4
+        ''',
+        # Копии в дополнительные каналы складываются с постами того же канала
+        '''
+            INSERT INTO stats_rollup (period, metric, channel_id, bucket, value)
+            SELECT 'hour', status, channel_id, strftime('%Y-%m-%d %H:00', finished_at), COUNT(*)
+            FROM post_targets
+            WHERE finished_at >= ? AND finished_at < ? AND status IN ('published', 'failed')
+            GROUP BY 2, 3, 4
+            ON CONFLICT (period, metric, channel_id, bucket) DO UPDATE SET value = value + excluded.value
+        ''',
+    ]
+    
+    # Пересчет счетчиков из исходных таблиц (каждый запрос атомарен)
+    STATS_RECOMPUTE = [
+        "INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'users', COUNT(*) FROM users",
+        '''
+            UPDATE stats_counters SET value = 0
+            WHERE name >= 'tariff:' AND name < 'tariff;'
+              AND substr(name, 8) NOT IN (SELECT tariff FROM users WHERE tariff IS NOT NULL)
+        ''',
+        "INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'tariff:' || tariff, COUNT(*) FROM users GROUP BY tariff",
+        "INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'revenue', COALESCE(SUM(amount), 0) FROM payments WHERE status = 'completed'",
+    ]
+    
+    # PRAGMA для всех соединений; journal_mode и synchronous - только для писателя
+    PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY',
+        'mmap_size': DB_MMAP_SIZE,
+        'cache_size': DB_CACHE_SIZE,
+    }
+    WRITER_ONLY_PRAGMAS = ('journal_mode', 'synchronous')
+    
+    def __init__(self, db_path: str = DB_PATH, read_pool_size: int = DB_READ_POOL_SIZE,
+                 pragmas: Optional[Dict] = None, group_commit: bool = DB_GROUP_COMMIT,
+                 group_commit_delay: float = DB_GROUP_COMMIT_DELAY,
+                 group_commit_max: int = DB_GROUP_COMMIT_MAX,
+                 user_cache_size: int = USER_CACHE_SIZE, user_cache_policy: str = USER_CACHE_POLICY):
         self.db_path = db_path
         self.connection = None
-        
+        self.group_commit = group_commit
+        self.group_commit_delay = group_commit_delay
+        self.group_commit_max = group_commit_max
+        self.writes = 0
+        self.commits = 0
+        # Тарифы и приватные каналы меняет только админ - держим их в памяти
+        self.settings_cache = TTLCache(SETTINGS_CACHE_TTL)
+        # Строка пользователя (со счетчиком постов) и его каналы; сбрасываются при записи
+        self.user_cache = LRUCache(user_cache_size, user_cache_policy)
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._flusher: Optional[asyncio.Task] = None
+        # Писатель один на всех: транзакции конкурентных обработчиков не должны чередоваться
+        self._write_lock = asyncio.Lock()
+        self.pragmas = {**self.PRAGMAS, **(pragmas or {})}
+        # База в памяти не видна другим соединениям - читаем через писателя
+        self.read_pool_size = 0 if db_path == ":memory:" else read_pool_size
+        self._readers: Optional[asyncio.Queue] = None
+        self._reader_connections: List[aiosqlite.Connection] = []
+        self._readers_lock = asyncio.Lock()
+    
+    @property
+    def write_depth(self) -> int:
+        """Записи, ждущие группового коммита"""
+        return self._write_queue.qsize() if self._write_queue is not None else 0
+    
     async def connect(self):
-        """Устанавливаем соединение с базой данных"""
+        """Устанавливаем соединение с базой данных (единственный писатель)"""
         if self.connection is None:
             self.connection = await aiosqlite.connect(self.db_path)
             self.connection.row_factory = aiosqlite.Row
+            await self._apply_pragmas(self.connection, writer=True)
         return self.connection
     
+    async def _apply_pragmas(self, conn: aiosqlite.Connection, writer: bool):
+        for name, value in self.pragmas.items():
+            if value is None or (not writer and name in self.WRITER_ONLY_PRAGMAS):
+                continue
+            await conn.execute(f'PRAGMA {name} = {value}')
+    
+    async def _open_readers(self):
+        async with self._readers_lock:
+            if self._readers is not None:
+                return
+            await self.connect()
+            readers = asyncio.Queue()
+            for _ in range(self.read_pool_size):
+                conn = await aiosqlite.connect(f"file:{self.db_path}?mode=ro", uri=True)
+                conn.row_factory = aiosqlite.Row
+                await self._apply_pragmas(conn, writer=False)
+                self._reader_connections.append(conn)
+                readers.put_nowait(conn)
+            self._readers = readers
+    
+    async def _write(self, sql: str, params: tuple = (), fetch: bool = False) -> WriteResult:
+        """Изменяющий запрос через писателя.
+        
+        sql может быть списком пар (sql, params) - они выполняются атомарно,
+        lastrowid берется у последнего оператора, если он изменил строки.
+        Если операторы зависят от результатов друг друга (id вставленной
+        строки), sql - корутинная функция от соединения, возвращающая
+        WriteResult; она тоже выполняется атомарно.
+        Записи на соединении писателя идут строго по одной (_write_lock),
+        иначе чужой коммит мог бы разорвать список посередине.
+        При group_commit запрос попадает в очередь, и фоновая задача
+        объединяет запросы конкурентных обработчиков в одну транзакцию
+        (раз в group_commit_delay секунд или по group_commit_max операторов).
+        Вызов завершается после коммита транзакции со своим запросом.
+        """
+        if not self.group_commit:
+            conn = await self.connect()
+            async with self._write_lock:
+                try:
+                    result = await self._execute_write(conn, sql, params, fetch)
+                except Exception:
+                    await conn.rollback()
+                    raise
+                await conn.commit()
+            self.commits += 1
+            return result
+        
+        if self._flusher is None:
+            self._write_queue = asyncio.Queue()
+            self._flusher = asyncio.create_task(self._flush_writes())
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((sql, params, fetch, future))
+        return await future
+    
+    async def _execute_write(self, conn: aiosqlite.Connection, sql, params: tuple, fetch: bool) -> WriteResult:
+        self.writes += 1
+        if isinstance(sql, list) or callable(sql):
+            # Несколько операторов выполняются атомарно: ошибка откатывает их все
+            await conn.execute('SAVEPOINT statements')
+            try:
+                result = await (sql(conn) if callable(sql) else self._execute_statements(conn, sql))
+            except Exception:
+                await conn.execute('ROLLBACK TO statements')
+                await conn.execute('RELEASE statements')
+                raise
+            await conn.execute('RELEASE statements')
+            return result
+        if fetch:
+            # execute_fetchall выбирает RETURNING за один вызов, иначе чужой
+            # commit между execute и fetchall упадет на незавершенном операторе
+            rows = list(await conn.execute_fetchall(sql, params))
+            return WriteResult(len(rows), None, rows)
+        cursor = await conn.execute(sql, params)
+        result = WriteResult(cursor.rowcount, cursor.lastrowid, None)
+        await cursor.close()
+        return result
+    
+    async def _execute_statements(self, conn: aiosqlite.Connection, statements: List[Tuple]) -> WriteResult:
+        rowcount, lastrowid = 0, None
+        for statement, statement_params in statements:
+            # Список кортежей параметров - один executemany
+            if isinstance(statement_params, list):
+                cursor = await conn.executemany(statement, statement_params)
+            else:
+                cursor = await conn.execute(statement, statement_params)
+            rowcount += max(cursor.rowcount, 0)
+            lastrowid = cursor.lastrowid if cursor.rowcount > 0 else None
+            await cursor.close()
+        return WriteResult(rowcount, lastrowid, None)
+    
+    async def _flush_writes(self):
+        while True:
+            batch = [await self._write_queue.get()]
+            if self._write_queue.qsize() < self.group_commit_max:
+                await asyncio.sleep(self.group_commit_delay)
+            while len(batch) < self.group_commit_max and not self._write_queue.empty():
+                batch.append(self._write_queue.get_nowait())
+            try:
+                await self._commit_batch(batch)
+            except Exception as e:
+                # Задача не должна падать: иначе следующие _write ждали бы свои future вечно
+                logger.error(f"Ошибка группового коммита: {e}")
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                for _ in batch:
+                    self._write_queue.task_done()
+    
+    async def _commit_batch(self, batch: List[Tuple]):
+        """Одна транзакция на пачку; ошибка оператора откатывает только его"""
+        conn = await self.connect()
+        await self._write_lock.acquire()
+        results = []
+        try:
+            if conn.in_transaction:
+                # Транзакция осталась открытой после неудачного отката прошлой пачки
+                await conn.rollback()
+            await conn.execute('BEGIN IMMEDIATE')
+            for sql, params, fetch, _ in batch:
+                await conn.execute('SAVEPOINT write')
+                try:
+                    results.append(await self._execute_write(conn, sql, params, fetch))
+                except Exception as e:
+                    await conn.execute('ROLLBACK TO write')
+                    results.append(e)
+                await conn.execute('RELEASE write')
+            await conn.commit()
+            self.commits += 1
+        except Exception as e:
+            logger.error(f"Ошибка группового коммита: {e}")
+            try:
+                await conn.rollback()
+            except Exception as rollback_error:
+                logger.error(f"Ошибка отката группового коммита: {rollback_error}")
+            results = [e] * len(batch)
+        finally:
+            self._write_lock.release()
+        
+        for (_, _, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+    
+    @asynccontextmanager
+    async def reader(self):
+        """Соединение только для чтения из пула.
+        
+        В режиме WAL читатели не ждут коммитов писателя, поэтому
+        запросы /channels и /tariffs не стоят в очереди за публикацией.
+        """
+        if not self.read_pool_size:
+            yield await self.connect()
+            return
+        if self._readers is None:
+            await self._open_readers()
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+    
     async def init_db(self):
         """Инициализация базы данных"""
         conn = await self.connect()
@@ -146,196 +961,835 @@ class Database:
         ''')
         
         await conn.commit()
+        await self.migrate()
         logger.info("База данных инициализирована")
     
+    async def migrate(self):
+        """Применение недостающих миграций схемы"""
+        conn = await self.connect()
+        async with conn.execute('PRAGMA user_version') as cursor:
+            version = (await cursor.fetchone())[0]
+        
+        for number, statements in enumerate(self.MIGRATIONS[version:], version + 1):
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute(f'PRAGMA user_version = {number}')
+            await conn.commit()
+            logger.info(f"Применена миграция базы данных {number}")
+    
     async def close(self):
-        """Закрываем соединение"""
+        """Закрываем соединения"""
+        if self._flusher:
+            await self._write_queue.join()
+            self._flusher.cancel()
+            self._flusher = None
+        for conn in self._reader_connections:
+            await conn.close()
+        self._reader_connections = []
+        self._readers = None
         if self.connection:
             await self.connection.close()
+            self.connection = None
     
     # ========== ПОЛЬЗОВАТЕЛИ ==========
     async def add_user(self, user_id: int, username: str, first_name: str, last_name: str = ""):
         """Добавление пользователя"""
-        conn = await self.connect()
-        await conn.execute('''
+        await self._write('''
             INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
             VALUES (?, ?, ?, ?)
         ''', (user_id, username, first_name, last_name))
-        await conn.commit()
     
     async def get_user(self, user_id: int) -> Optional[Dict]:
         """Получение информации о пользователе"""
-        conn = await self.connect()
-        async with conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return dict(row) if row else None
+        user = self.user_cache.get(('user', user_id))
+        if user is _MISSING:
+            generation = self.user_cache.generation
+            async with self.reader() as conn:
+                async with conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)) as cursor:
+                    row = await cursor.fetchone()
+            if not row:
+                return None
+            user = dict(row)
+            self.user_cache.set(('user', user_id), user, generation)
+        return dict(user)
     
     async def update_user_tariff(self, user_id: int, tariff: str, duration_days: int = 30):
         """Обновление тарифа пользователя"""
         subscription_end = datetime.now() + timedelta(days=duration_days)
-        conn = await self.connect()
-        await conn.execute('''
+        await self._write('''
             UPDATE users 
             SET tariff = ?, subscription_end = ?
             WHERE user_id = ?
         ''', (tariff, subscription_end.isoformat(), user_id))
-        await conn.commit()
+        # Сброс, а не правка на месте: параллельное чтение могло еще не положить строку в кэш
+        self.user_cache.invalidate(('user', user_id))
+    
+    async def increment_posts_today(self, user_id: int, count: int = 1):
+        """Увеличение счетчика постов за сегодня"""
+        today = datetime.now().date().isoformat()
+        await self._write('''
+            UPDATE users 
+            SET posts_today = CASE 
+                WHEN last_post_date = date(?) THEN posts_today + ? 
+                ELSE ? 
+            END,
+            last_post_date = date(?)
+            WHERE user_id = ?
+        ''', (today, count, count, today, user_id))
+        self.user_cache.invalidate(('user', user_id))
     
     # ========== КАНАЛЫ ==========
     async def add_user_channel(self, user_id: int, channel_id: str, channel_name: str) -> Tuple[bool, str]:
         """Добавление канала пользователя"""
-        conn = await self.connect()
-        
         # Проверяем лимит каналов
         user = await self.get_user(user_id)
         tariff = await self.get_tariff_info(user['tariff'])
         
-        async with conn.execute('SELECT COUNT(*) FROM user_channels WHERE user_id = ?', (user_id,)) as cursor:
-            count = (await cursor.fetchone())[0]
-            
+        count = len(await self.get_user_channels(user_id))
+        
         if count >= tariff['channels_limit']:
             return False, f"Лимит каналов ({tariff['channels_limit']}) достигнут"
         
         try:
-            await conn.execute('''
+            await self._write('''
                 INSERT INTO user_channels (user_id, channel_id, channel_name)
                 VALUES (?, ?, ?)
             ''', (user_id, channel_id, channel_name))
-            await conn.commit()
-            return True, "Канал успешно добавлен"
         except aiosqlite.IntegrityError:
             return False, "Этот канал уже добавлен"
+        
+        self.user_cache.invalidate(('channels', user_id))
+        return True, "Канал успешно добавлен"
     
     async def get_user_channels(self, user_id: int) -> List[Dict]:
         """Получение каналов пользователя"""
-        conn = await self.connect()
-        async with conn.execute(
-            'SELECT * FROM user_channels WHERE user_id = ? ORDER BY added_at DESC', 
-            (user_id,)
-        ) as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+        channels = self.user_cache.get(('channels', user_id))
+        if channels is _MISSING:
+            generation = self.user_cache.generation
+            async with self.reader() as conn:
+                async with conn.execute(
+                    'SELECT * FROM user_channels WHERE user_id = ? ORDER BY added_at DESC', 
+                    (user_id,)
+                ) as cursor:
+                    channels = [dict(row) for row in await cursor.fetchall()]
+            self.user_cache.set(('channels', user_id), channels, generation)
+        return [dict(channel) for channel in channels]
+    
+    async def get_channels_batch(self, after_id: int = 0, limit: int = ADMIN_CHECK_BATCH) -> List[Dict]:
+        """Пачка каналов всех пользователей по возрастанию id (для фоновой проверки прав)"""
+        async with self.reader() as conn:
+            async with conn.execute('''
+                SELECT id, user_id, channel_id, channel_name, status FROM user_channels
+                WHERE id > ? ORDER BY id LIMIT ?
+            ''', (after_id, limit)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+    
+    async def mark_channels_checked(self, channel_ids: List[str]):
+        """Время последней проверки прав"""
+        if channel_ids:
+            await self._write([(
+                'UPDATE user_channels SET checked_at = CURRENT_TIMESTAMP WHERE channel_id = ?',
+                [(channel_id,) for channel_id in channel_ids]
+            )])
+    
+    async def set_channel_status(self, channel_id: str, status: str) -> List[int]:
+        """'lost' приостанавливает ожидающие посты канала, 'active' возобновляет их.
+        
+        Посты, которые опоздали больше чем на CHANNEL_RESUME_GRACE секунд,
+        не возобновляются, а помечаются failed с записью в dead_letters.
+        Пост с копиями, который ждал этот канал в статусе paused, снова
+        становится pending и досылает копии (см. PublishPipeline).
+        Возвращает владельцев канала.
+        """
+        statements = [
+            ('UPDATE user_channels SET status = ?, checked_at = CURRENT_TIMESTAMP WHERE channel_id = ?',
+             (status, channel_id)),
+        ]
+        if status == 'lost':
+            # Посты, ждущие повтора, тоже приостанавливаются; возобновляются они как pending
+            statements += [
+                ("UPDATE scheduled_posts SET status = 'paused' WHERE channel_id = ? AND status IN ('pending', 'retry')",
+                 (channel_id,)),
+                ("UPDATE post_targets SET status = 'paused' WHERE channel_id = ? AND status = 'pending'",
+                 (channel_id,)),
+            ]
+        else:
+            cutoff = (datetime.now() - timedelta(seconds=CHANNEL_RESUME_GRACE)).isoformat()
+            statements += [
+                ('''
+                    INSERT INTO dead_letters (post_id, channel_id, error_class, error, attempts)
+                    SELECT id, channel_id, 'expired', 'канал был недоступен до наступления времени публикации', attempts
+                    FROM scheduled_posts
+                    WHERE channel_id = ? AND status = 'paused' AND scheduled_time < ? AND message_id IS NULL
+                ''', (channel_id, cutoff)),
+                # Пост, уже вышедший в основном канале (message_id), не просрочен - он ждет копий
+                ('''
+                    UPDATE scheduled_posts
+                    SET status = 'failed', finished_at = CURRENT_TIMESTAMP, last_error = 'expired'
+                    WHERE channel_id = ? AND status = 'paused' AND scheduled_time < ? AND message_id IS NULL
+                ''', (channel_id, cutoff)),
+                ("UPDATE scheduled_posts SET status = 'pending' WHERE channel_id = ? AND status = 'paused'",
+                 (channel_id,)),
+                # Копии давно вышедших постов тоже не догоняем
+                ('''
+                    UPDATE post_targets SET status = CASE
+                        WHEN (SELECT scheduled_time FROM scheduled_posts WHERE id = post_id) < ? THEN 'failed'
+                        ELSE 'pending'
+                    END
+                    WHERE channel_id = ? AND status = 'paused'
+                ''', (cutoff, channel_id)),
+                ('''
+                    UPDATE post_targets SET finished_at = CURRENT_TIMESTAMP
+                    WHERE channel_id = ? AND status = 'failed' AND finished_at IS NULL
+                ''', (channel_id,)),
+                # Посты, ждавшие копию в этот канал; с неотправленным основным сообщением -
+                # только если их собственный канал не потерян
+                ('''
+                    UPDATE scheduled_posts SET status = 'pending'
+                    WHERE status = 'paused'
+                      AND id IN (SELECT post_id FROM post_targets WHERE channel_id = ?)
+                      AND (message_id IS NOT NULL OR NOT EXISTS (
+                          SELECT 1 FROM user_channels c
+                          WHERE c.channel_id = scheduled_posts.channel_id AND c.status = 'lost'
+                      ))
+                ''', (channel_id,)),
+            ]
+        await self._write(statements)
+        async with self.reader() as conn:
+            async with conn.execute('SELECT user_id FROM user_channels WHERE channel_id = ?', (channel_id,)) as cursor:
+                owners = [row[0] for row in await cursor.fetchall()]
+        for user_id in owners:
+            self.user_cache.invalidate(('channels', user_id))
+        return owners
     
     # ========== ТАРИФЫ ==========
     async def get_tariff_info(self, tariff_name: str) -> Dict:
         """Получение информации о тарифе"""
-        conn = await self.connect()
-        async with conn.execute(
-            'SELECT * FROM tariff_settings WHERE tariff_name = ?', 
-            (tariff_name,)
-        ) as cursor:
-            row = await cursor.fetchone()
+        tariff = self.settings_cache.get(('tariff', tariff_name))
+        if tariff is _MISSING:
+            async with self.reader() as conn:
+                async with conn.execute(
+                    'SELECT * FROM tariff_settings WHERE tariff_name = ?', 
+                    (tariff_name,)
+                ) as cursor:
+                    row = await cursor.fetchone()
             if row:
-                return dict(row)
-            # Возвращаем тариф free по умолчанию
-            return {
-                'tariff_name': 'free',
-                'price': 0,
-                'channels_limit': 1,
-                'posts_per_day': 1,
-                'duration_days': 0
-            }
+                tariff = dict(row)
+            else:
+                # Возвращаем тариф free по умолчанию
+                tariff = {
+                    'tariff_name': 'free',
+                    'price': 0,
+                    'channels_limit': 1,
+                    'posts_per_day': 1,
+                    'duration_days': 0
+                }
+            self.settings_cache.set(('tariff', tariff_name), tariff)
+        return dict(tariff)
     
     async def update_tariff_price(self, tariff_name: str, price: int) -> bool:
         """Обновление цены тарифа"""
-        conn = await self.connect()
-        cursor = await conn.execute(
+        result = await self._write(
             'UPDATE tariff_settings SET price = ? WHERE tariff_name = ?',
             (price, tariff_name)
         )
-        await conn.commit()
-        return cursor.rowcount > 0
+        self.settings_cache.invalidate(('tariff', tariff_name))
+        return result.rowcount > 0
     
     async def set_private_channel(self, tariff_name: str, channel_id: str, invite_link: str):
         """Настройка приватного канала"""
-        conn = await self.connect()
-        await conn.execute('''
+        await self._write('''
             INSERT OR REPLACE INTO private_channels (tariff_name, channel_id, invite_link)
             VALUES (?, ?, ?)
         ''', (tariff_name, channel_id, invite_link))
-        await conn.commit()
+        self.settings_cache.invalidate(('private_channel', tariff_name))
     
     async def get_private_channel(self, tariff_name: str) -> Optional[Dict]:
         """Получение приватного канала"""
-        conn = await self.connect()
-        async with conn.execute(
-            'SELECT * FROM private_channels WHERE tariff_name = ?',
-            (tariff_name,)
-        ) as cursor:
-            row = await cursor.fetchone()
-            return dict(row) if row else None
+        channel = self.settings_cache.get(('private_channel', tariff_name))
+        if channel is _MISSING:
+            async with self.reader() as conn:
+                async with conn.execute(
+                    'SELECT * FROM private_channels WHERE tariff_name = ?',
+                    (tariff_name,)
+                ) as cursor:
+                    row = await cursor.fetchone()
+            channel = dict(row) if row else None
+            self.settings_cache.set(('private_channel', tariff_name), channel)
+        return dict(channel) if channel else None
     
     # ========== ПОСТЫ ==========
     async def add_scheduled_post(self, user_id: int, channel_id: str, content_type: str,
                                 content: str, media_id: str, scheduled_time: datetime) -> int:
         """Добавление запланированного поста"""
-        conn = await self.connect()
-        cursor = await conn.execute('''
+        result = await self._write('''
             INSERT INTO scheduled_posts 
             (user_id, channel_id, content_type, content, media_id, scheduled_time)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (user_id, channel_id, content_type, content, media_id, scheduled_time.isoformat()))
-        await conn.commit()
-        return cursor.lastrowid
+        return result.lastrowid
     
-    async def get_pending_posts(self) -> List[Dict]:
-        """Получение ожидающих публикаций"""
-        conn = await self.connect()
-        async with conn.execute('''
-            SELECT * FROM scheduled_posts 
-            WHERE status = 'pending' AND scheduled_time <= datetime('now', '+5 minutes')
-            ORDER BY scheduled_time
-        ''') as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
-    
-    async def update_post_status(self, post_id: int, status: str):
-        """Обновление статуса поста"""
-        conn = await self.connect()
-        await conn.execute(
-            'UPDATE scheduled_posts SET status = ? WHERE id = ?',
-            (status, post_id)
-        )
-        await conn.commit()
+    async def add_scheduled_posts(self, user_id: int, posts: List[Dict]) -> int:
+        """Массовое добавление постов одним executemany в одной транзакции"""
+        result = await self._write([('''
+            INSERT INTO scheduled_posts 
+            (user_id, channel_id, content_type, content, media_id, scheduled_time)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(user_id, post['channel_id'], post['content_type'], post['text'], post['media_id'],
+               post['scheduled_time'].isoformat()) for post in posts])])
+        return result.rowcount
+    
+    async def count_posts_by_day(self, user_id: int, first_day: datetime, last_day: datetime) -> Dict[str, int]:
+        """Число неотмененных постов пользователя по дням публикации: 'ГГГГ-ММ-ДД' -> количество"""
+        start = first_day.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = last_day.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        async with self.reader() as conn:
+            async with conn.execute('''
+                SELECT substr(scheduled_time, 1, 10), COUNT(*) FROM scheduled_posts
+                WHERE user_id = ? AND scheduled_time >= ? AND scheduled_time < ?
+                  AND status IN ('pending', 'in_flight', 'retry', 'paused', 'published', 'partial')
+                GROUP BY 1
+            ''', (user_id, start.isoformat(), end.isoformat())) as cursor:
+                return {row[0]: row[1] for row in await cursor.fetchall()}
+    
+    async def add_fanout_post(self, user_id: int, channel_ids: List[str], content_type: str,
+                              content: str, media_id: str, scheduled_time: datetime) -> int:
+        """Пост в несколько каналов: строка для первого канала и цели для остальных"""
+        async def insert(conn: aiosqlite.Connection) -> WriteResult:
+            # id поста берем у курсора, а не у last_insert_rowid() соединения
+            cursor = await conn.execute('''
+                INSERT INTO scheduled_posts 
+                (user_id, channel_id, content_type, content, media_id, scheduled_time, fanout)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, channel_ids[0], content_type, content, media_id,
+                  scheduled_time.isoformat(), len(channel_ids) - 1))
+            post_id = cursor.lastrowid
+            await cursor.close()
+            await conn.executemany('INSERT INTO post_targets (post_id, channel_id) VALUES (?, ?)',
+                                   [(post_id, channel_id) for channel_id in channel_ids[1:]])
+            return WriteResult(len(channel_ids), post_id, None)
+        
+        result = await self._write(insert)
+        return result.lastrowid
+    
+    async def get_pending_targets(self, post_id: int) -> List[str]:
+        """Каналы поста, куда копия еще не отправлена"""
+        async with self.reader() as conn:
+            async with conn.execute(
+                "SELECT channel_id FROM post_targets WHERE post_id = ? AND status = 'pending'", (post_id,)
+            ) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+    
+    async def get_target_statuses(self, post_id: int) -> List[str]:
+        """Статусы всех копий поста"""
+        async with self.reader() as conn:
+            async with conn.execute('SELECT status FROM post_targets WHERE post_id = ?', (post_id,)) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+    
+    async def update_target_status(self, post_id: int, channel_id: str, status: str):
+        """Статус копии поста в дополнительном канале"""
+        # finished_at - время завершения для почасовых агрегатов
+        await self._write('''
+            UPDATE post_targets
+            SET status = ?, finished_at = CASE WHEN ? IN ('published', 'failed') THEN CURRENT_TIMESTAMP END
+            WHERE post_id = ? AND channel_id = ?
+        ''', (status, status, post_id, channel_id))
+    
+    async def get_pending_posts(self, until: datetime) -> List[Dict]:
+        """Получение ожидающих публикаций и повторов до указанного момента"""
+        async with self.reader() as conn:
+            async with conn.execute('''
+                SELECT id, scheduled_time FROM scheduled_posts 
+                WHERE status = 'pending' AND scheduled_time <= ?
+                UNION ALL
+                SELECT id, next_attempt_at FROM scheduled_posts 
+                WHERE status = 'retry' AND next_attempt_at <= ?
+                ORDER BY 2
+            ''', (until.isoformat(), until.isoformat())) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+    
+    async def claim_posts(self, post_ids: List[int], worker_id: str, lease_until: datetime) -> List[Dict]:
+        """Атомарный захват ожидающих постов воркером"""
+        if not post_ids:
+            return []
+        placeholders = ", ".join("?" for _ in post_ids)
+        result = await self._write(f'''
+            UPDATE scheduled_posts 
+            SET status = 'in_flight', worker_id = ?, lease_expires_at = ?
+            WHERE id IN ({placeholders}) AND status IN ('pending', 'retry')
+            RETURNING *
+        ''', (worker_id, lease_until.isoformat(), *post_ids), fetch=True)
+        return sorted((dict(row) for row in result.rows), key=lambda post: post['scheduled_time'])
+    
+    async def claim_due_posts(self, worker_id: str, lease_until: datetime, limit: int = 500) -> List[Dict]:
+        """Атомарный захват просроченных постов, наступивших повторов и постов с истекшей арендой"""
+        now = datetime.now().isoformat()
+        result = await self._write('''
+            UPDATE scheduled_posts 
+            SET status = 'in_flight', worker_id = ?, lease_expires_at = ?
+            WHERE id IN (
+                SELECT id FROM scheduled_posts 
+                WHERE status = 'pending' AND scheduled_time <= ?
+                UNION ALL
+                SELECT id FROM scheduled_posts 
+                WHERE status = 'retry' AND next_attempt_at <= ?
+                UNION ALL
+                SELECT id FROM scheduled_posts 
+                WHERE status = 'in_flight' AND lease_expires_at <= ?
+                LIMIT ?
+            )
+            RETURNING *
+        ''', (worker_id, lease_until.isoformat(), now, now, now, limit), fetch=True)
+        return sorted((dict(row) for row in result.rows), key=lambda post: post['scheduled_time'])
+    
+    async def renew_leases(self, worker_id: str, lease_until: datetime) -> int:
+        """Продление аренды всех постов воркера"""
+        result = await self._write('''
+            UPDATE scheduled_posts SET lease_expires_at = ?
+            WHERE status = 'in_flight' AND worker_id = ?
+        ''', (lease_until.isoformat(), worker_id))
+        return result.rowcount
+    
+    async def update_post_status(self, post_id: int, status: str, worker_id: Optional[str] = None) -> bool:
+        """Обновление статуса поста (с worker_id - только если аренда еще у воркера)"""
+        # finished_at - время завершения для почасовых агрегатов
+        finished = "CASE WHEN ? IN ('published', 'failed', 'partial') THEN CURRENT_TIMESTAMP END"
+        if worker_id is None:
+            result = await self._write(
+                f'UPDATE scheduled_posts SET status = ?, finished_at = {finished} WHERE id = ?',
+                (status, status, post_id)
+            )
+        else:
+            result = await self._write(f'''
+                UPDATE scheduled_posts SET status = ?, finished_at = {finished}, lease_expires_at = NULL
+                WHERE id = ? AND status = 'in_flight' AND worker_id = ?
+            ''', (status, status, post_id, worker_id))
+        return result.rowcount > 0
+    
+    async def set_post_message(self, post_id: int, message_id: int):
+        """Сообщение поста с копиями в основном канале: после перезапуска основной канал не отправляется снова"""
+        await self._write('UPDATE scheduled_posts SET message_id = ? WHERE id = ?', (message_id, post_id))
+    
+    async def schedule_retry(self, post_id: int, next_attempt_at: datetime, error: str,
+                             worker_id: Optional[str] = None, count_attempt: bool = True) -> bool:
+        """Возврат поста в очередь с повтором в next_attempt_at (с worker_id - только если аренда у воркера)"""
+        owner = ' AND status = \'in_flight\' AND worker_id = ?' if worker_id is not None else ''
+        result = await self._write(f'''
+            UPDATE scheduled_posts
+            SET status = 'retry', attempts = attempts + ?, next_attempt_at = ?, last_error = ?,
+                worker_id = NULL, lease_expires_at = NULL
+            WHERE id = ?{owner}
+        ''', (int(count_attempt), next_attempt_at.isoformat(), error[:500], post_id,
+              *(() if worker_id is None else (worker_id,))))
+        return result.rowcount > 0
+    
+    async def add_dead_letter(self, post_id: int, channel_id: str, error_class: str, error: str, attempts: int):
+        """Запись о посте (или копии в канал), который не удалось доставить"""
+        await self._write('''
+            INSERT INTO dead_letters (post_id, channel_id, error_class, error, attempts)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (post_id, channel_id, error_class, error[:500], attempts))
+    
+    async def get_dead_letters(self, limit: int = 20) -> List[Dict]:
+        """Последние недоставленные посты"""
+        async with self.reader() as conn:
+            async with conn.execute(
+                'SELECT * FROM dead_letters ORDER BY failed_at DESC LIMIT ?', (limit,)
+            ) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+    
+    # ========== СЕРИИ ПОСТОВ ==========
+    async def add_post_series(self, user_id: int, channel_id: str, content_type: str, content: str,
+                              media_id: str, rule: str, start_time: datetime,
+                              count: Optional[int] = None) -> int:
+        """Создание серии вместе с первым выпуском, возвращает id поста"""
+        async def insert(conn: aiosqlite.Connection) -> WriteResult:
+            cursor = await conn.execute('''
+                INSERT INTO post_series
+                (user_id, channel_id, content_type, content, media_id, rule, start_time, next_time, remaining)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, channel_id, content_type, content, media_id, rule,
+                  start_time.isoformat(), start_time.isoformat(), None if count is None else count - 1))
+            series_id = cursor.lastrowid
+            await cursor.close()
+            return await self._insert_series_issue(conn, series_id)
+        
+        result = await self._write(insert)
+        return result.lastrowid
+    
+    async def _insert_series_issue(self, conn: aiosqlite.Connection, series_id: int) -> WriteResult:
+        """Выпуск серии на ее next_time (внутри транзакции записи)"""
+        cursor = await conn.execute('''
+            INSERT INTO scheduled_posts
+            (user_id, channel_id, content_type, content, media_id, scheduled_time, series_id)
+            SELECT user_id, channel_id, content_type, content, media_id, next_time, id
+            FROM post_series WHERE id = ?
+        ''', (series_id,))
+        result = WriteResult(cursor.rowcount, cursor.lastrowid, None)
+        await cursor.close()
+        return result
+    
+    async def get_series(self, series_id: int) -> Optional[Dict]:
+        """Серия по id"""
+        async with self.reader() as conn:
+            async with conn.execute('SELECT * FROM post_series WHERE id = ?', (series_id,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+    
+    async def get_user_series(self, user_id: int) -> List[Dict]:
+        """Активные серии пользователя"""
+        async with self.reader() as conn:
+            async with conn.execute('''
+                SELECT * FROM post_series WHERE user_id = ? AND status = 'active' ORDER BY id
+            ''', (user_id,)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+    
+    async def get_stalled_series(self, limit: int = 500) -> List[int]:
+        """Активные серии без ожидающего выпуска (процесс упал между публикацией и продлением)"""
+        async with self.reader() as conn:
+            async with conn.execute('''
+                SELECT id FROM post_series s
+                WHERE status = 'active' AND NOT EXISTS (
+                    SELECT 1 FROM scheduled_posts p
+                    WHERE p.series_id = s.id AND p.status IN ('pending', 'in_flight', 'retry', 'paused')
+                )
+                LIMIT ?
+            ''', (limit,)) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+    
+    async def advance_series(self, series_id: int, current_time: str, next_time: datetime) -> Optional[int]:
+        """Следующий выпуск серии, если next_time серии еще равен current_time.
+        
+        Сравнение с current_time не дает двум воркерам создать один выпуск дважды.
+        Возвращает id нового поста или None.
+        """
+        async def advance(conn: aiosqlite.Connection) -> WriteResult:
+            cursor = await conn.execute('''
+                UPDATE post_series
+                SET next_time = ?, remaining = remaining - 1
+                WHERE id = ? AND next_time = ? AND status = 'active'
+                  AND (remaining IS NULL OR remaining > 0)
+            ''', (next_time.isoformat(), series_id, current_time))
+            advanced = cursor.rowcount > 0
+            await cursor.close()
+            # Выпуск создает только тот, чье обновление прошло
+            return await self._insert_series_issue(conn, series_id) if advanced else WriteResult(0, None, None)
+        
+        result = await self._write(advance)
+        return result.lastrowid
+    
+    async def skip_series_issue(self, series_id: int, current_time: str, next_time: datetime) -> bool:
+        """Пропуск выпуска next_time без поста (лимит тарифа); remaining не уменьшается"""
+        result = await self._write('''
+            UPDATE post_series SET next_time = ?
+            WHERE id = ? AND next_time = ? AND status = 'active'
+        ''', (next_time.isoformat(), series_id, current_time))
+        return result.rowcount > 0
+    
+    async def finish_series(self, series_id: int):
+        """Серия исчерпана (COUNT или UNTIL)"""
+        await self._write("UPDATE post_series SET status = 'finished' WHERE id = ? AND status = 'active'", (series_id,))
+    
+    async def stop_series(self, series_id: int, user_id: int) -> bool:
+        """Остановка серии владельцем вместе с ожидающим выпуском (и ждущим повтора или паузы)"""
+        async def stop(conn: aiosqlite.Connection) -> WriteResult:
+            cursor = await conn.execute(
+                "UPDATE post_series SET status = 'stopped' WHERE id = ? AND user_id = ? AND status = 'active'",
+                (series_id, user_id))
+            stopped = cursor.rowcount
+            await cursor.close()
+            if stopped:
+                cursor = await conn.execute('''
+                    UPDATE scheduled_posts SET status = 'cancelled'
+                    WHERE series_id = ? AND status IN ('pending', 'retry', 'paused')
+                ''', (series_id,))
+                await cursor.close()
+            return WriteResult(stopped, None, None)
+        
+        result = await self._write(stop)
+        return result.rowcount > 0
     
     # ========== ПЛАТЕЖИ И СТАТИСТИКА ==========
     async def add_payment(self, user_id: int, tariff: str, amount: int):
         """Добавление платежа"""
-        conn = await self.connect()
-        await conn.execute('''
+        await self._write('''
             INSERT INTO payments (user_id, tariff, amount, status)
             VALUES (?, ?, ?, 'completed')
         ''', (user_id, tariff, amount))
-        await conn.commit()
+    
+    async def _read_counters(self, day: Optional[str] = None) -> Dict[str, int]:
+        """Счетчики статистики (общие, по тарифам и за день)"""
+        day = day or datetime.utcnow().strftime('%Y-%m-%d')
+        async with self.reader() as conn:
+            async with conn.execute('''
+                SELECT name, value FROM stats_counters
+                WHERE name IN ('users', 'revenue', ?, ?, ?)
+                   OR (name >= 'tariff:' AND name < 'tariff;')
+            ''', (f'posts_published:{day}', f'posts_failed:{day}', f'posts_partial:{day}')) as cursor:
+                return {row[0]: row[1] for row in await cursor.fetchall()}
     
     async def get_statistics(self) -> Dict:
-        """Получение статистики"""
-        conn = await self.connect()
-        
-        async with conn.execute('SELECT COUNT(*) FROM users') as cursor:
-            total_users = (await cursor.fetchone())[0]
-        
-        async with conn.execute('SELECT SUM(amount) FROM payments WHERE status = "completed"') as cursor:
-            total_revenue = (await cursor.fetchone())[0] or 0
-        
-        async with conn.execute('SELECT tariff, COUNT(*) FROM users GROUP BY tariff') as cursor:
-            tariff_stats = {row[0]: row[1] for row in await cursor.fetchall()}
-        
+        """Получение статистики из счетчиков, которые ведут триггеры"""
+        day = datetime.utcnow().strftime('%Y-%m-%d')
+        counters = await self._read_counters(day)
         return {
-            'total_users': total_users,
-            'total_revenue': total_revenue,
-            'tariff_stats': tariff_stats
+            'total_users': counters.get('users', 0),
+            'total_revenue': counters.get('revenue', 0),
+            'tariff_stats': {name[len('tariff:'):]: value for name, value in counters.items()
+                             if name.startswith('tariff:') and value},
+            'posts_published_today': counters.get(f'posts_published:{day}', 0),
+            'posts_failed_today': counters.get(f'posts_failed:{day}', 0),
+            'posts_partial_today': counters.get(f'posts_partial:{day}', 0),
         }
     
+    async def reconcile_statistics(self) -> Dict[str, Tuple[int, int]]:
+        """Сверка счетчиков с таблицами. Возвращает исправленные счетчики: имя -> (было, стало)"""
+        before = await self._read_counters()
+        for statement in self.STATS_RECOMPUTE:
+            await self._write(statement)
+        after = await self._read_counters()
+        return {name: (before.get(name, 0), value) for name, value in after.items()
+                if before.get(name, 0) != value}
+    
+    async def rollup_statistics(self, start: datetime, end: datetime) -> int:
+        """Пересчет почасовых агрегатов за [start, end) и дневных за затронутые дни (время UTC)"""
+        start = start.replace(minute=0, second=0, microsecond=0)
+        day_start = start.replace(hour=0)
+        day_end = (end - timedelta(microseconds=1)).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        hours = (f'{start:%Y-%m-%d %H:00}', f'{end:%Y-%m-%d %H:00}')
+        day_hours = (f'{day_start:%Y-%m-%d %H:00}', f'{day_end:%Y-%m-%d %H:00}')
+        timestamps = (f'{start:%Y-%m-%d %H:%M:%S}', f'{end:%Y-%m-%d %H:%M:%S}')
+        last_hour = f'{end - timedelta(microseconds=1):%Y-%m-%d %H:00}'
+        
+        statements = [("DELETE FROM stats_rollup WHERE period = 'hour' AND bucket >= ? AND bucket < ?", hours)]
+        statements += [(sql, timestamps) for sql in self.ROLLUP_HOURLY]
+        statements += [
+            # Итоги публикаций по всем каналам
+            ('''
+                INSERT INTO stats_rollup (period, metric, channel_id, bucket, value)
+                SELECT 'hour', metric, '', bucket, SUM(value) FROM stats_rollup
+                WHERE period = 'hour' AND bucket >= ? AND bucket < ? AND metric IN ('published', 'failed')
+                GROUP BY metric, bucket
+            ''', hours),
+            ("DELETE FROM stats_rollup WHERE period = 'day' AND bucket >= ? AND bucket < ?",
+             (f'{day_start:%Y-%m-%d}', f'{day_end:%Y-%m-%d}')),
+            ('''
+                INSERT INTO stats_rollup (period, metric, channel_id, bucket, value)
+                SELECT 'day', metric, channel_id, substr(bucket, 1, 10), SUM(value) FROM stats_rollup
+                WHERE period = 'hour' AND bucket >= ? AND bucket < ?
+                GROUP BY metric, channel_id, substr(bucket, 1, 10)
+            ''', day_hours),
+            # Отметка хранится отдельно: по MAX(bucket) часы без событий пересчитывались бы снова
+            ('''
+                INSERT INTO stats_counters (name, value)
+                VALUES ('rollup_watermark', CAST(strftime('%s', ?) AS INTEGER))
+                ON CONFLICT (name) DO UPDATE SET value = MAX(value, excluded.value)
+            ''', (last_hour,)),
+        ]
+        result = await self._write(statements)
+        return result.rowcount
+    
+    async def rollup_watermark(self) -> Optional[datetime]:
+        """Последний посчитанный час, а без агрегатов - самая ранняя запись в исходных таблицах"""
+        async with self.reader() as conn:
+            async with conn.execute("SELECT value FROM stats_counters WHERE name = 'rollup_watermark'") as cursor:
+                row = await cursor.fetchone()
+            if row is not None:
+                return datetime.utcfromtimestamp(row[0])
+            async with conn.execute('''
+                SELECT MIN(first) FROM (
+                    SELECT MIN(registered_at) AS first FROM users
+                    UNION ALL SELECT MIN(payment_date) FROM payments
+                    UNION ALL SELECT MIN(created_at) FROM scheduled_posts
+                )
+            ''') as cursor:
+                watermark = (await cursor.fetchone())[0]
+        return datetime.fromisoformat(watermark) if watermark else None
+    
+    async def get_rollup(self, metric: str, since: str, period: str = 'day', channel_id: str = '') -> Dict[str, int]:
+        """Значения агрегата по корзинам начиная с since: корзина -> значение"""
+        async with self.reader() as conn:
+            async with conn.execute('''
+                SELECT bucket, value FROM stats_rollup
+                WHERE period = ? AND metric = ? AND channel_id = ? AND bucket >= ?
+                ORDER BY bucket
+            ''', (period, metric, channel_id, since)) as cursor:
+                return {row[0]: row[1] for row in await cursor.fetchall()}
+    
+    async def get_rollup_top_channels(self, metric: str, since: str, limit: int = 5) -> List[Tuple[str, int]]:
+        """Каналы с наибольшим значением дневного агрегата начиная с since"""
+        async with self.reader() as conn:
+            async with conn.execute('''
+                SELECT channel_id, SUM(value) FROM stats_rollup
+                WHERE period = 'day' AND metric = ? AND channel_id != '' AND bucket >= ?
+                GROUP BY channel_id ORDER BY 2 DESC LIMIT ?
+            ''', (metric, since, limit)) as cursor:
+                return [(row[0], row[1]) for row in await cursor.fetchall()]
+    
     async def get_all_users(self) -> List[Dict]:
         """Получение всех пользователей"""
-        conn = await self.connect()
-        async with conn.execute('SELECT * FROM users ORDER BY registered_at DESC') as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+        async with self.reader() as conn:
+            async with conn.execute('SELECT * FROM users ORDER BY registered_at DESC') as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+    
+    async def get_users_page(self, limit: int = 10, after: Optional[Tuple[str, int]] = None,
+                             before: Optional[Tuple[str, int]] = None) -> Tuple[List[Dict], bool]:
+        """Страница пользователей от новых к старым по ключу (registered_at, user_id).
+        
+        after - ключ последней строки предыдущей страницы (листаем к старым),
+        before - ключ первой строки текущей страницы (листаем к новым).
+        Возвращает строки и признак, что в этом направлении есть еще страницы.
+        """
+        if before is not None:
+            sql = '''
+                SELECT * FROM users WHERE (registered_at, user_id) > (?, ?)
+                ORDER BY registered_at, user_id LIMIT ?
+            '''
+            params = (*before, limit + 1)
+        elif after is not None:
+            sql = '''
+                SELECT * FROM users WHERE (registered_at, user_id) < (?, ?)
+                ORDER BY registered_at DESC, user_id DESC LIMIT ?
+            '''
+            params = (*after, limit + 1)
+        else:
+            sql = 'SELECT * FROM users ORDER BY registered_at DESC, user_id DESC LIMIT ?'
+            params = (limit + 1,)
+        
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+        return rows, has_more
+    
+    async def iter_users(self, batch_size: int = 500):
+        """Все пользователи пачками по ключу, без загрузки таблицы в память"""
+        after = None
+        while True:
+            rows, has_more = await self.get_users_page(batch_size, after=after)
+            for row in rows:
+                yield row
+            if not has_more:
+                return
+            after = (rows[-1]['registered_at'], rows[-1]['user_id'])
 
 # Инициализируем базу данных
+instrument_methods(Database, 'bot_db_query_duration_seconds', 'Время методов Database')
+
 db = Database()
+# Датчик рабочей базы: временные экземпляры (проверки, бенчмарки) его не перезаписывают
+metrics.gauge('bot_queue_depth', 'Глубина очередей', lambda: db.write_depth, queue='db_write')
+
+# ========== ПРОВЕРКА ПЛАНОВ ЗАПРОСОВ ==========
+# Методы, которым полный проход по таблице разрешен (админские выгрузки)
+QUERY_PLAN_FULL_SCANS = {'get_all_users', 'reconcile_statistics'}
+# Методы без своих запросов к данным: служебные и обертки над другими методами
+QUERY_PLAN_SKIPPED = {'connect', 'close', 'init_db', 'migrate', 'iter_users'}
+
+def query_plan_calls(database: 'Database', now: datetime) -> List[Tuple[str, Callable]]:
+    """Вызовы методов Database для проверки планов: (имя метода, вызов)"""
+    return [
+        ('add_user', lambda: database.add_user(1, 'user', 'User')),
+        ('get_user', lambda: database.get_user(1)),
+        ('update_user_tariff', lambda: database.update_user_tariff(1, 'basic')),
+        ('increment_posts_today', lambda: database.increment_posts_today(1)),
+        ('add_user_channel', lambda: database.add_user_channel(1, '-1001', 'Channel')),
+        ('get_user_channels', lambda: database.get_user_channels(1)),
+        ('get_channels_batch', lambda: database.get_channels_batch(0)),
+        ('mark_channels_checked', lambda: database.mark_channels_checked(['-1001'])),
+        ('set_channel_status', lambda: database.set_channel_status('-1001', 'lost')),
+        ('set_channel_status', lambda: database.set_channel_status('-1001', 'active')),
+        ('get_tariff_info', lambda: database.get_tariff_info('basic')),
+        ('update_tariff_price', lambda: database.update_tariff_price('basic', 100)),
+        ('set_private_channel', lambda: database.set_private_channel('basic', '-1002', 'https://t.me/+x')),
+        ('get_private_channel', lambda: database.get_private_channel('basic')),
+        ('add_scheduled_post', lambda: database.add_scheduled_post(1, '-1001', 'text', 'x', None, now)),
+        ('add_scheduled_posts', lambda: database.add_scheduled_posts(1, [{
+            'channel_id': '@channel', 'content_type': 'text', 'text': 'text', 'media_id': None,
+            'scheduled_time': datetime(2024, 1, 1)}])),
+        ('count_posts_by_day', lambda: database.count_posts_by_day(1, datetime(2024, 1, 1), datetime(2024, 1, 7))),
+        ('get_pending_posts', lambda: database.get_pending_posts(now)),
+        ('claim_posts', lambda: database.claim_posts([1], WORKER_ID, now)),
+        ('claim_due_posts', lambda: database.claim_due_posts(WORKER_ID, now)),
+        ('renew_leases', lambda: database.renew_leases(WORKER_ID, now)),
+        ('update_post_status', lambda: database.update_post_status(1, 'published', WORKER_ID)),
+        ('schedule_retry', lambda: database.schedule_retry(1, now, 'error', WORKER_ID)),
+        ('add_dead_letter', lambda: database.add_dead_letter(1, '-1001', 'permanent', 'error', 1)),
+        ('get_dead_letters', lambda: database.get_dead_letters()),
+        ('add_fanout_post', lambda: database.add_fanout_post(1, ['-1001', '-1002'], 'text', 'x', None, now)),
+        ('set_post_message', lambda: database.set_post_message(1, 1)),
+        ('get_pending_targets', lambda: database.get_pending_targets(1)),
+        ('get_target_statuses', lambda: database.get_target_statuses(1)),
+        ('update_target_status', lambda: database.update_target_status(1, '-1002', 'published')),
+        ('add_post_series', lambda: database.add_post_series(1, '-1001', 'text', 'x', None, 'FREQ=DAILY', now)),
+        ('get_series', lambda: database.get_series(1)),
+        ('get_user_series', lambda: database.get_user_series(1)),
+        ('get_stalled_series', lambda: database.get_stalled_series()),
+        ('advance_series', lambda: database.advance_series(1, now.isoformat(), now + timedelta(days=1))),
+        ('stop_series', lambda: database.stop_series(1, 1)),
+        ('skip_series_issue', lambda: database.skip_series_issue(1, now.isoformat(), now + timedelta(days=1))),
+        ('finish_series', lambda: database.finish_series(1)),
+        ('add_payment', lambda: database.add_payment(1, 'basic', 100)),
+        ('get_statistics', lambda: database.get_statistics()),
+        ('reconcile_statistics', lambda: database.reconcile_statistics()),
+        ('rollup_statistics', lambda: database.rollup_statistics(datetime(2024, 1, 1), datetime(2024, 1, 2))),
+        ('rollup_watermark', lambda: database.rollup_watermark()),
+        ('get_rollup', lambda: database.get_rollup('published', '2024-01-01')),
+        ('get_rollup_top_channels', lambda: database.get_rollup_top_channels('failed', '2024-01-01')),
+        ('get_all_users', lambda: database.get_all_users()),
+        ('get_users_page', lambda: database.get_users_page(10)),
+        ('get_users_page', lambda: database.get_users_page(10, after=('2024-01-01 00:00:00', 1))),
+        ('get_users_page', lambda: database.get_users_page(10, before=('2024-01-01 00:00:00', 1))),
+    ]
+
+async def find_full_scans(conn: aiosqlite.Connection, statements: List[Tuple[str, str]]) -> List[str]:
+    """EXPLAIN QUERY PLAN для пар (метод, sql); возвращает запросы, читающие таблицу целиком"""
+    problems = []
+    for name, sql in statements:
+        if not sql.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')):
+            continue
+        async with conn.execute(f'EXPLAIN QUERY PLAN {sql}') as cursor:
+            details = [row[3] for row in await cursor.fetchall()]
+        # Обход индекса по порядку с LIMIT читает не больше LIMIT строк
+        bounded = ' LIMIT ' in f" {' '.join(sql.upper().split())} "
+        for detail in details:
+            if not detail.startswith('SCAN ') or name in QUERY_PLAN_FULL_SCANS:
+                continue
+            if bounded and 'USING INDEX' in detail:
+                continue
+            if 'VIRTUAL TABLE' in detail:
+                # json_each и т.п. перебирают параметр запроса, а не таблицу
+                continue
+            problems.append(f"{name}: {detail} | {' '.join(sql.split())}")
+    return problems
+
+async def check_query_plans() -> List[str]:
+    """Прогон всех методов Database на пустой базе и EXPLAIN QUERY PLAN каждого запроса.
+    
+    Возвращает список запросов, которые сканируют таблицу целиком
+    (SCAN без покрывающего индекса и без LIMIT по индексу).
+    Запускается тестами (tests/test_query_plans.py) и флагом --check-query-plans.
+    """
+    database = Database(":memory:")
+    await database.init_db()
+    conn = await database.connect()
+    
+    current = ['']
+    statements = []
+    await conn.set_trace_callback(lambda sql: statements.append((current[0], sql)))
+    for name, call in query_plan_calls(database, datetime.now()):
+        current[0] = name
+        await call()
+    await conn.set_trace_callback(None)
+    
+    problems = await find_full_scans(conn, statements)
+    await database.close()
+    return problems
 
 # ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
 def create_keyboard(buttons: List[List[Dict]]) -> InlineKeyboardMarkup:
@@ -348,14 +1802,387 @@ def create_keyboard(buttons: List[List[Dict]]) -> InlineKeyboardMarkup:
         ])
     return InlineKeyboardMarkup(keyboard)
 
-async def check_user_admin(bot, chat_id: str, user_id: int) -> bool:
-    """Проверка, является ли пользователь администратором канала"""
+class PrebuiltKeyboard(InlineKeyboardMarkup):
+    """Клавиатура, которая переводится в dict для Bot API один раз при создании"""
+    
+    __slots__ = ("_serialized",)
+    
+    def __init__(self, inline_keyboard):
+        super().__init__(inline_keyboard)
+        with self._unfrozen():
+            self._serialized = super().to_dict()
+    
+    def to_dict(self, recursive: bool = True) -> Dict:
+        if not recursive:
+            return super().to_dict(recursive=False)
+        return self._serialized
+
+class KeyboardRegistry:
+    """Готовые клавиатуры: статические меню строятся один раз при старте,
+    параметризованные (например, выбор канала) - запоминаются по входным данным.
+    """
+    
+    def __init__(self, memo_size: int = 10000, memo_ttl: float = CALLBACK_PAYLOAD_TTL / 2):
+        self.static: Dict[str, PrebuiltKeyboard] = {}
+        # Срок жизни меньше, чем у токенов CallbackCodec внутри кнопок
+        self.memo_ttl = memo_ttl
+        self.memo = LRUCache(memo_size)
+    
+    @staticmethod
+    def build(buttons: List[List[Dict]]) -> PrebuiltKeyboard:
+        return PrebuiltKeyboard([
+            [InlineKeyboardButton(btn['text'], callback_data=btn['callback']) for btn in row]
+            for row in buttons
+        ])
+    
+    def register(self, name: str, buttons: List[List[Dict]]):
+        self.static[name] = self.build(buttons)
+    
+    def get(self, name: str) -> PrebuiltKeyboard:
+        return self.static[name]
+    
+    def memoized(self, key: Tuple, factory) -> PrebuiltKeyboard:
+        """Клавиатура по ключу; factory() возвращает кнопки, если ее еще нет"""
+        entry = self.memo.get(key)
+        if entry is not _MISSING and entry[0] > time.monotonic():
+            return entry[1]
+        keyboard = self.build(factory())
+        self.memo.set(key, (time.monotonic() + self.memo_ttl, keyboard))
+        return keyboard
+
+keyboards = KeyboardRegistry()
+keyboards.register('main_menu', [
+    [{'text': '📅 Запланировать пост', 'callback': 'plan_post'}],
+    [{'text': '📊 Мои каналы', 'callback': 'my_channels'}],
+    [{'text': '💰 Тарифы', 'callback': 'tariffs'}],
+    [{'text': '🆘 Помощь', 'callback': 'help'}]
+])
+keyboards.register('tariffs', [
+    [{'text': '💳 Купить тариф', 'callback': 'buy_tariff'}],
+    [{'text': '🔙 Назад', 'callback': 'main_menu'}]
+])
+keyboards.register('buy_tariff', [
+    [{'text': '✅ Я подписался, оплатить', 'callback': 'confirm_payment'}],
+    [{'text': '🔙 Назад', 'callback': 'tariffs'}]
+])
+keyboards.register('select_time', [
+    [
+        {'text': '⏰ Через 1 час', 'callback': 'time_1h'},
+        {'text': '⏱️ Через 3 часа', 'callback': 'time_3h'}
+    ],
+    [
+        {'text': '🌅 Завтра утром', 'callback': 'time_tomorrow_9'},
+        {'text': '🌆 Завтра вечером', 'callback': 'time_tomorrow_18'}
+    ],
+    [
+        {'text': '📅 Выбрать дату', 'callback': 'time_custom'},
+        {'text': '⚡ Сейчас', 'callback': 'time_now'}
+    ],
+    [{'text': '❌ Отмена', 'callback': 'cancel'}]
+])
+keyboards.register('confirm_post', [
+    [
+        {'text': '✅ Да, запланировать', 'callback': 'confirm_post'},
+        {'text': '❌ Нет, отменить', 'callback': 'cancel'}
+    ],
+    [
+        {'text': '🔁 Каждый день', 'callback': 'repeat_daily'},
+        {'text': '🔁 По будням', 'callback': 'repeat_weekdays'},
+        {'text': '🔁 Раз в неделю', 'callback': 'repeat_weekly'}
+    ]
+])
+keyboards.register('admin', [
+    [{'text': '💰 Изменить цену', 'callback': 'admin_set_price'}],
+    [{'text': '🔗 Настроить канал', 'callback': 'admin_set_channel'}],
+    [{'text': '📊 Статистика', 'callback': 'admin_stats'}],
+    [{'text': '📈 Тренды', 'callback': 'admin_trends'}],
+    [{'text': '👥 Все пользователи', 'callback': 'admin_users'}]
+])
+
+def channel_picker_keyboard(channels: List[Dict]) -> PrebuiltKeyboard:
+    """Клавиатура выбора канала (запоминается по списку каналов)"""
+    def factory():
+        buttons = [
+            [{'text': f"{'⚠️' if channel.get('status') == 'lost' else '📢'} {channel['channel_name']}",
+              'callback': callback_codec.encode('sc', channel_id=channel['channel_id'])}]
+            for channel in channels
+        ]
+        if len(channels) > 1:
+            buttons.append([{'text': f"📢 Во все каналы ({len(channels)})", 'callback': 'select_all_channels'}])
+        buttons.append([{'text': '🔙 Назад', 'callback': 'main_menu'}])
+        return buttons
+    
+    key = ('channel_picker',) + tuple((channel['channel_id'], channel['channel_name'], channel.get('status'))
+                                      for channel in channels)
+    return keyboards.memoized(key, factory)
+
+class CallbackCodec:
+    """Компактная callback_data: '<маршрут>:<версия><тело>'.
+    
+    Поля маршрута (register) пакуются в бинарный вид (zigzag varint для чисел
+    и числовых строк вроде ID каналов, длина + UTF-8 для строк) и кодируются
+    base64url - тело 'i...'. Если результат длиннее 64 байт, поля кладутся
+    в хранилище на сервере, а в кнопку идет короткий токен - тело 't...'.
+    """
+    
+    VERSION = '1'
+    MAX_LENGTH = 64  # ограничение Telegram на callback_data, байт
+    _NONE, _INT, _STR, _NUMSTR = range(4)
+    _NUMERIC = re.compile(r'-?[1-9]\d*|0')
+    
+    def __init__(self, ttl: float = CALLBACK_PAYLOAD_TTL, maxsize: int = CALLBACK_PAYLOAD_LIMIT):
+        self.ttl = ttl
+        self.fields: Dict[str, Tuple[str, ...]] = {}
+        self.store = LRUCache(maxsize, "fifo")
+    
+    def register(self, route: str, *fields: str):
+        """Описание полей маршрута (порядок важен для бинарного формата)"""
+        self.fields[route] = fields
+    
+    @staticmethod
+    def _varint(value: int) -> bytes:
+        value = value * 2 if value >= 0 else -value * 2 - 1  # zigzag
+        out = bytearray()
+        while True:
+            byte = value & 0x7F
+            value >>= 7
+            if value:
+                out.append(byte | 0x80)
+            else:
+                out.append(byte)
+                return bytes(out)
+    
+    @staticmethod
+    def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+        value = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return (value >> 1) ^ -(value & 1), pos
+    
+    def _pack(self, values: List) -> bytes:
+        out = bytearray()
+        for value in values:
+            if value is None:
+                out.append(self._NONE)
+            elif isinstance(value, int):
+                out.append(self._INT)
+                out += self._varint(value)
+            elif self._NUMERIC.fullmatch(value):
+                out.append(self._NUMSTR)
+                out += self._varint(int(value))
+            else:
+                raw = value.encode()
+                out.append(self._STR)
+                out += self._varint(len(raw))
+                out += raw
+        return bytes(out)
+    
+    def _unpack(self, data: bytes) -> List:
+        values = []
+        pos = 0
+        while pos < len(data):
+            tag = data[pos]
+            pos += 1
+            if tag == self._NONE:
+                values.append(None)
+            elif tag in (self._INT, self._NUMSTR):
+                value, pos = self._read_varint(data, pos)
+                values.append(value if tag == self._INT else str(value))
+            else:
+                length, pos = self._read_varint(data, pos)
+                values.append(data[pos:pos + length].decode())
+                pos += length
+        return values
+    
+    def encode(self, route: str, **payload) -> str:
+        """callback_data для маршрута route с полями payload"""
+        values = [payload.get(field) for field in self.fields[route]]
+        body = base64.urlsafe_b64encode(self._pack(values)).rstrip(b'=').decode()
+        data = f"{route}:{self.VERSION}i{body}"
+        if len(data.encode()) <= self.MAX_LENGTH:
+            return data
+        token = secrets.token_urlsafe(6)
+        self.store.set(token, (time.monotonic() + self.ttl, values))
+        return f"{route}:{self.VERSION}t{token}"
+    
+    def decode(self, data: str) -> Optional[Dict]:
+        """Поля кнопки; None - если кнопка устарела или повреждена"""
+        route, _, rest = data.partition(':')
+        fields = self.fields.get(route)
+        if fields is None or rest[:1] != self.VERSION:
+            return None
+        kind, body = rest[1:2], rest[2:]
+        try:
+            if kind == 'i':
+                values = self._unpack(base64.urlsafe_b64decode(body + '=' * (-len(body) % 4)))
+            elif kind == 't':
+                entry = self.store.get(body)
+                if entry is _MISSING or entry[0] < time.monotonic():
+                    return None
+                values = entry[1]
+            else:
+                return None
+        except (ValueError, IndexError):
+            return None
+        if len(values) != len(fields):
+            return None
+        return dict(zip(fields, values))
+
+callback_codec = CallbackCodec()
+callback_codec.register('sc', 'channel_id')
+callback_codec.register('au', 'direction', 'registered_at', 'user_id')
+callback_codec.register('ss', 'series_id')
+
+admin_cache = TTLCache(ADMIN_CHECK_TTL)
+
+async def fetch_admin_status(bot, chat_id: str, user_id: int) -> Optional[bool]:
+    """Живая проверка прав с записью в кэш; None - Telegram не ответил, результат неизвестен"""
     try:
         member = await bot.get_chat_member(chat_id, user_id)
-        return member.status in [ChatMember.ADMINISTRATOR, ChatMember.OWNER]
+    except Forbidden as e:
+        # Бота удалили из чата - это ответ, а не сбой
+        logger.warning(f"Нет доступа к каналу {chat_id}: {e}")
+        is_admin = False
+    except BadRequest as e:
+        if 'not found' not in str(e).lower():
+            # Прочие BadRequest не говорят о правах - не кэшируем и не приостанавливаем канал
+            logger.error(f"Ошибка проверки администратора в {chat_id}: {e}")
+            return None
+        # Чата (или пользователя в нем) нет
+        logger.warning(f"Нет доступа к каналу {chat_id}: {e}")
+        is_admin = False
     except Exception as e:
         logger.error(f"Ошибка проверки администратора: {e}")
-        return False
+        return None
+    else:
+        # В каналах у администратора может не быть права публикации
+        is_admin = (member.status in [ChatMember.ADMINISTRATOR, ChatMember.OWNER]
+                    and getattr(member, 'can_post_messages', None) is not False)
+    admin_cache.set((str(chat_id), user_id), is_admin)
+    return is_admin
+
+async def check_user_admin(bot, chat_id: str, user_id: int) -> bool:
+    """Проверка, является ли пользователь администратором канала.
+    
+    Положительный ответ берется из кэша (его обновляет ChannelPermissionMonitor),
+    отрицательный перепроверяется: права могли выдать только что.
+    """
+    if admin_cache.get((str(chat_id), user_id)) is True:
+        return True
+    return bool(await fetch_admin_status(bot, chat_id, user_id))
+
+class RecurrenceRule:
+    """Подмножество RRULE (RFC 5545) для повторяющихся постов.
+    
+    Поддерживаются FREQ=HOURLY|DAILY|WEEKLY, INTERVAL, BYDAY (MO..SU),
+    BYHOUR, BYMINUTE и UNTIL. COUNT хранится в серии отдельно (remaining).
+    Время выпусков отсчитывается от start_time серии; по умолчанию час,
+    минута и день недели берутся из него.
+    """
+    
+    FREQUENCIES = {'HOURLY': timedelta(hours=1), 'DAILY': timedelta(days=1), 'WEEKLY': timedelta(weeks=1)}
+    WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+    MAX_PERIODS = 1000  # сколько периодов просматривать в поисках подходящего выпуска
+    
+    def __init__(self, freq: str, interval: int = 1, byday: Optional[List[int]] = None,
+                 byhour: Optional[List[int]] = None, byminute: Optional[List[int]] = None,
+                 until: Optional[datetime] = None, count: Optional[int] = None):
+        self.freq = freq
+        self.interval = interval
+        self.byday = byday
+        self.byhour = byhour
+        self.byminute = byminute
+        self.until = until
+        self.count = count
+    
+    @classmethod
+    def parse(cls, text: str) -> 'RecurrenceRule':
+        """Разбор строки вида FREQ=WEEKLY;BYDAY=MO,WE;BYHOUR=9; ValueError при ошибке"""
+        parts = {}
+        for part in text.strip().removeprefix('RRULE:').split(';'):
+            if not part:
+                continue
+            key, sep, value = part.partition('=')
+            if not sep or not value:
+                raise ValueError(f"неверная часть правила '{part}'")
+            parts[key.strip().upper()] = value.strip().upper()
+        
+        freq = parts.pop('FREQ', None)
+        if freq not in cls.FREQUENCIES:
+            raise ValueError("FREQ должен быть HOURLY, DAILY или WEEKLY")
+        
+        def numbers(key: str, low: int, high: int) -> Optional[List[int]]:
+            if key not in parts:
+                return None
+            values = sorted({int(value) for value in parts.pop(key).split(',')})
+            if not values or values[0] < low or values[-1] > high:
+                raise ValueError(f"{key} вне диапазона {low}..{high}")
+            return values
+        
+        try:
+            interval = int(parts.pop('INTERVAL', 1))
+            byhour = numbers('BYHOUR', 0, 23)
+            byminute = numbers('BYMINUTE', 0, 59)
+            count = int(parts.pop('COUNT')) if 'COUNT' in parts else None
+            until = parts.pop('UNTIL', None)
+            if until and 'T' in until:
+                until = datetime.strptime(until.rstrip('Z'), '%Y%m%dT%H%M%S')
+            elif until:
+                # Дата без времени включает весь день
+                until = datetime.strptime(until, '%Y%m%d') + timedelta(days=1, seconds=-1)
+        except ValueError as e:
+            raise ValueError(f"неверное число в правиле: {e}")
+        byday = None
+        if 'BYDAY' in parts:
+            days = parts.pop('BYDAY').split(',')
+            if any(day not in cls.WEEKDAYS for day in days):
+                raise ValueError("BYDAY - дни недели MO,TU,WE,TH,FR,SA,SU")
+            byday = sorted({cls.WEEKDAYS.index(day) for day in days})
+        if parts:
+            raise ValueError(f"неподдерживаемые части правила: {', '.join(parts)}")
+        if interval < 1 or (count is not None and count < 1):
+            raise ValueError("INTERVAL и COUNT должны быть положительными")
+        return cls(freq, interval, byday, byhour, byminute, until, count)
+    
+    def _period_start(self, start_time: datetime) -> datetime:
+        if self.freq == 'HOURLY':
+            return start_time.replace(minute=0, second=0, microsecond=0)
+        midnight = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.freq == 'WEEKLY':
+            return midnight - timedelta(days=start_time.weekday())
+        return midnight
+    
+    def _occurrences(self, period: datetime, start_time: datetime) -> List[datetime]:
+        """Выпуски внутри одного периода по возрастанию"""
+        minutes = self.byminute or [start_time.minute]
+        if self.freq == 'HOURLY':
+            times = [period.replace(minute=minute) for minute in minutes]
+        else:
+            if self.freq == 'WEEKLY':
+                days = [period + timedelta(days=day) for day in (self.byday or [start_time.weekday()])]
+            else:
+                days = [period]
+            times = [day.replace(hour=hour, minute=minute)
+                     for day in days for hour in (self.byhour or [start_time.hour]) for minute in minutes]
+        return [moment for moment in times
+                if (self.byday is None or moment.weekday() in self.byday)
+                and (self.byhour is None or moment.hour in self.byhour)]
+    
+    def next_after(self, after: datetime, start_time: datetime) -> Optional[datetime]:
+        """Первый выпуск строго позже after (и не раньше start_time) или None"""
+        anchor = self._period_start(start_time)
+        step = self.FREQUENCIES[self.freq] * self.interval
+        index = max(0, int((after - anchor) / step))
+        for period_index in range(index, index + self.MAX_PERIODS):
+            for moment in self._occurrences(anchor + step * period_index, start_time):
+                if moment > after and moment >= start_time.replace(second=0, microsecond=0):
+                    return None if self.until and moment > self.until else moment
+        return None
 
 # ========== ОСНОВНЫЕ КОМАНДЫ ==========
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -363,12 +2190,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     await db.add_user(user.id, user.username, user.first_name, user.last_name)
     
-    keyboard = create_keyboard([
-        [{'text': '📅 Запланировать пост', 'callback': 'plan_post'}],
-        [{'text': '📊 Мои каналы', 'callback': 'my_channels'}],
-        [{'text': '💰 Тарифы', 'callback': 'tariffs'}],
-        [{'text': '🆘 Помощь', 'callback': 'help'}]
-    ])
+    keyboard = keyboards.get('main_menu')
     
     await update.message.reply_text(
         f"👋 Привет, {user.first_name}!\n\n"
@@ -404,17 +2226,13 @@ async def tariffs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     text += "💳 **Для покупки:**\nНажмите кнопку ниже или отправьте /buy"
     
-    keyboard = create_keyboard([
-        [{'text': '💳 Купить тариф', 'callback': 'buy_tariff'}],
-        [{'text': '🔙 Назад', 'callback': 'main_menu'}]
-    ])
+    keyboard = keyboards.get('tariffs')
     
     await update.message.reply_text(text, reply_markup=keyboard)
 
 async def buy_tariff(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Покупка тарифа"""
     query = update.callback_query
-    await query.answer()
     
     tariff = await db.get_tariff_info('basic')
     private_channel = await db.get_private_channel('basic')
@@ -448,10 +2266,7 @@ async def buy_tariff(update: Update, context: ContextTypes.DEFAULT_TYPE):
 Свяжитесь с администратором для активации тарифа.
 """
     
-    keyboard = create_keyboard([
-        [{'text': '✅ Я подписался, оплатить', 'callback': 'confirm_payment'}],
-        [{'text': '🔙 Назад', 'callback': 'tariffs'}]
-    ])
+    keyboard = keyboards.get('buy_tariff')
     
     await query.edit_message_text(text, reply_markup=keyboard)
 
@@ -509,7 +2324,10 @@ async def my_channels_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     text = f"📊 **Ваши каналы** (тариф: {user['tariff']})\n\n"
     for i, channel in enumerate(channels, 1):
         text += f"{i}. {channel['channel_name']}\n"
-        text += f"   ID: {channel['channel_id']}\n\n"
+        text += f"   ID: {channel['channel_id']}\n"
+        if channel.get('status') == 'lost':
+            text += "   ⚠️ Бот не может публиковать - посты приостановлены\n"
+        text += "\n"
     
     await update.message.reply_text(text)
 
@@ -517,7 +2335,6 @@ async def my_channels_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def plan_post_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало планирования поста"""
     query = update.callback_query
-    await query.answer()
     
     user_id = update.effective_user.id
     user = await db.get_user(user_id)
@@ -545,15 +2362,8 @@ async def plan_post_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # Создаем клавиатуру с каналами
-    keyboard_buttons = []
-    for channel in channels:
-        keyboard_buttons.append([
-            {'text': f"📢 {channel['channel_name']}", 'callback': f"select_channel_{channel['channel_id']}"}
-        ])
-    keyboard_buttons.append([{'text': '🔙 Назад', 'callback': 'main_menu'}])
-    
-    keyboard = create_keyboard(keyboard_buttons)
+    # Клавиатура с каналами
+    keyboard = channel_picker_keyboard(channels)
     
     await query.edit_message_text(
         "📋 **Выберите канал для публикации:**",
@@ -563,9 +2373,25 @@ async def plan_post_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def select_channel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Выбор канала"""
     query = update.callback_query
-    await query.answer()
     
-    channel_id = query.data.split('_')[2]
+    context.user_data.pop('channel_ids', None)
+    if query.data == 'select_all_channels':
+        # Один пост во все каналы пользователя
+        channel_ids = [channel['channel_id'] for channel in await db.get_user_channels(update.effective_user.id)]
+        if not channel_ids:
+            await query.edit_message_text("❌ У вас нет добавленных каналов!")
+            return
+        context.user_data['channel_ids'] = channel_ids
+        channel_id = channel_ids[0]
+    elif query.data.startswith('select_channel_'):
+        # Кнопки старого формата в уже отправленных сообщениях
+        channel_id = query.data[len('select_channel_'):]
+    else:
+        payload = callback_codec.decode(query.data)
+        if payload is None:
+            await query.edit_message_text("⌛ Кнопка устарела. Начните планирование заново: /start")
+            return
+        channel_id = payload['channel_id']
     context.user_data['channel_id'] = channel_id
     
     await query.edit_message_text(
@@ -577,12 +2403,93 @@ async def select_channel_callback(update: Update, context: ContextTypes.DEFAULT_
         "Или нажмите ❌ для отмены."
     )
 
+def channels_label(user_data: Dict) -> str:
+    """Канал поста для сообщений (при публикации во все каналы - их количество)"""
+    channel_ids = user_data.get('channel_ids')
+    if channel_ids and len(channel_ids) > 1:
+        return f"{user_data['channel_id']} и еще {len(channel_ids) - 1}"
+    return user_data['channel_id']
+
+class MediaGroupCollector:
+    """Сборка альбома: Telegram присылает каждое фото/видео альбома отдельным
+    сообщением с общим media_group_id. Группа считается полной, когда
+    delay секунд не приходит новых сообщений.
+    """
+    
+    def __init__(self, delay: float = MEDIA_GROUP_DELAY, max_items: int = MEDIA_GROUP_MAX_ITEMS):
+        self.delay = delay
+        self.max_items = max_items
+        self._groups: Dict[str, Dict] = {}
+    
+    def add(self, message, on_complete):
+        """Добавление сообщения; on_complete(items, caption) вызывается один раз на альбом"""
+        group = self._groups.get(message.media_group_id)
+        if group is None:
+            group = self._groups[message.media_group_id] = {'items': [], 'caption': '', 'task': None}
+        
+        if message.photo:
+            group['items'].append((message.message_id, 'photo', message.photo[-1].file_id))
+        elif message.video:
+            group['items'].append((message.message_id, 'video', message.video.file_id))
+        if message.caption and not group['caption']:
+            group['caption'] = message.caption
+        
+        # Таймер перезапускается с каждым сообщением группы
+        if group['task']:
+            group['task'].cancel()
+        group['task'] = asyncio.create_task(self._complete(message.media_group_id, on_complete))
+    
+    async def _complete(self, group_id: str, on_complete):
+        await asyncio.sleep(self.delay)
+        group = self._groups.pop(group_id)
+        items = [(kind, file_id) for _, kind, file_id in sorted(group['items'])][:self.max_items]
+        try:
+            await on_complete(items, group['caption'])
+        except Exception as e:
+            logger.error(f"Ошибка сборки альбома {group_id}: {e}")
+
+media_groups = MediaGroupCollector()
+
+async def reply_content_received(message, user_data: Dict):
+    """Превью полученного контента и выбор времени"""
+    keyboard = keyboards.get('select_time')
+    
+    text_preview = user_data['text'][:100] + "..." if len(user_data['text']) > 100 else user_data['text']
+    content_type = user_data['content_type']
+    if content_type == 'album':
+        content_type = f"album ({len(json.loads(user_data['media_id']))} шт.)"
+    
+    await message.reply_text(
+        f"✅ Контент получен!\n\n"
+        f"📝 Текст: {text_preview}\n"
+        f"📁 Тип: {content_type}\n\n"
+        f"⏰ **Выберите время публикации:**",
+        reply_markup=keyboard
+    )
+
 async def handle_post_content(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка контента поста"""
     if update.message.text == '❌':
         await update.message.reply_text("❌ Планирование отменено.")
         return
     
+    if update.message.media_group_id and (update.message.photo or update.message.video):
+        # Альбом: один пост с media_id = JSON-список [[тип, file_id], ...]
+        user_data = context.user_data
+        message = update.message
+        
+        async def album_complete(items: List[Tuple[str, str]], caption: str):
+            user_data['text'] = caption
+            if len(items) == 1:
+                # send_media_group требует от 2 элементов
+                user_data['content_type'], user_data['media_id'] = items[0]
+            else:
+                user_data['content_type'], user_data['media_id'] = 'album', json.dumps(items)
+            await reply_content_received(message, user_data)
+        
+        media_groups.add(update.message, album_complete)
+        return
+    
     context.user_data['text'] = update.message.text or ""
     context.user_data['media_id'] = None
     context.user_data['content_type'] = 'text'
@@ -594,36 +2501,11 @@ async def handle_post_content(update: Update, context: ContextTypes.DEFAULT_TYPE
         context.user_data['media_id'] = update.message.video.file_id
         context.user_data['content_type'] = 'video'
     
-    keyboard = create_keyboard([
-        [
-            {'text': '⏰ Через 1 час', 'callback': 'time_1h'},
-            {'text': '⏱️ Через 3 часа', 'callback': 'time_3h'}
-        ],
-        [
-            {'text': '🌅 Завтра утром', 'callback': 'time_tomorrow_9'},
-            {'text': '🌆 Завтра вечером', 'callback': 'time_tomorrow_18'}
-        ],
-        [
-            {'text': '📅 Выбрать дату', 'callback': 'time_custom'},
-            {'text': '⚡ Сейчас', 'callback': 'time_now'}
-        ],
-        [{'text': '❌ Отмена', 'callback': 'cancel'}]
-    ])
-    
-    text_preview = context.user_data['text'][:100] + "..." if len(context.user_data['text']) > 100 else context.user_data['text']
-    
-    await update.message.reply_text(
-        f"✅ Контент получен!\n\n"
-        f"📝 Текст: {text_preview}\n"
-        f"📁 Тип: {context.user_data['content_type']}\n\n"
-        f"⏰ **Выберите время публикации:**",
-        reply_markup=keyboard
-    )
+    await reply_content_received(update.message, context.user_data)
 
 async def select_time_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Выбор времени публикации"""
     query = update.callback_query
-    await query.answer()
     
     now = datetime.now()
     
@@ -636,7 +2518,7 @@ async def select_time_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     elif query.data == 'time_tomorrow_18':
         scheduled_time = (now + timedelta(days=1)).replace(hour=18, minute=0, second=0)
     elif query.data == 'time_now':
-        scheduled_time = now + timedelta(minutes=5)
+        scheduled_time = now
     elif query.data == 'time_custom':
         await query.edit_message_text(
             "📅 **Введите дату и время в формате:**\n"
@@ -645,108 +2527,322 @@ async def select_time_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             "Или отправьте ❌ для отмены."
         )
         return
-    elif query.data == 'cancel':
-        await query.edit_message_text("❌ Планирование отменено.")
-        return
+    elif query.data == 'cancel':
+        await query.edit_message_text("❌ Планирование отменено.")
+        return
+    
+    context.user_data['scheduled_time'] = scheduled_time
+    
+    # Показываем подтверждение
+    keyboard = keyboards.get('confirm_post')
+    
+    await query.edit_message_text(
+        f"📋 **Подтверждение публикации**\n\n"
+        f"📢 Канал: {channels_label(context.user_data)}\n"
+        f"📝 Тип: {context.user_data['content_type']}\n"
+        f"⏰ Время: {scheduled_time.strftime('%Y.%m.%d %H:%M')}\n\n"
+        f"✅ **Подтвердить публикацию?**",
+        reply_markup=keyboard
+    )
+
+async def handle_custom_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка пользовательского времени"""
+    if update.message.text == '❌':
+        await update.message.reply_text("❌ Планирование отменено.")
+        return
+    
+    try:
+        scheduled_time = datetime.strptime(update.message.text, "%Y.%m.%d %H:%M")
+        
+        if scheduled_time < datetime.now():
+            await update.message.reply_text("❌ Нельзя планировать в прошлом!")
+            return
+        
+        context.user_data['scheduled_time'] = scheduled_time
+        
+        keyboard = keyboards.get('confirm_post')
+        
+        await update.message.reply_text(
+            f"📋 **Подтверждение публикации**\n\n"
+            f"📢 Канал: {channels_label(context.user_data)}\n"
+            f"📝 Тип: {context.user_data['content_type']}\n"
+            f"⏰ Время: {scheduled_time.strftime('%Y.%m.%d %H:%M')}\n\n"
+            f"✅ **Подтвердить публикацию?**",
+            reply_markup=keyboard
+        )
+    except ValueError:
+        await update.message.reply_text(
+            "❌ Неверный формат!\n"
+            "Используйте: ГГГГ.ММ.ДД ЧЧ:ММ\n"
+            "Пример: 2025.12.31 18:30\n\n"
+            "Попробуйте снова или отправьте ❌ для отмены."
+        )
+
+async def confirm_post_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подтверждение поста"""
+    query = update.callback_query
+    
+    if query.data == 'cancel':
+        await query.edit_message_text("❌ Планирование отменено.")
+        return
+    
+    user_id = update.effective_user.id
+    
+    # Сохраняем пост (во все выбранные каналы - одной строкой с целями)
+    channel_ids = context.user_data.get('channel_ids')
+    if channel_ids and len(channel_ids) > 1:
+        post_id = await db.add_fanout_post(
+            user_id=user_id,
+            channel_ids=channel_ids,
+            content_type=context.user_data['content_type'],
+            content=context.user_data['text'],
+            media_id=context.user_data['media_id'],
+            scheduled_time=context.user_data['scheduled_time']
+        )
+    else:
+        post_id = await db.add_scheduled_post(
+            user_id=user_id,
+            channel_id=context.user_data['channel_id'],
+            content_type=context.user_data['content_type'],
+            content=context.user_data['text'],
+            media_id=context.user_data['media_id'],
+            scheduled_time=context.user_data['scheduled_time']
+        )
+    dispatcher.schedule(post_id, context.user_data['scheduled_time'])
+    
+    # Обновляем счетчик постов
+    await db.increment_posts_today(user_id)
+    
+    await query.edit_message_text(
+        f"✅ **Пост запланирован!**\n\n"
+        f"📝 ID поста: {post_id}\n"
+        f"⏰ Время публикации: {context.user_data['scheduled_time'].strftime('%Y.%m.%d %H:%M')}\n"
+        f"📢 Канал: {channels_label(context.user_data)}\n\n"
+        f"✨ Пост будет опубликован автоматически."
+    )
+
+# ========== ПОВТОРЯЮЩИЕСЯ ПОСТЫ ==========
+SERIES_PRESETS = {
+    'repeat_daily': ('FREQ=DAILY', 'каждый день'),
+    'repeat_weekdays': ('FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR', 'по будням'),
+    'repeat_weekly': ('FREQ=WEEKLY', 'раз в неделю'),
+}
+
+async def confirm_series_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подтверждение поста как серии: в базе хранится правило и только ближайший выпуск"""
+    query = update.callback_query
+    
+    rule, label = SERIES_PRESETS[query.data]
+    user_id = update.effective_user.id
+    scheduled_time = context.user_data['scheduled_time']
+    
+    # Бесплатный лимит считается по posts_today, серия обошла бы его со второго выпуска
+    user = await db.get_user(user_id)
+    if user['tariff'] == 'free':
+        await query.edit_message_text(
+            "❌ Повторяющиеся посты доступны только на платных тарифах.\n\n"
+            "💳 /tariffs - посмотреть тарифы"
+        )
+        return
+    
+    # Серии хранятся по одной на канал
+    for channel_id in context.user_data.get('channel_ids') or [context.user_data['channel_id']]:
+        post_id = await db.add_post_series(
+            user_id=user_id,
+            channel_id=channel_id,
+            content_type=context.user_data['content_type'],
+            content=context.user_data['text'],
+            media_id=context.user_data['media_id'],
+            rule=rule,
+            start_time=scheduled_time,
+            count=RecurrenceRule.parse(rule).count
+        )
+        dispatcher.schedule(post_id, scheduled_time)
+    
+    await db.increment_posts_today(user_id)
+    
+    await query.edit_message_text(
+        f"🔁 **Серия постов создана!**\n\n"
+        f"⏰ Первый выпуск: {scheduled_time.strftime('%Y.%m.%d %H:%M')}\n"
+        f"📆 Повтор: {label}\n"
+        f"📢 Канал: {channels_label(context.user_data)}\n\n"
+        f"Остановить серию: /series"
+    )
+
+async def series_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /series - активные серии пользователя"""
+    series = await db.get_user_series(update.effective_user.id)
+    if not series:
+        await update.message.reply_text("📭 У вас нет повторяющихся постов.")
+        return
+    
+    text = "🔁 **Ваши серии постов:**\n\n"
+    buttons = []
+    for item in series:
+        preview = item['content'][:40] + "..." if len(item['content'] or '') > 40 else item['content']
+        text += f"#{item['id']} {item['channel_id']} - {item['rule']}\n"
+        text += f"   Следующий: {datetime.fromisoformat(item['next_time']).strftime('%Y.%m.%d %H:%M')}\n"
+        text += f"   📝 {preview}\n\n"
+        buttons.append([{'text': f"⏹ Остановить #{item['id']}",
+                         'callback': callback_codec.encode('ss', series_id=item['id'])}])
+    
+    await update.message.reply_text(text, reply_markup=create_keyboard(buttons))
+
+async def stop_series_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Остановка серии кнопкой из /series"""
+    query = update.callback_query
+    
+    payload = callback_codec.decode(query.data)
+    if payload is None:
+        await query.edit_message_text("⌛ Кнопка устарела. Откройте список заново: /series")
+        return
+    
+    if await db.stop_series(payload['series_id'], update.effective_user.id):
+        await query.edit_message_text(f"⏹ Серия #{payload['series_id']} остановлена.")
+    else:
+        await query.edit_message_text("❌ Серия не найдена или уже остановлена.")
+
+# ========== МАССОВЫЙ ИМПОРТ ==========
+BULK_IMPORT_TYPES = {'text', 'photo', 'video'}
+BULK_IMPORT_TIME_FORMATS = ("%Y.%m.%d %H:%M", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S")
+
+def parse_import_rows(data: bytes, filename: str):
+    """Строки файла импорта по одной: (номер строки, dict). CSV читается потоково"""
+    if filename.lower().endswith('.json'):
+        items = orjson.loads(data) if orjson else json.loads(data)
+        if not isinstance(items, list):
+            raise ValueError("JSON должен быть массивом объектов")
+        for number, item in enumerate(items, 1):
+            yield number, item
+        return
+    
+    reader = csv.DictReader(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', newline=''))
+    for row in reader:
+        yield reader.line_num, row
+
+def validate_import_row(row, channels: set, now: datetime) -> Dict:
+    """Проверка одной строки импорта; ValueError с причиной"""
+    if not isinstance(row, dict):
+        raise ValueError("ожидается объект")
+    channel_id = str(row.get('channel_id') or '').strip()
+    if channel_id not in channels:
+        raise ValueError(f"канал {channel_id or '(пусто)'} не добавлен")
+    
+    raw_time = str(row.get('scheduled_time') or '').strip()
+    for time_format in BULK_IMPORT_TIME_FORMATS:
+        try:
+            scheduled_time = datetime.strptime(raw_time, time_format)
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError(f"неверное время '{raw_time}', нужно ГГГГ.ММ.ДД ЧЧ:ММ")
+    if scheduled_time < now:
+        raise ValueError("время в прошлом")
+    
+    content_type = str(row.get('content_type') or 'text').strip()
+    if content_type not in BULK_IMPORT_TYPES:
+        raise ValueError(f"неизвестный тип '{content_type}'")
+    media_id = str(row.get('media_id') or '').strip() or None
+    if content_type != 'text' and not media_id:
+        raise ValueError("для фото и видео нужен media_id")
+    text = str(row.get('text') or '')
+    if content_type == 'text' and not text.strip():
+        raise ValueError("пустой текст")
+    if len(text) > (4096 if content_type == 'text' else 1024):
+        raise ValueError("слишком длинный текст")
+    
+    return {'channel_id': channel_id, 'scheduled_time': scheduled_time,
+            'content_type': content_type, 'text': text, 'media_id': media_id}
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /import - формат файла для массового планирования"""
+    await update.message.reply_text(
+        "📥 **Массовое планирование**\n\n"
+        "Отправьте файл .csv или .json со столбцами:\n"
+        "• channel_id - ID добавленного канала\n"
+        "• scheduled_time - ГГГГ.ММ.ДД ЧЧ:ММ\n"
+        "• text - текст поста\n"
+        "• content_type - text, photo или video (необязательно)\n"
+        "• media_id - file_id фото или видео\n\n"
+        f"До {BULK_IMPORT_MAX_ROWS} постов в файле. "
+        "Файл загружается целиком или не загружается совсем."
+    )
+
+async def handle_bulk_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Импорт календаря постов из CSV/JSON документа"""
+    document = update.message.document
+    user_id = update.effective_user.id
+    
+    if document.file_size and document.file_size > BULK_IMPORT_MAX_BYTES:
+        await update.message.reply_text(f"❌ Файл больше {BULK_IMPORT_MAX_BYTES // 1024} КБ.")
+        return
+    
+    user = await db.get_user(user_id)
+    channels = {channel['channel_id'] for channel in await db.get_user_channels(user_id)}
+    if user is None or not channels:
+        await update.message.reply_text(
+            "❌ У вас нет добавленных каналов!\n\n"
+            "✨ **Добавьте канал:**\n"
+            "/add_channel [ID] [Название]"
+        )
+        return
     
-    context.user_data['scheduled_time'] = scheduled_time
+    data = bytes(await (await document.get_file()).download_as_bytearray())
     
-    # Показываем подтверждение
-    keyboard = create_keyboard([
-        [
-            {'text': '✅ Да, запланировать', 'callback': 'confirm_post'},
-            {'text': '❌ Нет, отменить', 'callback': 'cancel'}
-        ]
-    ])
+    # Потоковая проверка: строки разбираются по одной, ошибки копятся до 10
+    now = datetime.now()
+    posts, errors = [], []
+    try:
+        for number, row in parse_import_rows(data, document.file_name or ''):
+            if len(posts) >= BULK_IMPORT_MAX_ROWS:
+                errors.append(f"больше {BULK_IMPORT_MAX_ROWS} постов в файле")
+                break
+            try:
+                posts.append(validate_import_row(row, channels, now))
+            except ValueError as e:
+                errors.append(f"строка {number}: {e}")
+                if len(errors) >= 10:
+                    break
+    except (ValueError, csv.Error, UnicodeDecodeError) as e:
+        errors.append(f"файл не разобран: {e}")
     
-    await query.edit_message_text(
-        f"📋 **Подтверждение публикации**\n\n"
-        f"📢 Канал: {context.user_data['channel_id']}\n"
-        f"📝 Тип: {context.user_data['content_type']}\n"
-        f"⏰ Время: {scheduled_time.strftime('%Y.%m.%d %H:%M')}\n\n"
-        f"✅ **Подтвердить публикацию?**",
-        reply_markup=keyboard
-    )
-
-async def handle_custom_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка пользовательского времени"""
-    if update.message.text == '❌':
-        await update.message.reply_text("❌ Планирование отменено.")
+    if not errors and not posts:
+        errors.append("в файле нет постов")
+    if errors:
+        await update.message.reply_text("❌ **Импорт отклонен:**\n\n" + "\n".join(errors))
         return
     
-    try:
-        scheduled_time = datetime.strptime(update.message.text, "%Y.%m.%d %H:%M")
-        
-        if scheduled_time < datetime.now():
-            await update.message.reply_text("❌ Нельзя планировать в прошлом!")
-            return
-        
-        context.user_data['scheduled_time'] = scheduled_time
-        
-        keyboard = create_keyboard([
-            [
-                {'text': '✅ Да, запланировать', 'callback': 'confirm_post'},
-                {'text': '❌ Нет, отменить', 'callback': 'cancel'}
-            ]
-        ])
-        
-        await update.message.reply_text(
-            f"📋 **Подтверждение публикации**\n\n"
-            f"📢 Канал: {context.user_data['channel_id']}\n"
-            f"📝 Тип: {context.user_data['content_type']}\n"
-            f"⏰ Время: {scheduled_time.strftime('%Y.%m.%d %H:%M')}\n\n"
-            f"✅ **Подтвердить публикацию?**",
-            reply_markup=keyboard
-        )
-    except ValueError:
+    # Лимит тарифа проверяется сразу по всем дням календаря
+    tariff = await db.get_tariff_info(user['tariff'])
+    per_day = {}
+    for post in posts:
+        day = post['scheduled_time'].strftime('%Y-%m-%d')
+        per_day[day] = per_day.get(day, 0) + 1
+    first = min(post['scheduled_time'] for post in posts)
+    last = max(post['scheduled_time'] for post in posts)
+    existing = await db.count_posts_by_day(user_id, first, last)
+    over = [f"{day}: {existing.get(day, 0)} + {count} > {tariff['posts_per_day']}"
+            for day, count in sorted(per_day.items())
+            if existing.get(day, 0) + count > tariff['posts_per_day']]
+    if over:
         await update.message.reply_text(
-            "❌ Неверный формат!\n"
-            "Используйте: ГГГГ.ММ.ДД ЧЧ:ММ\n"
-            "Пример: 2025.12.31 18:30\n\n"
-            "Попробуйте снова или отправьте ❌ для отмены."
+            "❌ **Превышен лимит постов в день по тарифу:**\n\n" + "\n".join(over[:10]) +
+            "\n\n💳 /tariffs - посмотреть тарифы"
         )
-
-async def confirm_post_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Подтверждение поста"""
-    query = update.callback_query
-    await query.answer()
-    
-    if query.data == 'cancel':
-        await query.edit_message_text("❌ Планирование отменено.")
         return
     
-    user_id = update.effective_user.id
-    
-    # Сохраняем пост
-    post_id = await db.add_scheduled_post(
-        user_id=user_id,
-        channel_id=context.user_data['channel_id'],
-        content_type=context.user_data['content_type'],
-        content=context.user_data['text'],
-        media_id=context.user_data['media_id'],
-        scheduled_time=context.user_data['scheduled_time']
-    )
-    
-    # Обновляем счетчик постов
-    conn = await db.connect()
-    today = datetime.now().date().isoformat()
-    await conn.execute('''
-        UPDATE users 
-        SET posts_today = CASE 
-            WHEN last_post_date = date(?) THEN posts_today + 1 
-            ELSE 1 
-        END,
-        last_post_date = date(?)
-        WHERE user_id = ?
-    ''', (today, today, user_id))
-    await conn.commit()
+    count = await db.add_scheduled_posts(user_id, posts)
+    # В posts_today идут только посты на сегодня: будущие дни уже проверены по календарю
+    today_count = per_day.get(now.strftime('%Y-%m-%d'), 0)
+    if today_count:
+        await db.increment_posts_today(user_id, today_count)
+    dispatcher.reload(first)
     
-    await query.edit_message_text(
-        f"✅ **Пост запланирован!**\n\n"
-        f"📝 ID поста: {post_id}\n"
-        f"⏰ Время публикации: {context.user_data['scheduled_time'].strftime('%Y.%m.%d %H:%M')}\n"
-        f"📢 Канал: {context.user_data['channel_id']}\n\n"
-        f"✨ Пост будет опубликован автоматически."
+    await update.message.reply_text(
+        f"✅ **Запланировано постов: {count}**\n\n"
+        f"📅 С {first.strftime('%Y.%m.%d %H:%M')} по {last.strftime('%Y.%m.%d %H:%M')}\n"
+        f"📢 Каналов: {len({post['channel_id'] for post in posts})}"
     )
 
 # ========== АДМИН КОМАНДЫ ==========
@@ -775,19 +2871,13 @@ Basic: {stats['tariff_stats'].get('basic', 0)}
 Постов/день: {tariff['posts_per_day']}
     """
     
-    keyboard = create_keyboard([
-        [{'text': '💰 Изменить цену', 'callback': 'admin_set_price'}],
-        [{'text': '🔗 Настроить канал', 'callback': 'admin_set_channel'}],
-        [{'text': '📊 Статистика', 'callback': 'admin_stats'}],
-        [{'text': '👥 Все пользователи', 'callback': 'admin_users'}]
-    ])
+    keyboard = keyboards.get('admin')
     
     await update.message.reply_text(text, reply_markup=keyboard)
 
 async def admin_set_price_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Настройка цены"""
     query = update.callback_query
-    await query.answer()
     
     tariff = await db.get_tariff_info('basic')
     
@@ -802,7 +2892,6 @@ async def admin_set_price_callback(update: Update, context: ContextTypes.DEFAULT
 async def admin_set_channel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Настройка приватного канала"""
     query = update.callback_query
-    await query.answer()
     
     private_channel = await db.get_private_channel('basic')
     
@@ -887,7 +2976,6 @@ async def handle_admin_channel(update: Update, context: ContextTypes.DEFAULT_TYP
 async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Статистика"""
     query = update.callback_query
-    await query.answer()
     
     stats = await db.get_statistics()
     
@@ -900,174 +2988,1158 @@ async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 📈 **Распределение по тарифам:**
 Free: {stats['tariff_stats'].get('free', 0)}
 Basic: {stats['tariff_stats'].get('basic', 0)}
+
+📬 **Публикации за сегодня:**
+Опубликовано: {stats['posts_published_today']}
+Не во все каналы: {stats['posts_partial_today']}
+Ошибок: {stats['posts_failed_today']}
     """
     
     await query.edit_message_text(text)
 
+def sparkline(values: List[int]) -> str:
+    """Мини-график из символов ▁..█"""
+    bars = '▁▂▃▄▅▆▇█'
+    top = max(values, default=0)
+    if not top:
+        return bars[0] * len(values)
+    return ''.join(bars[min(len(bars) - 1, value * len(bars) // (top + 1))] for value in values)
+
+async def admin_trends_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Тренды из агрегатов stats_rollup (без чтения исходных таблиц)"""
+    query = update.callback_query
+    
+    now = datetime.utcnow()
+    days = [(now - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(6, -1, -1)]
+    hours = [(now - timedelta(hours=i)).strftime('%Y-%m-%d %H:00') for i in range(23, -1, -1)]
+    
+    daily = {metric: await db.get_rollup(metric, days[0])
+             for metric in ('users', 'payments', 'revenue', 'scheduled', 'published', 'failed')}
+    hourly = await db.get_rollup('published', hours[0], period='hour')
+    failing = await db.get_rollup_top_channels('failed', days[0])
+    
+    text = "📈 **Тренды за 7 дней** (UTC)\n\n"
+    text += "Дата: 👥 новые | 💳 платежи | 📝 запланировано | ✅ опубликовано | ❌ ошибки\n"
+    for day in days:
+        text += (f"{day[5:]}: {daily['users'].get(day, 0)} | {daily['payments'].get(day, 0)} | "
+                 f"{daily['scheduled'].get(day, 0)} | {daily['published'].get(day, 0)} | "
+                 f"{daily['failed'].get(day, 0)}\n")
+    text += f"\n💰 Выручка за 7 дней: {sum(daily['revenue'].values())} звезд\n"
+    text += f"\n✅ Публикации за 24 часа:\n{sparkline([hourly.get(hour, 0) for hour in hours])}\n"
+    
+    if failing:
+        text += "\n⚠️ **Каналы с ошибками:**\n"
+        for channel_id, count in failing:
+            text += f"{channel_id}: {count}\n"
+    
+    await query.edit_message_text(text)
+
 async def admin_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Пользователи"""
     query = update.callback_query
-    await query.answer()
     
-    users = await db.get_all_users()
+    # Первая страница или переход по кнопке au: (ключ крайней строки страницы)
+    cursor = callback_codec.decode(query.data) if query.data != 'admin_users' else None
+    key = (cursor['registered_at'], cursor['user_id']) if cursor else None
+    if cursor and cursor['direction'] == 'prev':
+        users, has_more = await db.get_users_page(ADMIN_USERS_PAGE_SIZE, before=key)
+        has_newer, has_older = has_more, True
+    else:
+        users, has_more = await db.get_users_page(ADMIN_USERS_PAGE_SIZE, after=key)
+        has_newer, has_older = key is not None, has_more
     
     if not users:
         await query.edit_message_text("📭 Пользователей нет.")
         return
     
-    text = "👥 **Последние пользователи:**\n\n"
-    for user in users[:10]:  # Показываем первых 10
+    total = (await db.get_statistics())['total_users']
+    text = f"👥 **Пользователи** (всего: {total})\n\n"
+    for user in users:
         text += f"👤 {user['first_name']} (@{user['username'] or 'нет'})\n"
         text += f"   ID: {user['user_id']}\n"
         text += f"   Тариф: {user['tariff']}\n"
         text += f"   Каналов: {user['channels_count']}\n"
         text += f"   Регистрация: {user['registered_at'][:10]}\n\n"
     
-    if len(users) > 10:
-        text += f"\n... и еще {len(users) - 10} пользователей"
+    navigation = []
+    if has_newer:
+        first = users[0]
+        navigation.append({'text': '⬅️ Новее', 'callback': callback_codec.encode(
+            'au', direction='prev', registered_at=first['registered_at'], user_id=first['user_id'])})
+    if has_older:
+        last = users[-1]
+        navigation.append({'text': 'Старше ➡️', 'callback': callback_codec.encode(
+            'au', direction='next', registered_at=last['registered_at'], user_id=last['user_id'])})
     
-    await query.edit_message_text(text)
+    keyboard = create_keyboard([navigation]) if navigation else None
+    await query.edit_message_text(text, reply_markup=keyboard)
 
 # ========== ПУБЛИКАЦИЯ ПОСТОВ ==========
-async def publish_scheduled_posts(context: ContextTypes.DEFAULT_TYPE):
-    """Публикация запланированных постов"""
-    posts = await db.get_pending_posts()
+async def send_post(bot, post: Dict):
+    """Отправка поста в канал, возвращает отправленное сообщение (альбом - кортеж сообщений)"""
+    if post.get('copy_from'):
+        # Копия уже опубликованного сообщения: без повторной загрузки и разбора контента
+        from_chat_id, message_id = post['copy_from']
+        return await bot.copy_message(
+            chat_id=post['channel_id'],
+            from_chat_id=from_chat_id,
+            message_id=message_id
+        )
+    if post['content_type'] == 'photo':
+        return await bot.send_photo(
+            chat_id=post['channel_id'],
+            photo=post['media_id'],
+            caption=post['content']
+        )
+    elif post['content_type'] == 'video':
+        return await bot.send_video(
+            chat_id=post['channel_id'],
+            video=post['media_id'],
+            caption=post['content']
+        )
+    elif post['content_type'] == 'album':
+        # Весь альбом одним вызовом; подпись альбома - подпись первого элемента
+        media = []
+        for index, (kind, file_id) in enumerate(json.loads(post['media_id'])):
+            media_class = InputMediaPhoto if kind == 'photo' else InputMediaVideo
+            media.append(media_class(media=file_id, caption=post['content'] if index == 0 else None))
+        return await bot.send_media_group(
+            chat_id=post['channel_id'],
+            media=media
+        )
+    else:
+        return await bot.send_message(
+            chat_id=post['channel_id'],
+            text=post['content']
+        )
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity"""
     
-    for post in posts:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self) -> float:
+        """Сколько секунд ждать до следующего токена (0 - можно сейчас)"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(self.blocked_until - now, 0.0)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+    
+    def consume(self):
+        self.tokens -= 1
+    
+    def block(self, seconds: float):
+        """Блокировка корзины (ответ RetryAfter от Telegram)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+    
+    def is_idle(self) -> bool:
+        return self.delay() == 0 and self.tokens >= self.capacity
+    
+    async def acquire(self):
+        while True:
+            wait = self.delay()
+            if wait <= 0:
+                self.consume()
+                return
+            await asyncio.sleep(wait)
+
+class CircuitBreaker:
+    """Размыкатель канала: после threshold ошибок подряд канал закрыт на cooldown
+    секунд, затем пропускается одна пробная отправка. Успех замыкает цепь.
+    """
+    
+    def __init__(self, threshold: int = CIRCUIT_FAILURE_THRESHOLD, cooldown: float = CIRCUIT_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+    
+    def allow(self) -> bool:
+        if self.failures < self.threshold:
+            return True
+        if time.monotonic() < self.open_until or self.probing:
+            return False
+        self.probing = True
+        return True
+    
+    def allow_peek(self) -> bool:
+        """allow() без захвата пробной отправки"""
+        return self.failures < self.threshold or (time.monotonic() >= self.open_until and not self.probing)
+    
+    def release(self):
+        """Пробная отправка завершилась без ошибки канала (успех, flood control, ошибка поста)"""
+        self.probing = False
+    
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold:
+            self.open_until = time.monotonic() + self.cooldown
+    
+    def retry_in(self) -> float:
+        """Через сколько секунд стоит попробовать снова"""
+        return max(self.open_until - time.monotonic(), 1.0)
+
+def classify_publish_error(error: Exception) -> str:
+    """rate_limited - flood control, permanent - повтор не поможет, retryable - временный сбой"""
+    if isinstance(error, RetryAfter):
+        return 'rate_limited'
+    # BadRequest наследует NetworkError, поэтому проверяется раньше
+    if isinstance(error, (BadRequest, Forbidden, ChatMigrated, InvalidToken)):
+        return 'permanent'
+    # Таймауты и обрывы соединения; прочие ответы API повтором не исправить
+    if isinstance(error, NetworkError):
+        return 'retryable'
+    if isinstance(error, TelegramError):
+        return 'permanent'
+    return 'retryable'
+
+def is_chat_failure(error: Exception) -> bool:
+    """Ошибка канала, а не конкретного поста или сети (для размыкателя)"""
+    if isinstance(error, (Forbidden, ChatMigrated)):
+        return True
+    return isinstance(error, BadRequest) and 'chat' in str(error).lower()
+
+def retry_delay(attempt: int) -> float:
+    """Экспоненциальная задержка перед повтором attempt (с 1) с джиттером в половину задержки"""
+    delay = min(PUBLISH_RETRY_MAX_DELAY, PUBLISH_RETRY_BASE * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class RateLimiter:
+    """Глобальный лимит бота и лимиты по каждому каналу"""
+    
+    def __init__(self, global_rate: float = GLOBAL_RATE_LIMIT, chat_per_minute: float = CHAT_RATE_LIMIT,
+                 max_chats: int = 10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_per_minute / 60
+        self.chat_capacity = chat_per_minute
+        self.max_chats = max_chats
+        self.chats: Dict[str, TokenBucket] = {}
+    
+    def chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.max_chats:
+                # Полные корзины ничего не помнят, их можно выбросить
+                self.chats = {key: b for key, b in self.chats.items() if not b.is_idle()}
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_capacity)
+        return bucket
+
+class PublishPipeline:
+    """Пул воркеров для параллельной публикации с учетом лимитов Telegram.
+    
+    Пост, чей канал исчерпал лимит, откладывается обратно в очередь,
+    а воркер берет следующий - один загруженный канал не тормозит остальные.
+    
+    Пост с fanout > 0 сначала уходит в основной канал, затем в остальные
+    каналы ставятся копии (copy_message основного сообщения). Каждая копия
+    проходит через лимиты своего канала и общий лимит как отдельная задача.
+    id основного сообщения сохраняется сразу после отправки, поэтому пост,
+    захваченный заново после падения процесса, рассылает только копии.
+    Если пост вышел не во все каналы, его статус - 'partial'. Пока канал
+    какой-то копии потерян (копия paused), пост тоже ждет в статусе paused.
+    
+    Ошибки классифицируются: короткий flood control ждется в памяти,
+    временные сбои возвращают пост в базу со статусом 'retry' и
+    экспоненциальной задержкой, постоянные ошибки и исчерпанные попытки
+    попадают в dead_letters. Каналы, которые падают раз за разом,
+    отключаются размыкателем на CIRCUIT_COOLDOWN секунд.
+    """
+    
+    def __init__(self, database: Database, workers: int = PUBLISH_WORKERS,
+                 limiter: Optional[RateLimiter] = None):
+        self.db = database
+        self.workers_count = workers
+        self.limiter = limiter or RateLimiter()
+        self.bot = None
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+        self._waiting: Dict[str, deque] = {}
+        self._fanouts = set()
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.lag = metrics.histogram('bot_publish_lag_seconds', 'Задержка публикации относительно scheduled_time',
+                                     LAG_BUCKETS)
+    
+    def start(self, bot):
+        """Запуск воркеров"""
+        self.bot = bot
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+    
+    async def stop(self):
+        """Остановка воркеров"""
+        for task in [*self._workers, *self._fanouts]:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._fanouts, return_exceptions=True)
+        self._workers = []
+    
+    @property
+    def depth(self) -> int:
+        """Посты в очереди, включая отложенные лимитами каналов"""
+        return self.queue.qsize() + sum(len(waiting) for waiting in self._waiting.values())
+    
+    @property
+    def open_circuits(self) -> int:
+        """Каналы с разомкнутым размыкателем"""
+        return sum(not breaker.allow_peek() for breaker in self.breakers.values())
+    
+    def submit(self, posts: List[Dict]) -> List[asyncio.Future]:
+        """Постановка постов в очередь, возвращает future на каждый пост"""
+        loop = asyncio.get_running_loop()
+        futures = []
+        for post in posts:
+            future = loop.create_future()
+            self.queue.put_nowait((post, future, 0, False))
+            futures.append(future)
+        return futures
+    
+    def _defer(self, item):
+        """Откладываем пост до освобождения лимита канала"""
+        chat_id = item[0]['channel_id']
+        waiting = self._waiting.get(chat_id)
+        if waiting is None:
+            waiting = self._waiting[chat_id] = deque()
+            self._schedule_release(chat_id)
+        waiting.append(item)
+    
+    def _schedule_release(self, chat_id: str):
+        delay = self.limiter.chat_bucket(chat_id).delay()
+        asyncio.get_running_loop().call_later(delay, self._release, chat_id)
+    
+    def _release(self, chat_id: str):
+        """Возвращаем в очередь по одному посту на каждый токен канала"""
+        bucket = self.limiter.chat_bucket(chat_id)
+        waiting = self._waiting[chat_id]
+        if bucket.delay() <= 0:
+            bucket.consume()
+            post, future, attempts, _ = waiting.popleft()
+            self.queue.put_nowait((post, future, attempts, True))
+        if waiting:
+            self._schedule_release(chat_id)
+        else:
+            del self._waiting[chat_id]
+    
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                await self._process(item)
+            except Exception as e:
+                logger.error(f"Ошибка воркера публикации: {e}")
+            finally:
+                self.queue.task_done()
+    
+    async def _process(self, item):
+        post, future, attempts, has_chat_token = item
+        chat_id = post['channel_id']
+        fanout = post.get('fanout') and 'fanout_of' not in post
+        
+        if fanout and post.get('message_id'):
+            # Основной канал получил пост до перезапуска - досылаем только копии
+            await self._fan_out(post, future)
+            return
+        
+        if not has_chat_token:
+            chat_bucket = self.limiter.chat_bucket(chat_id)
+            if chat_id in self._waiting or chat_bucket.delay() > 0:
+                self._defer(item)
+                return
+            chat_bucket.consume()
+        await self.limiter.global_bucket.acquire()
+        
+        # Проверяем после лимитов: отложенный лимитом пост не должен занимать пробную отправку
+        breaker = self.breakers.get(chat_id)
+        if breaker is not None and not breaker.allow():
+            # Канал стабильно падает - не тратим на него запросы до конца паузы
+            await self._retry(post, future, attempts, breaker.retry_in(), 'circuit_open',
+                              f"канал {chat_id} временно отключен", count_attempt=False)
+            return
+        
         try:
-            if post['content_type'] == 'photo':
-                await context.bot.send_photo(
-                    chat_id=post['channel_id'],
-                    photo=post['media_id'],
-                    caption=post['content']
-                )
-            elif post['content_type'] == 'video':
-                await context.bot.send_video(
-                    chat_id=post['channel_id'],
-                    video=post['media_id'],
-                    caption=post['content']
-                )
+            message = await send_post(self.bot, post)
+        except Exception as e:
+            if breaker is not None and not is_chat_failure(e):
+                breaker.release()
+            await self._failed(post, future, attempts, e, fanout)
+            return
+        self.breakers.pop(chat_id, None)
+        if not fanout:
+            await self._finish(post, future, 'published')
+            return
+        # Альбом - кортеж сообщений, сохраняем первое
+        message_id = (message[0] if isinstance(message, tuple) else message).message_id
+        await self.db.set_post_message(post['id'], message_id)
+        await self._fan_out(dict(post, message_id=message_id), future)
+    
+    async def _failed(self, post: Dict, future: asyncio.Future, attempts: int, error: Exception, fanout: bool):
+        """Разбор ошибки отправки: повтор в памяти, повтор через базу или dead letter"""
+        chat_id = post['channel_id']
+        kind = classify_publish_error(error)
+        if is_chat_failure(error):
+            self.breakers.setdefault(chat_id, CircuitBreaker()).record_failure()
+        
+        # Копии считают попытки в памяти, посты - в базе (attempts переживает перезапуск)
+        tries = attempts + 1 if 'fanout_of' in post else (post.get('attempts') or 0) + 1
+        if kind == 'rate_limited':
+            self.limiter.chat_bucket(chat_id).block(error.retry_after)
+            if error.retry_after <= PUBLISH_INLINE_RETRY_AFTER and attempts + 1 < PUBLISH_MAX_RETRIES:
+                logger.warning(f"Flood control для поста {post['id']}, повтор через {error.retry_after} с")
+                self._defer((post, future, attempts + 1, False))
+                return
+            delay = error.retry_after + random.uniform(0, 1)
+        else:
+            delay = retry_delay(tries)
+        
+        if kind == 'permanent' or tries >= PUBLISH_MAX_RETRIES:
+            metrics.counter('bot_dead_letters_total', 'Недоставленные посты и копии', error_class=kind).inc()
+            await self.db.add_dead_letter(post.get('fanout_of', post['id']), chat_id, kind, str(error), tries)
+            await (self._fan_out(post, future, error) if fanout else self._finish(post, future, 'failed', error))
+            return
+        await self._retry(post, future, attempts, delay, kind, str(error))
+    
+    async def _retry(self, post: Dict, future: asyncio.Future, attempts: int, delay: float,
+                     kind: str, error: str, count_attempt: bool = True):
+        """Повтор через delay секунд; kind 'circuit_open' считается отдельно от повторов после ошибок"""
+        status = kind if kind == 'circuit_open' else 'retry'
+        metrics.counter('bot_publish_total', 'Итоги попыток публикации', status=status).inc()
+        if 'fanout_of' in post:
+            # Копия повторяется в памяти: основной пост уже вышел и ждет копии
+            asyncio.get_running_loop().call_later(
+                delay, self.queue.put_nowait, (post, future, attempts + int(count_attempt), False))
+            return
+        
+        next_attempt_at = datetime.now() + timedelta(seconds=delay)
+        if await self.db.schedule_retry(post['id'], next_attempt_at, f"{kind}: {error}",
+                                        post.get('worker_id'), count_attempt):
+            logger.warning(f"Пост {post['id']} ({kind}: {error}), повтор в {next_attempt_at:%H:%M:%S}")
+            dispatcher.schedule(post['id'], next_attempt_at)
+        else:
+            logger.warning(f"Аренда поста {post['id']} истекла до завершения публикации")
+        if not future.done():
+            future.set_result('retry')
+    
+    async def _fan_out(self, post: Dict, future: asyncio.Future, error: Exception = None):
+        """Копии поста в остальные каналы после отправки в основной"""
+        if error:
+            logger.error(f"Ошибка публикации поста {post['id']} в основной канал {post['channel_id']}: {error}")
+        # Альбом и неудачная основная отправка - отправляем заново по file_id
+        copy_from = None
+        if post.get('message_id') and post['content_type'] != 'album':
+            copy_from = (post['channel_id'], post['message_id'])
+        
+        loop = asyncio.get_running_loop()
+        copies = []
+        for channel_id in await self.db.get_pending_targets(post['id']):
+            copy_future = loop.create_future()
+            copy = dict(post, channel_id=channel_id, fanout_of=post['id'], copy_from=copy_from)
+            self.queue.put_nowait((copy, copy_future, 0, False))
+            copies.append(copy_future)
+        
+        task = asyncio.create_task(self._finish_fan_out(post, future, 'failed' if error else 'published', copies))
+        self._fanouts.add(task)
+        task.add_done_callback(self._fanouts.discard)
+    
+    async def _finish_fan_out(self, post: Dict, future: asyncio.Future, status: str, copies: List[asyncio.Future]):
+        # Итоги по каналам - в post_targets и message_id, у поста - сводный статус
+        await asyncio.gather(*copies)
+        targets = await self.db.get_target_statuses(post['id'])
+        if 'paused' in targets:
+            # Копия ждет канал с потерянными правами: set_channel_status вернет пост в pending
+            if await self.db.update_post_status(post['id'], 'paused', post.get('worker_id')):
+                logger.info(f"Пост {post['id']} ждет восстановления прав в каналах копий")
             else:
-                await context.bot.send_message(
-                    chat_id=post['channel_id'],
-                    text=post['content']
-                )
-            
-            await db.update_post_status(post['id'], 'published')
+                logger.warning(f"Аренда поста {post['id']} истекла до завершения публикации")
+            if not future.done():
+                future.set_result('paused')
+            return
+        statuses = {status, *targets}
+        await self._finish(post, future, statuses.pop() if len(statuses) == 1 else 'partial')
+    
+    async def _finish(self, post: Dict, future: asyncio.Future, status: str, error: Exception = None):
+        metrics.counter('bot_publish_total', 'Итоги попыток публикации', status=status).inc()
+        if status in ('published', 'partial'):
+            self.lag.observe((datetime.now() - datetime.fromisoformat(post['scheduled_time'])).total_seconds())
+        if 'fanout_of' in post:
+            await self.db.update_target_status(post['fanout_of'], post['channel_id'], status)
+        elif not await self.db.update_post_status(post['id'], status, post.get('worker_id')):
+            logger.warning(f"Аренда поста {post['id']} истекла до завершения публикации")
+        if error:
+            logger.error(f"Ошибка публикации поста {post['id']}: {error}")
+        elif status == 'partial':
+            logger.warning(f"Пост {post['id']} опубликован не во все каналы")
+        else:
             logger.info(f"Опубликован пост {post['id']} в канале {post['channel_id']}")
+        if not future.done():
+            future.set_result(status)
+
+publish_pipeline = PublishPipeline(db)
+metrics.gauge('bot_queue_depth', 'Глубина очередей', lambda: publish_pipeline.depth, queue='publish')
+metrics.gauge('bot_open_circuits', 'Каналы с разомкнутым размыкателем', lambda: publish_pipeline.open_circuits)
+
+async def publish_scheduled_posts(posts: List[Dict]) -> List[str]:
+    """Публикация запланированных постов, возвращает статусы"""
+    return await asyncio.gather(*publish_pipeline.submit(posts))
+
+# ========== ДИСПЕТЧЕР ПУБЛИКАЦИЙ ==========
+class PostDispatcher:
+    """Таймер публикаций: куча постов, упорядоченная по scheduled_time.
+    
+    Вместо опроса базы раз в минуту диспетчер держит в памяти посты,
+    которые должны выйти в ближайшем окне (horizon), и спит ровно до
+    следующего поста. Новые посты добавляются через schedule() без
+    обращения к базе. База читается только при сдвиге окна.
+    
+    Перед отправкой посты атомарно захватываются (status = 'in_flight')
+    с арендой на lease секунд, поэтому несколько процессов могут делить
+    одну таблицу. Раз в треть срока аренды диспетчер продлевает свои
+    аренды и забирает посты с истекшей арендой.
+    """
+    
+    def __init__(self, database: Database, horizon: timedelta = timedelta(hours=1),
+                 batch_size: int = 500, worker_id: str = WORKER_ID,
+                 lease: timedelta = timedelta(seconds=POST_LEASE_SECONDS)):
+        self.db = database
+        self.horizon = horizon
+        self.batch_size = batch_size
+        self.worker_id = worker_id
+        self.lease = lease
+        self._next_sweep: Optional[datetime] = None
+        self._heap: List[Tuple[datetime, int]] = []
+        self._scheduled = set()
+        self._horizon_end: Optional[datetime] = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._publish_tasks = set()
+    
+    def start(self):
+        """Запуск диспетчера"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Остановка диспетчера"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._publish_tasks:
+            await asyncio.gather(*self._publish_tasks, return_exceptions=True)
+    
+    @property
+    def depth(self) -> int:
+        """Посты в окне диспетчера"""
+        return len(self._heap)
+    
+    def schedule(self, post_id: int, scheduled_time: datetime):
+        """Добавление поста в очередь (без запроса к базе)"""
+        # Посты за пределами окна подхватятся при следующей загрузке
+        if self._horizon_end is None or scheduled_time > self._horizon_end:
+            return
+        self._push(post_id, scheduled_time)
+        self._wakeup.set()
+    
+    def reload(self, earliest: datetime):
+        """Перечитать окно из базы после массовой вставки (id постов неизвестны)"""
+        if self._horizon_end is None or earliest > self._horizon_end:
+            return
+        self._horizon_end = None
+        self._wakeup.set()
+    
+    def _push(self, post_id: int, scheduled_time: datetime):
+        if post_id in self._scheduled:
+            return
+        self._scheduled.add(post_id)
+        heapq.heappush(self._heap, (scheduled_time, post_id))
+    
+    async def _reload(self, now: datetime):
+        """Загрузка постов ближайшего окна из базы"""
+        self._horizon_end = now + self.horizon
+        for post in await self.db.get_pending_posts(self._horizon_end):
+            self._push(post['id'], datetime.fromisoformat(post['scheduled_time']))
+        logger.info(f"Диспетчер: в очереди {len(self._heap)} постов до {self._horizon_end:%H:%M:%S}")
+    
+    def _pop_due(self, now: datetime) -> List[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, post_id = heapq.heappop(self._heap)
+            self._scheduled.discard(post_id)
+            due.append(post_id)
+        return due
+    
+    async def _publish(self, post_ids: List[int]):
+        posts = []
+        lease_until = datetime.now() + self.lease
+        for i in range(0, len(post_ids), self.batch_size):
+            batch = post_ids[i:i + self.batch_size]
+            posts.extend(await self.db.claim_posts(batch, self.worker_id, lease_until))
+        await publish_scheduled_posts(posts)
+        await self._expand({post['series_id'] for post in posts if post.get('series_id')})
+    
+    async def _sweep(self):
+        """Продление своих аренд и захват брошенных постов"""
+        lease_until = datetime.now() + self.lease
+        await self.db.renew_leases(self.worker_id, lease_until)
+        posts = []
+        while True:
+            batch = await self.db.claim_due_posts(self.worker_id, lease_until, self.batch_size)
+            posts.extend(batch)
+            if len(batch) < self.batch_size:
+                break
+        if posts:
+            logger.info(f"Диспетчер: захвачено {len(posts)} просроченных постов")
+            await publish_scheduled_posts(posts)
+        await self._expand({post['series_id'] for post in posts if post.get('series_id')} |
+                           set(await self.db.get_stalled_series()))
+    
+    async def _expand(self, series_ids):
+        """Создание следующего выпуска серий, текущий выпуск которых уже отработал"""
+        now = datetime.now()
+        for series_id in series_ids:
+            series = await self.db.get_series(series_id)
+            if series is None or series['status'] != 'active':
+                continue
+            try:
+                rule = RecurrenceRule.parse(series['rule'])
+            except ValueError as e:
+                logger.error(f"Серия {series_id}: неверное правило {series['rule']}: {e}")
+                await self.db.finish_series(series_id)
+                continue
             
+            # Выпуски, пропущенные пока бот не работал, не догоняем
+            current = datetime.fromisoformat(series['next_time'])
+            next_time = rule.next_after(max(current, now), datetime.fromisoformat(series['start_time']))
+            if next_time is None or series['remaining'] == 0:
+                await self.db.finish_series(series_id)
+                continue
+            
+            # Выпуски идут в лимит постов тарифа наравне с обычными постами
+            user = await self.db.get_user(series['user_id'])
+            tariff = await self.db.get_tariff_info(user['tariff'] if user else 'free')
+            day = next_time.strftime('%Y-%m-%d')
+            planned = await self.db.count_posts_by_day(series['user_id'], next_time, next_time)
+            if planned.get(day, 0) >= tariff['posts_per_day']:
+                logger.info(f"Серия {series_id}: лимит постов на {day} исчерпан, выпуск {next_time} пропущен")
+                await self.db.skip_series_issue(series_id, series['next_time'], next_time)
+                continue
+            
+            post_id = await self.db.advance_series(series_id, series['next_time'], next_time)
+            if post_id:
+                self.schedule(post_id, next_time)
+                if next_time.date() == now.date():
+                    await self.db.increment_posts_today(series['user_id'])
+    
+    def _spawn(self, coro):
+        # Публикуем в фоне, чтобы таймер не отставал
+        task = asyncio.create_task(coro)
+        self._publish_tasks.add(task)
+        task.add_done_callback(self._publish_tasks.discard)
+    
+    async def _run(self):
+        while True:
+            try:
+                self._wakeup.clear()
+                now = datetime.now()
+                
+                if self._horizon_end is None or now >= self._horizon_end:
+                    await self._reload(now)
+                
+                if self._next_sweep is None or now >= self._next_sweep:
+                    self._next_sweep = now + self.lease / 3
+                    self._spawn(self._sweep())
+                
+                due = self._pop_due(now)
+                if due:
+                    self._spawn(self._publish(due))
+                    continue
+                
+                next_at = min(self._horizon_end, self._next_sweep)
+                if self._heap and self._heap[0][0] < next_at:
+                    next_at = self._heap[0][0]
+                timeout = max((next_at - datetime.now()).total_seconds(), 0)
+                
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка диспетчера публикаций: {e}")
+                await asyncio.sleep(1)
+
+dispatcher = PostDispatcher(db)
+metrics.gauge('bot_queue_depth', 'Глубина очередей', lambda: dispatcher.depth, queue='dispatcher')
+
+# ========== ФОНОВАЯ СТАТИСТИКА ==========
+async def reconcile_statistics_loop(interval: float = STATS_RECONCILE_INTERVAL):
+    """Периодическая сверка счетчиков статистики с таблицами"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            drift = await db.reconcile_statistics()
+            if drift:
+                logger.warning(f"Сверка статистики исправила счетчики: {drift}")
+        except Exception as e:
+            logger.error(f"Ошибка сверки статистики: {e}")
+
+async def rollup_statistics(database: Database = db, chunk_hours: int = STATS_ROLLUP_CHUNK_HOURS):
+    """Досчет агрегатов от последнего посчитанного часа до текущего (его пересчитываем заново)"""
+    end = datetime.utcnow().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    start = await database.rollup_watermark() or end - timedelta(hours=1)
+    while start < end:
+        chunk_end = min(start + timedelta(hours=chunk_hours), end)
+        await database.rollup_statistics(start, chunk_end)
+        start = chunk_end
+
+async def rollup_statistics_loop(interval: float = STATS_ROLLUP_INTERVAL):
+    """Периодическое обновление почасовых и дневных агрегатов"""
+    while True:
+        try:
+            await rollup_statistics()
         except Exception as e:
-            logger.error(f"Ошибка публикации поста {post['id']}: {e}")
-            await db.update_post_status(post['id'], 'failed')
+            logger.error(f"Ошибка агрегации статистики: {e}")
+        await asyncio.sleep(interval)
+
+# Ссылки на фоновые задачи: без них задачу может собрать сборщик мусора
+statistics_tasks: List[asyncio.Task] = []
+
+def _log_task_exit(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.error(f"Фоновая задача {task.get_name()} упала: {task.exception()!r}")
+
+def start_statistics_tasks():
+    """Запуск сверки и агрегации статистики"""
+    if statistics_tasks:
+        return
+    for loop in (reconcile_statistics_loop, rollup_statistics_loop):
+        task = asyncio.create_task(loop(), name=loop.__name__)
+        task.add_done_callback(_log_task_exit)
+        statistics_tasks.append(task)
+
+# ========== ПРАВА В КАНАЛАХ ==========
+class ChannelPermissionMonitor:
+    """Фоновая проверка прав бота во всех каналах из user_channels.
+    
+    Каналы читаются пачками по id, get_chat_member ограничен rate запросами
+    в секунду. Канал, где бот потерял права, помечается 'lost', а его
+    ожидающие посты - 'paused', чтобы публикатор не тратил на них отправки.
+    Когда права возвращаются, посты снова становятся 'pending'.
+    """
+    
+    def __init__(self, database: Database, interval: float = ADMIN_CHECK_INTERVAL,
+                 batch_size: int = ADMIN_CHECK_BATCH, rate: float = ADMIN_CHECK_RATE):
+        self.db = database
+        self.interval = interval
+        self.batch_size = batch_size
+        self.bucket = TokenBucket(rate, max(1.0, rate))
+        self.bot = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self, bot):
+        """Запуск фоновых обходов"""
+        self.bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Остановка фоновых обходов"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            try:
+                result = await self.check_all()
+                logger.info(f"Проверка прав в каналах: {result}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка проверки прав в каналах: {e}")
+            await asyncio.sleep(self.interval)
+    
+    async def check_all(self) -> Dict[str, int]:
+        """Один обход всех каналов"""
+        checked: Dict[str, Optional[bool]] = {}
+        lost = restored = 0
+        after_id = 0
+        while True:
+            batch = await self.db.get_channels_batch(after_id, self.batch_size)
+            if not batch:
+                break
+            after_id = batch[-1]['id']
+            
+            # Один канал может быть у нескольких пользователей - проверяем его один раз
+            statuses = {}
+            for row in batch:
+                statuses.setdefault(row['channel_id'], row['status'])
+            for channel_id, status in statuses.items():
+                if channel_id in checked:
+                    continue
+                await self.bucket.acquire()
+                is_admin = checked[channel_id] = await fetch_admin_status(self.bot, channel_id, self.bot.id)
+                if is_admin is False and status != 'lost':
+                    await self._set_status(channel_id, 'lost')
+                    lost += 1
+                elif is_admin and status == 'lost':
+                    await self._set_status(channel_id, 'active')
+                    restored += 1
+            await self.db.mark_channels_checked([channel_id for channel_id in statuses
+                                                 if checked.get(channel_id) is not None])
+            if len(batch) < self.batch_size:
+                break
+        return {'checked': len(checked), 'lost': lost, 'restored': restored}
+    
+    async def _set_status(self, channel_id: str, status: str):
+        owners = await self.db.set_channel_status(channel_id, status)
+        if status == 'lost':
+            logger.warning(f"Бот потерял права в канале {channel_id}, посты приостановлены")
+            text = (f"⚠️ Бот больше не может публиковать в канале {channel_id}.\n\n"
+                    f"Запланированные посты приостановлены. Верните боту права администратора "
+                    f"с публикацией сообщений - посты возобновятся автоматически.")
+        else:
+            logger.info(f"Права в канале {channel_id} восстановлены, посты возобновлены")
+            dispatcher.reload(datetime.now())
+            text = (f"✅ Права бота в канале {channel_id} восстановлены, публикации возобновлены.\n\n"
+                    f"Посты, время которых прошло больше {CHANNEL_RESUME_GRACE / 3600:g} ч назад, отменены.")
+        for user_id in owners:
+            try:
+                await self.bot.send_message(chat_id=user_id, text=text)
+            except Exception as e:
+                logger.warning(f"Не удалось уведомить пользователя {user_id}: {e}")
+
+channel_monitor = ChannelPermissionMonitor(db)
 
 # ========== ОБРАБОТЧИК КНОПОК ==========
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка нажатий кнопок"""
+async def help_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Помощь"""
     query = update.callback_query
-    await query.answer()
-    
-    data = query.data
-    
-    if data == 'main_menu':
-        await start(update, context)
-    elif data == 'plan_post':
-        await plan_post_start(update, context)
-    elif data == 'my_channels':
-        await my_channels_command(update, context)
-    elif data == 'tariffs':
-        await tariffs_command(update, context)
-    elif data == 'help':
-        await query.edit_message_text(
-            "🆘 **Помощь**\n\n"
-            "📋 **Основные команды:**\n"
-            "/start - Главное меню\n"
-            "/add_channel - Добавить канал\n"
-            "/channels - Мои каналы\n"
-            "/tariffs - Информация о тарифе\n"
-            "/buy - Купить тариф\n\n"
-            "📅 **Планирование постов:**\n"
-            "1. Нажмите 'Запланировать пост'\n"
-            "2. Выберите канал\n"
-            "3. Отправьте контент\n"
-            "4. Выберите время\n"
-            "5. Подтвердите\n\n"
-            "👨‍💼 **Админ команды:**\n"
-            "/admin - Панель администратора\n\n"
-            "📞 **Поддержка:** @ваш_username"
-        )
-    elif data == 'buy_tariff':
-        await buy_tariff(update, context)
-    elif data.startswith('select_channel_'):
-        await select_channel_callback(update, context)
-    elif data in ['time_1h', 'time_3h', 'time_tomorrow_9', 'time_tomorrow_18', 'time_now', 'time_custom', 'cancel']:
-        await select_time_callback(update, context)
-    elif data in ['confirm_post', 'confirm_payment']:
-        await confirm_post_callback(update, context)
-    elif data == 'admin_set_price':
-        await admin_set_price_callback(update, context)
-    elif data == 'admin_set_channel':
-        await admin_set_channel_callback(update, context)
-    elif data == 'admin_stats':
-        await admin_stats_callback(update, context)
-    elif data == 'admin_users':
-        await admin_users_callback(update, context)
+    await query.edit_message_text(
+        "🆘 **Помощь**\n\n"
+        "📋 **Основные команды:**\n"
+        "/start - Главное меню\n"
+        "/add_channel - Добавить канал\n"
+        "/channels - Мои каналы\n"
+        "/tariffs - Информация о тарифе\n"
+        "/buy - Купить тариф\n\n"
+        "📅 **Планирование постов:**\n"
+        "1. Нажмите 'Запланировать пост'\n"
+        "2. Выберите канал\n"
+        "3. Отправьте контент\n"
+        "4. Выберите время\n"
+        "5. Подтвердите\n\n"
+        "🔁 Повторяющиеся посты - /series\n"
+        "📥 Много постов сразу - /import\n\n"
+        "👨‍💼 **Админ команды:**\n"
+        "/admin - Панель администратора\n\n"
+        "📞 **Поддержка:** @ваш_username"
+    )
 
-# ========== ГЛАВНАЯ ФУНКЦИЯ ==========
-async def main():
-    """Запуск бота"""
-    # Инициализируем базу данных
-    await db.init_db()
+class CallbackRouter:
+    """Маршрутизатор callback_data: точные ключи - через dict, префиксы - через trie.
+    
+    Роутер сам вызывает query.answer() ровно один раз до обработчика,
+    поэтому обработчики кнопок answer() не вызывают.
+    """
+    
+    _HANDLER = object()  # ключ узла trie, в котором лежит маршрут
+    
+    def __init__(self):
+        self.exact: Dict[str, Tuple] = {}
+        self.trie: Dict = {}
+        self.latency: Dict[str, Histogram] = {}
+        self.unknown = 0
+    
+    def route(self, key: str, handler, name: Optional[str] = None):
+        """Маршрут для точного значения callback_data"""
+        self.exact[key] = (name or key, handler)
+        self._track(name or key)
+    
+    def prefix(self, prefix: str, handler, name: Optional[str] = None):
+        """Маршрут для callback_data, начинающихся с prefix"""
+        node = self.trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[self._HANDLER] = (name or prefix, handler)
+        self._track(name or prefix)
+    
+    def _track(self, name: str):
+        self.latency[name] = metrics.histogram('bot_handler_duration_seconds',
+                                               'Время обработчиков команд, сообщений и кнопок',
+                                               kind='callback', handler=name)
+    
+    def resolve(self, data: str) -> Optional[Tuple]:
+        """(имя маршрута, обработчик); для префиксов - самый длинный совпавший"""
+        route = self.exact.get(data)
+        if route:
+            return route
+        node = self.trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            route = node.get(self._HANDLER, route)
+        return route
+    
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка нажатий кнопок"""
+        query = update.callback_query
+        await query.answer()
+        
+        route = self.resolve(query.data or "")
+        if route is None:
+            self.unknown += 1
+            logger.warning(f"Неизвестная кнопка: {query.data}")
+            return
+        
+        name, handler = route
+        started = time.perf_counter()
+        try:
+            await handler(update, context)
+        finally:
+            self.latency[name].observe(time.perf_counter() - started)
+    
+    def stats(self) -> Dict:
+        return {
+            'unknown': self.unknown,
+            'routes': {name: histogram.snapshot() for name, histogram in self.latency.items() if histogram.count},
+        }
+
+callback_router = CallbackRouter()
+callback_router.route('main_menu', start)
+callback_router.route('plan_post', plan_post_start)
+callback_router.route('my_channels', my_channels_command)
+callback_router.route('tariffs', tariffs_command)
+callback_router.route('help', help_callback)
+callback_router.route('buy_tariff', buy_tariff)
+callback_router.prefix('sc:', select_channel_callback, name='select_channel')
+callback_router.prefix('select_channel_', select_channel_callback, name='select_channel')
+callback_router.route('select_all_channels', select_channel_callback, name='select_channel')
+for key in ['time_1h', 'time_3h', 'time_tomorrow_9', 'time_tomorrow_18', 'time_now', 'time_custom', 'cancel']:
+    callback_router.route(key, select_time_callback, name='select_time')
+for key in ['confirm_post', 'confirm_payment']:
+    callback_router.route(key, confirm_post_callback, name='confirm_post')
+for key in SERIES_PRESETS:
+    callback_router.route(key, confirm_series_callback, name='confirm_series')
+callback_router.prefix('ss:', stop_series_callback, name='stop_series')
+callback_router.route('admin_set_price', admin_set_price_callback)
+callback_router.route('admin_set_channel', admin_set_channel_callback)
+callback_router.route('admin_stats', admin_stats_callback)
+callback_router.route('admin_trends', admin_trends_callback)
+callback_router.route('admin_users', admin_users_callback)
+callback_router.prefix('au:', admin_users_callback, name='admin_users')
+
+# ========== WEBHOOK ==========
+class WebhookIngress:
+    """Прием webhook-обновлений без ожидания обработчиков.
+    
+    Запрос только разбирает обновление, кладет его в ограниченную очередь
+    и сразу отвечает 200. Обновления обрабатывают workers фоновых задач.
+    Когда очередь полна: режим 'wait' ждет место до queue_timeout секунд,
+    режим 'reject' сразу отвечает 503, и Telegram повторит доставку позже.
+    """
+    
+    def __init__(self, application: Application, maxsize: int = WEBHOOK_QUEUE_SIZE,
+                 workers: int = WEBHOOK_WORKERS, backpressure: str = WEBHOOK_BACKPRESSURE,
+                 queue_timeout: float = WEBHOOK_QUEUE_TIMEOUT, dedup_window: int = WEBHOOK_DEDUP_WINDOW):
+        if backpressure not in ("wait", "reject"):
+            raise ValueError(f"Неизвестный режим backpressure: {backpressure}")
+        self.application = application
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.workers_count = workers
+        self.backpressure = backpressure
+        self.queue_timeout = queue_timeout
+        self.accepted = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.latency = metrics.histogram('bot_webhook_duration_seconds', 'Время приема webhook-запроса')
+        # Telegram повторяет доставку после таймаута - помним последние update_id
+        self._seen_ids: OrderedDict = OrderedDict()  # update_id в порядке приема
+        self.dedup_window = dedup_window
+        self._workers: List[asyncio.Task] = []
     
+    def start(self):
+        """Запуск обработчиков очереди"""
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+    
+    async def stop(self):
+        """Обработка оставшихся обновлений и остановка"""
+        await self.queue.join()
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+    
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+    
+    def stats(self) -> Dict:
+        return {
+            'depth': self.depth,
+            'maxsize': self.queue.maxsize,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'duplicates': self.duplicates,
+            'processed': self.processed,
+            'latency': self.latency.snapshot(),
+        }
+    
+    def _remember(self, update_id: int):
+        self._seen_ids[update_id] = None
+        if len(self._seen_ids) > self.dedup_window:
+            self._seen_ids.popitem(last=False)
+    
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления: {e}")
+            finally:
+                self.processed += 1
+                self.queue.task_done()
+    
+    async def enqueue(self, update: Update) -> bool:
+        """Постановка обновления в очередь с учетом backpressure"""
+        try:
+            if self.backpressure == "wait":
+                await asyncio.wait_for(self.queue.put(update), self.queue_timeout)
+            else:
+                self.queue.put_nowait(update)
+        except (asyncio.QueueFull, asyncio.TimeoutError):
+            self.rejected += 1
+            logger.warning(f"Очередь webhook переполнена ({self.depth}), обновление отклонено")
+            return False
+        self.accepted += 1
+        return True
+    
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        """Обработка webhook запросов"""
+        started = time.perf_counter()
+        try:
+            body = await request.read()
+            try:
+                data = orjson.loads(body) if orjson else json.loads(body)
+            except ValueError:
+                return web.Response(status=400, text="Bad Request")
+            if not isinstance(data, dict):
+                return web.Response(status=400, text="Bad Request")
+            
+            update_id = data.get('update_id')
+            if update_id in self._seen_ids:
+                # Повторная доставка: подтверждаем, но не обрабатываем
+                self.duplicates += 1
+                return web.Response(text="OK")
+            # Запоминаем до ожидания места в очереди, чтобы параллельный повтор не прошел
+            if update_id is not None:
+                self._remember(update_id)
+            
+            try:
+                update = Update.de_json(data, self.application.bot)
+            except Exception as e:
+                # Повтор доставки не исправит битое обновление - подтверждаем, чтобы Telegram не слал его снова
+                logger.error(f"Не удалось разобрать обновление {update_id}: {e}")
+                return web.Response(text="OK")
+            if not await self.enqueue(update):
+                # Отклоненное обновление Telegram пришлет снова - его нужно принять
+                self._seen_ids.pop(update_id, None)
+                return web.Response(status=503, text="Busy")
+            return web.Response(text="OK")
+        finally:
+            self.latency.observe(time.perf_counter() - started)
+    
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """Состояние очереди обновлений"""
+        return web.json_response(self.stats())
+
+# ========== ГЛАВНАЯ ФУНКЦИЯ ==========
+def build_application(base_url: Optional[str] = BOT_API_URL, application_class=Application) -> Application:
+    """Application со всеми обработчиками (base_url - поддельный Bot API нагрузочного стенда)"""
     # Создаем Application с настройками для Railway
-    request = HTTPXRequest(connection_pool_size=50)
+    request = InstrumentedRequest(connection_pool_size=50)
     
-    application = (
+    builder = (
         Application.builder()
+        .application_class(application_class)
         .token(BOT_TOKEN)
         .request(request)
         .concurrent_updates(True)  # Включаем параллельную обработку
-        .build()
     )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
     
     # Добавляем обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("tariffs", tariffs_command))
-    application.add_handler(CommandHandler("add_channel", add_channel_command))
-    application.add_handler(CommandHandler("channels", my_channels_command))
-    application.add_handler(CommandHandler("admin", admin_command))
-    application.add_handler(CommandHandler("buy", buy_tariff))
+    application.add_handler(CommandHandler("start", timed_handler('command', "start", start)))
+    application.add_handler(CommandHandler("tariffs", timed_handler('command', "tariffs", tariffs_command)))
+    application.add_handler(CommandHandler("add_channel", timed_handler('command', "add_channel", add_channel_command)))
+    application.add_handler(CommandHandler("channels", timed_handler('command', "channels", my_channels_command)))
+    application.add_handler(CommandHandler("admin", timed_handler('command', "admin", admin_command)))
+    application.add_handler(CommandHandler("buy", timed_handler('command', "buy", buy_tariff)))
+    application.add_handler(CommandHandler("import", timed_handler('command', "import", import_command)))
+    application.add_handler(CommandHandler("series", timed_handler('command', "series", series_command)))
     
     # Обработчик контента поста
     application.add_handler(MessageHandler(
         filters.TEXT | filters.PHOTO | filters.VIDEO,
-        handle_post_content
+        timed_handler('message', 'handle_post_content', handle_post_content)
+    ))
+    
+    # Массовый импорт постов из файла
+    application.add_handler(MessageHandler(
+        filters.Document.FileExtension('csv') | filters.Document.FileExtension('json'),
+        timed_handler('message', 'handle_bulk_import', handle_bulk_import)
     ))
     
     # Обработчики админских сообщений
     application.add_handler(MessageHandler(
-        filters.TEXT & filters.User(user_id=ADMIN_ID),
-        handle_admin_price,
-        pattern=r'^\d+$'
+        filters.TEXT & filters.User(user_id=ADMIN_ID) & filters.Regex(r'^\d+$'),
+        timed_handler('message', 'handle_admin_price', handle_admin_price)
     ))
     
     application.add_handler(MessageHandler(
-        filters.TEXT & filters.User(user_id=ADMIN_ID),
-        handle_admin_channel,
-        pattern=r'^-100\d+ .+'
+        filters.TEXT & filters.User(user_id=ADMIN_ID) & filters.Regex(r'^-100\d+ .+'),
+        timed_handler('message', 'handle_admin_channel', handle_admin_channel)
     ))
     
     # Обработчик пользовательского времени
     application.add_handler(MessageHandler(
         filters.Regex(r'^\d{4}\.\d{2}\.\d{2} \d{2}:\d{2}$'),
-        handle_custom_time
+        timed_handler('message', 'handle_custom_time', handle_custom_time)
     ))
     
     # Обработчик кнопок
-    application.add_handler(CallbackQueryHandler(button_handler))
-    
-    # Периодическая задача для публикации постов
-    job_queue = application.job_queue
-    job_queue.run_repeating(publish_scheduled_posts, interval=60, first=10)
+    application.add_handler(CallbackQueryHandler(callback_router.dispatch))
+    return application
+
+async def main():
+    """Запуск бота"""
+    # Инициализируем базу данных
+    await db.init_db()
+    application = build_application()
     
     # Запускаем бота
     if WEBHOOK_URL:
@@ -1076,19 +4148,21 @@ async def main():
         await application.bot.set_webhook(WEBHOOK_URL)
         await application.start()
         
-        # Создаем простой сервер для Railway
-        from aiohttp import web
+        # Диспетчер публикаций (спит до ближайшего поста вместо опроса базы)
+        publish_pipeline.start(application.bot)
+        dispatcher.start()
+        start_statistics_tasks()
+        channel_monitor.start(application.bot)
         
-        async def handle_webhook(request):
-            """Обработка webhook запросов"""
-            if request.method == "POST":
-                data = await request.json()
-                update = Update.de_json(data, application.bot)
-                await application.process_update(update)
-            return web.Response(text="OK")
+        # Создаем простой сервер для Railway
+        ingress = WebhookIngress(application)
+        metrics.gauge('bot_queue_depth', 'Глубина очередей', lambda: ingress.depth, queue='webhook')
+        ingress.start()
         
         app = web.Application()
-        app.router.add_post("/webhook", handle_webhook)
+        app.router.add_post("/webhook", ingress.handle_webhook)
+        app.router.add_get("/health", ingress.handle_health)
+        app.router.add_get("/metrics", metrics.handle_metrics)
         
         runner = web.AppRunner(app)
         await runner.setup()
@@ -1105,12 +4179,25 @@ async def main():
         await application.start()
         await application.updater.start_polling()
         
+        # Диспетчер публикаций (спит до ближайшего поста вместо опроса базы)
+        publish_pipeline.start(application.bot)
+        dispatcher.start()
+        start_statistics_tasks()
+        channel_monitor.start(application.bot)
+        
         logger.info("Бот запущен с polling")
         
         # Бесконечный цикл
         await asyncio.Event().wait()
 
 if __name__ == "__main__":
+    if "--check-query-plans" in sys.argv:
+        # Регрессионная проверка индексов: ненулевой код выхода, если горячий запрос сканирует таблицу
+        problems = asyncio.run(check_query_plans())
+        for problem in problems:
+            print(problem)
+        sys.exit(1 if problems else 0)
+    
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
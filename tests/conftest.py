@@ -0,0 +1,13 @@
+# tests/conftest.py
+"""Общие фикстуры: main.py лежит в корне репозитория, база - во временном каталоге"""
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+@pytest.fixture
+def db_path(tmp_path) -> str:
+    return str(tmp_path / 'scheduler.db')
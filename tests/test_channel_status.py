@@ -0,0 +1,59 @@
+# tests/test_channel_status.py
+"""Потеря и восстановление прав в канале для постов с копиями"""
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import main
+
+class FakeBot:
+    """Бот, который запоминает, куда отправлял"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        self.sent.append(chat_id)
+        return SimpleNamespace(message_id=len(self.sent))
+
+    async def copy_message(self, chat_id, from_chat_id, message_id):
+        self.sent.append(chat_id)
+        return SimpleNamespace(message_id=len(self.sent))
+
+async def publish(database: main.Database, pipeline: main.PublishPipeline, post_id: int):
+    posts = await database.claim_posts([post_id], main.WORKER_ID, datetime.now() + timedelta(minutes=5))
+    return await asyncio.gather(*pipeline.submit(posts))
+
+async def post_state(database: main.Database, post_id: int):
+    async with database.reader() as conn:
+        async with conn.execute('SELECT status FROM scheduled_posts WHERE id = ?', (post_id,)) as cursor:
+            status = (await cursor.fetchone())[0]
+    return status, await database.get_target_statuses(post_id)
+
+def test_fanout_copy_to_lost_channel_is_sent_after_resume(db_path):
+    async def run():
+        database = main.Database(db_path)
+        pipeline = main.PublishPipeline(database)
+        bot = FakeBot()
+        try:
+            await database.init_db()
+            await database.add_user(1, 'u', 'user')
+            post_id = await database.add_fanout_post(1, ['-1001', '-2001'], 'text', 'x', None, datetime.now())
+            await database.set_channel_status('-2001', 'lost')
+            pipeline.start(bot)
+
+            assert await publish(database, pipeline, post_id) == ['paused']
+            assert await post_state(database, post_id) == ('paused', ['paused'])
+            assert bot.sent == ['-1001']
+
+            await database.set_channel_status('-2001', 'active')
+            assert await post_state(database, post_id) == ('pending', ['pending'])
+
+            # Основной канал уже получил пост - досылается только копия
+            assert await publish(database, pipeline, post_id) == ['published']
+            assert await post_state(database, post_id) == ('published', ['published'])
+            assert bot.sent == ['-1001', '-2001']
+        finally:
+            await pipeline.stop()
+            await database.close()
+    asyncio.run(run())
@@ -0,0 +1,83 @@
+# tests/test_database_writes.py
+"""Атомарность списков операторов в _write при конкурентных записях"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+async def concurrent_writes(database: main.Database, rounds: int = 50):
+    await database.init_db()
+    when = datetime.now() + timedelta(days=1)
+    posts = []
+
+    async def fanout(i: int):
+        posts.append((await database.add_fanout_post(1, [f'-1{i}', f'-2{i}', f'-3{i}'], 'text', 'x', None, when),
+                      [f'-2{i}', f'-3{i}']))
+
+    # Одиночные записи вклиниваются между операторами списков
+    await asyncio.gather(*(coro for i in range(rounds) for coro in (
+        fanout(i),
+        database.add_user(1000 + i, 'u', 'user'),
+        database.add_payment(1000 + i, 'basic', 100),
+    )))
+    return posts
+
+@pytest.mark.parametrize('group_commit', [False, True])
+def test_list_writes_stay_atomic_under_concurrency(db_path, group_commit):
+    async def run():
+        database = main.Database(db_path, group_commit=group_commit)
+        try:
+            posts = await concurrent_writes(database)
+            assert len({post_id for post_id, _ in posts}) == len(posts)
+            for post_id, targets in posts:
+                assert sorted(await database.get_pending_targets(post_id)) == sorted(targets)
+            assert (await database.get_statistics())['total_users'] == 50
+        finally:
+            await database.close()
+    asyncio.run(run())
+
+def test_failed_list_write_leaves_no_rows(db_path):
+    async def run():
+        database = main.Database(db_path)
+        try:
+            await database.init_db()
+            with pytest.raises(Exception):
+                await database._write([
+                    ("INSERT INTO users (user_id, first_name) VALUES (1, 'a')", ()),
+                    ("INSERT INTO users (user_id, first_name) VALUES (1, 'b')", ()),
+                ])
+            await database.add_user(2, 'u', 'user')
+            assert await database.get_user(1) is None
+            assert await database.get_user(2) is not None
+        finally:
+            await database.close()
+    asyncio.run(run())
+
+def test_group_commit_survives_failed_rollback(db_path):
+    async def run():
+        database = main.Database(db_path, group_commit=True)
+        try:
+            await database.init_db()
+            conn = await database.connect()
+            commit, rollback = conn.commit, conn.rollback
+
+            async def broken():
+                conn.commit, conn.rollback = commit, rollback
+                raise main.aiosqlite.OperationalError('disk I/O error')
+
+            # Падают и коммит пачки, и ее откат
+            async def failing_commit():
+                conn.rollback = broken
+                raise main.aiosqlite.OperationalError('database is locked')
+            conn.commit = failing_commit
+            with pytest.raises(main.aiosqlite.OperationalError):
+                await database.add_user(1, 'u', 'user')
+            assert not database._flusher.done()
+            await asyncio.wait_for(database.add_user(2, 'u', 'user'), 5)
+            assert await database.get_user(1) is None
+            assert await database.get_user(2) is not None
+        finally:
+            await database.close()
+    asyncio.run(run())
@@ -0,0 +1,67 @@
+# tests/test_post_series.py
+"""Серии постов: выпуски при конкурентных записях и остановка серии"""
+import asyncio
+from datetime import datetime, timedelta
+
+import main
+
+def run_with_database(db_path, scenario):
+    async def run():
+        database = main.Database(db_path)
+        try:
+            await database.init_db()
+            await scenario(database)
+        finally:
+            await database.close()
+    asyncio.run(run())
+
+async def series_posts(database: main.Database, series_id: int):
+    async with database.reader() as conn:
+        async with conn.execute('SELECT id, status FROM scheduled_posts WHERE series_id = ? ORDER BY id',
+                                (series_id,)) as cursor:
+            return [tuple(row) for row in await cursor.fetchall()]
+
+def test_each_series_gets_its_first_issue_under_concurrent_writes(db_path):
+    start = datetime.now() + timedelta(hours=1)
+
+    async def scenario(database):
+        results = await asyncio.gather(*(coro for i in range(30) for coro in (
+            database.add_post_series(1, f'-100{i}', 'text', 'x', None, 'FREQ=DAILY', start),
+            database.add_payment(1, 'basic', 100),
+        )))
+        post_ids = results[::2]
+        assert len(set(post_ids)) == 30
+        for series_id in range(1, 31):
+            posts = await series_posts(database, series_id)
+            assert len(posts) == 1 and posts[0][1] == 'pending'
+            assert posts[0][0] in post_ids
+
+    run_with_database(db_path, scenario)
+
+def test_advance_series_creates_one_issue_per_step(db_path):
+    start = datetime.now() + timedelta(hours=1)
+
+    async def scenario(database):
+        await database.add_post_series(1, '-1001', 'text', 'x', None, 'FREQ=DAILY', start)
+        series = await database.get_series(1)
+        # Два воркера продлевают серию с одного и того же next_time
+        first, second = await asyncio.gather(
+            database.advance_series(1, series['next_time'], start + timedelta(days=1)),
+            database.advance_series(1, series['next_time'], start + timedelta(days=1)),
+        )
+        assert [first is None, second is None].count(True) == 1
+        assert len(await series_posts(database, 1)) == 2
+
+    run_with_database(db_path, scenario)
+
+def test_stop_series_cancels_issue_waiting_for_retry(db_path):
+    start = datetime.now() + timedelta(hours=1)
+
+    async def scenario(database):
+        post_id = await database.add_post_series(1, '-1001', 'text', 'x', None, 'FREQ=DAILY', start)
+        await database.schedule_retry(post_id, start, 'network: timeout')
+        assert await database.stop_series(1, 1)
+        assert await series_posts(database, 1) == [(post_id, 'cancelled')]
+        assert not await database.stop_series(1, 1)
+
+    run_with_database(db_path, scenario)
@@ -0,0 +1,19 @@
+# tests/test_publish_errors.py
+"""Разделение ошибок публикации на временные и постоянные"""
+import pytest
+from telegram.error import BadRequest, Conflict, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+
+import main
+
+@pytest.mark.parametrize('error, kind', [
+    (RetryAfter(5), 'rate_limited'),
+    (BadRequest('Chat not found'), 'permanent'),
+    (Forbidden('bot was kicked'), 'permanent'),
+    (Conflict('terminated by other getUpdates request'), 'permanent'),
+    (TelegramError('unknown'), 'permanent'),
+    (TimedOut(), 'retryable'),
+    (NetworkError('connection reset'), 'retryable'),
+    (OSError('connection refused'), 'retryable'),
+])
+def test_classify_publish_error(error, kind):
+    assert main.classify_publish_error(error) == kind
@@ -0,0 +1,35 @@
+# tests/test_query_plans.py
+"""Горячие запросы Database не должны читать таблицы целиком (EXPLAIN QUERY PLAN)"""
+import asyncio
+import inspect
+from datetime import datetime
+
+import main
+
+def public_methods(cls):
+    return {name for name, func in vars(cls).items()
+            if not name.startswith('_') and (inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func))}
+
+def test_no_full_table_scans():
+    assert asyncio.run(main.check_query_plans()) == []
+
+def test_every_database_method_is_checked():
+    # Новый метод Database без строки в query_plan_calls не проверялся бы вовсе
+    checked = {name for name, _ in main.query_plan_calls(main.Database(':memory:'), datetime.now())}
+    assert public_methods(main.Database) - checked - main.QUERY_PLAN_SKIPPED == set()
+
+def test_full_scan_is_reported():
+    async def run():
+        database = main.Database(':memory:')
+        try:
+            await database.init_db()
+            conn = await database.connect()
+            return await main.find_full_scans(conn, [
+                ('by_content', "SELECT id FROM scheduled_posts WHERE content = 'x'"),
+                ('by_id', 'SELECT id FROM scheduled_posts WHERE id = 1'),
+                ('json_each', "SELECT value FROM json_each('[1, 2]')"),
+            ])
+        finally:
+            await database.close()
+    problems = asyncio.run(run())
+    assert len(problems) == 1 and problems[0].startswith('by_content: SCAN scheduled_posts')